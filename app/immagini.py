@@ -8,7 +8,7 @@ from PIL import Image
 from io import BytesIO
 from app.models import NltOfferte, ImmaginiNlt
 from datetime import datetime
-from supabase import create_client
+from app.utils.storage import storage
 
 # Carico variabili ambiente
 load_dotenv()
@@ -22,14 +22,7 @@ engine = create_engine(DATABASE_URL)
 SessionLocal = sessionmaker(bind=engine)
 
 def upload_to_supabase(file_bytes, filename, content_type="image/webp"):
-    SUPABASE_URL = os.getenv("SUPABASE_URL")
-    SUPABASE_KEY = os.getenv("SUPABASE_KEY")
-    client = create_client(SUPABASE_URL, SUPABASE_KEY)
-
-    client.storage.from_("nlt-images").upload(
-        filename, file_bytes, {"content-type": content_type}
-    )
-    return client.storage.from_("nlt-images").get_public_url(filename)
+    return storage.carica_sync("nlt-images", filename, file_bytes, content_type)
 
 def recupera_e_carica_immagine(codice_modello, angle, solo_privati=None):
     params = {
@@ -35,6 +35,11 @@ from app.routes.customers import router as customers_router
 from app.routes.nlt import router as nlt_router
 from app.routes import status
 from app.tasks import scheduler
+from app.utils.executors import loop_lag_monitor, shutdown_executors
+from app.utils.image_cache import chiudi_http_client
+from app.utils.storage import storage
+from app.utils.click_buffer import click_buffer
+from app.utils.whatsapp_eventi import broker_whatsapp
 from app.routes.smtp_settings import router as smtp_router
 from app.routes.site_settings import router as site_settings_router
 from app.routes.motornet import router_usato, router_nuovo, router_generic
@@ -95,10 +100,16 @@ app = FastAPI(
 )
 
 
-# ✅ Avvia il cron job in un thread separato all'avvio dell'app
+# ✅ I job schedulati girano nel worker dedicato (python -m app.worker, vedi Procfile).
+# Nel processo web lo scheduler resta spento; RUN_SCHEDULER=true solo per sviluppo locale
+# a processo singolo.
+RUN_SCHEDULER = os.getenv("RUN_SCHEDULER", "false").lower() == "true"
 
 @app.on_event("startup")
 def start_cron_job():
+    if not RUN_SCHEDULER:
+        print("⏸️ APScheduler disattivato nel processo web (gira in app.worker)")
+        return
     scheduler.start()
     print("✅ Cron job APScheduler avviato!")
 
@@ -109,6 +120,42 @@ def stop_cron_job():
         print("🛑 APScheduler fermato")
 
 
+# ✅ Monitor del lag dell'event loop: logga lo stack di chi blocca il loop oltre soglia
+@app.on_event("startup")
+async def start_loop_monitor():
+    loop_lag_monitor.start()
+
+@app.on_event("shutdown")
+def stop_executors():
+    loop_lag_monitor.stop()
+    shutdown_executors()
+
+@app.on_event("shutdown")
+async def stop_http_clients():
+    await chiudi_http_client()
+    await storage.chiudi()
+
+
+# ✅ Writer dei click pubblici: flush a lotti, svuotato allo shutdown
+@app.on_event("startup")
+def start_click_writer():
+    click_buffer.start()
+
+@app.on_event("shutdown")
+def stop_click_writer():
+    click_buffer.stop()
+
+
+# ✅ Eventi WhatsApp in push: LISTEN su Postgres solo con WHATSAPP_PUBSUB_PG=true
+@app.on_event("startup")
+def start_whatsapp_eventi():
+    broker_whatsapp.start()
+
+@app.on_event("shutdown")
+def stop_whatsapp_eventi():
+    broker_whatsapp.stop()
+
+
 # ✅ Configurazione dello schema di autenticazione Bearer per Swagger UI
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
 
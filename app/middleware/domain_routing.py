@@ -6,24 +6,19 @@ from starlette.middleware.base import BaseHTTPMiddleware
 from sqlalchemy import text
 from urllib.parse import parse_qs, urlencode
 from app.database import engine  # usa il tuo engine sincrono
-import time
+from app.utils.tenant_cache import TTLCache
 
-# Cache in RAM: host -> (slug, is_primary, force_https)
-_DOMAIN_CACHE: Dict[str, Tuple[str, bool, bool]] = {}
-# Cache primaria: slug -> primary_host
-_PRIMARY_CACHE: Dict[str, str] = {}
-# TTL semplice (secondi). Se vuoi invalidare manualmente, svuota i dict.
+# Cache in RAM (vedi app.utils.tenant_cache.TTLCache): un'unica fotografia della tabella
+#   "domini" -> ({host: (slug, is_primary, force_https)}, {slug: primary_host})
+# Per invalidare manualmente: invalida_domini()
 _CACHE_TTL = 300
-_LAST_FILL = 0.0
+_domini_cache = TTLCache(_CACHE_TTL)
 
 def _normalize_host(request: Request) -> str:
     return (request.headers.get("host") or "").split(":")[0].strip().lower()
 
-def _now() -> float:
-    return time.time()
-
-def _refresh_needed() -> bool:
-    return (_now() - _LAST_FILL) > _CACHE_TTL
+def invalida_domini():
+    _domini_cache.invalida()
 
 def _build_url(request: Request, host: str, strip_slug: bool, force_https: bool, absolute: bool = True) -> str:
     scheme = "https" if force_https or request.url.scheme == "https" else "http"
@@ -35,39 +30,47 @@ def _build_url(request: Request, host: str, strip_slug: bool, force_https: bool,
     base = f"{scheme}://{host}" if absolute else ""
     return f"{base}{path}{('?' + query) if query else ''}"
 
-def _load_all_mappings():
+def _load_all_mappings() -> Tuple[Dict[str, Tuple[str, bool, bool]], Dict[str, str]]:
     """Carica tutta la tabella in cache (full refresh)."""
-    global _LAST_FILL
-    _DOMAIN_CACHE.clear()
-    _PRIMARY_CACHE.clear()
     with engine.connect() as conn:
         rows = conn.execute(text("""
             select domain, slug, is_primary, force_https
             from public.domain_aliases
         """)).mappings().all()
+    domini: Dict[str, Tuple[str, bool, bool]] = {}
     for r in rows:
-        host = r["domain"].lower()
-        _DOMAIN_CACHE[host] = (r["slug"], bool(r["is_primary"]), bool(r["force_https"]))
+        domini[r["domain"].lower()] = (r["slug"], bool(r["is_primary"]), bool(r["force_https"]))
     # build primary map
-    for host, (slug, is_primary, _fh) in _DOMAIN_CACHE.items():
-        if is_primary:
-            _PRIMARY_CACHE[slug] = host
-    _LAST_FILL = _now()
+    primari = {slug: host for host, (slug, is_primary, _fh) in domini.items() if is_primary}
+    _domini_cache.set("domini", (domini, primari))
+    return domini, primari
+
+def _mappings() -> Tuple[Dict[str, Tuple[str, bool, bool]], Dict[str, str]]:
+    cached = _domini_cache.get("domini")
+    if cached is not None:
+        return cached
+    try:
+        return _load_all_mappings()
+    except Exception:
+        # in caso di errore in refresh, prosegui senza mappature
+        return {}, {}
 
 def _get_domain_record(host: str) -> Optional[Tuple[str, bool, bool]]:
     """Ritorna (slug, is_primary, force_https) per host."""
-    if host in _DOMAIN_CACHE:
-        return _DOMAIN_CACHE[host]
+    domini, _ = _mappings()
+    if host in domini:
+        return domini[host]
     # cache miss: prova refresh e ripeti
-    _load_all_mappings()
-    return _DOMAIN_CACHE.get(host)
+    domini, _ = _load_all_mappings()
+    return domini.get(host)
 
 def _get_primary_host(slug: str) -> Optional[str]:
-    if slug in _PRIMARY_CACHE:
-        return _PRIMARY_CACHE[slug]
+    _, primari = _mappings()
+    if slug in primari:
+        return primari[slug]
     # cache stantia? ricarichiamo tutto
-    _load_all_mappings()
-    return _PRIMARY_CACHE.get(slug)
+    _, primari = _load_all_mappings()
+    return primari.get(slug)
 
 class DomainRoutingMiddleware(BaseHTTPMiddleware):
     async def dispatch(self, request: Request, call_next):
@@ -76,14 +79,6 @@ class DomainRoutingMiddleware(BaseHTTPMiddleware):
             if not host:
                 return Response("Dominio non configurato", status_code=404)
 
-            # refresh periodico (soft); non blocca se non necessario
-            if _refresh_needed():
-                try:
-                    _load_all_mappings()
-                except Exception:
-                    # in caso di errore in refresh, prosegui con cache vecchia
-                    pass
-
             rec = _get_domain_record(host)
             if not rec:
                 # Host sconosciuto: 404 esplicito (oppure puoi fare redirect ad un fallback noto)
@@ -724,6 +724,8 @@ class MnetDettagli(Base):
 
     pneumatici_anteriori = Column(Text)
     pneumatici_posteriori = Column(Text)
+    # Diametro cerchio maggiore (pollici) ricavato dalle misure pneumatici al sync
+    diametro_cerchio = Column(SmallInteger, nullable=True)
 
     massa_p_carico = Column(Text)
     indice_carico = Column(Text)
@@ -788,6 +790,10 @@ class MnetDettagli(Base):
 
     ultima_modifica = Column(TIMESTAMP, default=func.now(), onupdate=func.now())
 
+    # Sync incrementale: hash del payload Motornet e ultimo download
+    content_hash = Column(String(64), nullable=True)
+    fetched_at = Column(DateTime(timezone=True), nullable=True)
+
 
 class AzImage(Base):
     __tablename__ = "az_image"
@@ -1133,6 +1139,26 @@ class NltVetrinaClick(Base):
 
     dealer = relationship("User", backref="vetrina_click")
 
+
+# Contatori giornalieri dei click (vedi click_rollup_schema.sql): li aggiorna il writer
+# dei click nello stesso INSERT, le statistiche leggono solo da qui
+class NltOfferteClickGiorno(Base):
+    __tablename__ = "nlt_offerte_click_giorno"
+
+    giorno = Column(Date, primary_key=True)
+    id_offerta = Column(Integer, ForeignKey("nlt_offerte.id_offerta", ondelete="CASCADE"), primary_key=True)
+    id_dealer = Column(Integer, ForeignKey("public.utenti.id", ondelete="CASCADE"), primary_key=True, index=True)
+    click = Column(Integer, nullable=False, default=0)
+
+
+class NltVetrinaClickGiorno(Base):
+    __tablename__ = "nlt_vetrina_click_giorno"
+
+    giorno = Column(Date, primary_key=True)
+    id_dealer = Column(Integer, ForeignKey("public.utenti.id", ondelete="CASCADE"), primary_key=True)
+    click = Column(Integer, nullable=False, default=0)
+
+
 class NltOfferteRating(Base):
     __tablename__ = "nlt_offerte_rating"
     __table_args__ = {"schema": "public"}
@@ -1335,6 +1361,10 @@ class MnetDettaglioUsato(Base):
     paese_prod = Column(String)
     ridotte = Column(Boolean)
 
+    # Sync incrementale: hash del payload Motornet e ultimo download
+    content_hash = Column(String(64), nullable=True)
+    fetched_at = Column(DateTime(timezone=True), nullable=True)
+
 class NotificaType(Base):
     __tablename__ = "notifiche_type"
     __table_args__ = {"schema": "public"}
@@ -1510,6 +1540,12 @@ class UsatoLeonardo(Base):
     logo_offset_y = Column(Integer, nullable=True)
     retry_count = Column(Integer, nullable=False, default=0)
 
+    # lease del worker immagini (usato_leonardo_jobs_schema.sql)
+    lease_holder = Column(String, nullable=True)
+    lease_scade_il = Column(DateTime(timezone=True), nullable=True)
+    disponibile_dal = Column(DateTime(timezone=True), nullable=True)  # backoff tra un tentativo e l'altro
+    varianti = Column(JSONB, nullable=True)  # thumb / card / hero (media_encoding.VARIANTI_SHOWROOM)
+
     # ✅ nuovo campo per soft-delete
     is_deleted = Column(Boolean, default=False, nullable=False)
 
@@ -1523,6 +1559,17 @@ class UsatoLeonardo(Base):
     auto = relationship("AZLeaseUsatoAuto", backref="usato_media")
 
 
+class StorageUrlFirmata(Base):
+    __tablename__ = "storage_url_firmate"
+    __table_args__ = {"schema": "public"}
+
+    bucket = Column(String, primary_key=True)
+    path = Column(Text, primary_key=True)
+    url = Column(Text, nullable=False)
+    scade_il = Column(DateTime(timezone=True), nullable=False, index=True)
+    firmato_il = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+
 class ScenarioDealer(Base):
     __tablename__ = "scenario_dealer"
     __table_args__ = {"schema": "public"}
@@ -1563,6 +1610,71 @@ class MnetImmagini(Base):
     updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
 
 
+class JobLease(Base):
+    """Lease dei job schedulati (vedi app/utils/job_lease.py)."""
+    __tablename__ = "job_lease"
+    __table_args__ = {"schema": "public"}
+
+    nome = Column(String, primary_key=True)      # 'scheduler' oppure 'job:<modulo.funzione>'
+    holder = Column(String, nullable=False)      # host:pid:random del processo
+    scade_il = Column(DateTime(timezone=True), nullable=False)
+    acquisito_il = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+
+class MnetSyncRetry(Base):
+    """Coda persistente dei codici Motornet falliti, ripresi al giro successivo del job."""
+    __tablename__ = "mnet_sync_retry"
+    __table_args__ = {"schema": "public"}
+
+    job = Column(String, primary_key=True)       # es. 'nuovo_dettagli'
+    chiave = Column(String, primary_key=True)    # codice (o combinazione serializzata)
+    tentativi = Column(Integer, nullable=False, default=1)
+    ultimo_errore = Column(Text, nullable=True)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+
+
+class NltCatalogoVetrina(Base):
+    """Catalogo vetrina NLT per tenant con canone già calcolato (vedi app/utils/catalogo_nlt.py)."""
+    __tablename__ = "nlt_catalogo_vetrina"
+    __table_args__ = {"schema": "public"}
+
+    settings_id = Column(Integer, primary_key=True)
+    id_offerta = Column(Integer, primary_key=True)
+    admin_id = Column(Integer, nullable=False, index=True)
+    slug = Column(String(255), nullable=False)
+    marca = Column(String(100))
+    modello = Column(String(100))
+    versione = Column(String(100))
+    cambio = Column(String)
+    alimentazione = Column(String)
+    segmento = Column(String)
+    segmento_mnet = Column(String)               # MnetDettagli.segmento
+    segmento_descrizione = Column(String)
+    tipo_descrizione = Column(String)
+    id_player = Column(Integer)
+    solo_privati = Column(Boolean, nullable=False, default=False)
+    prezzo_listino = Column(Numeric(10, 2))
+    prezzo_totale = Column(Numeric(10, 2))
+    canone_mensile = Column(Numeric(10, 2))      # con provvigioni admin + dealer
+    durata_mesi = Column(Integer)
+    km_inclusi = Column(Integer)
+    canone_60_40 = Column(Numeric(10, 2))
+    ha_dettagli = Column(Boolean, nullable=False, default=False)
+    immagine = Column(String(1000))
+    rating_convenienza = Column(SmallInteger)
+    aggiornato_il = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    # search_vector / testo_ricerca: colonne generate, gestite solo lato DB (vedi app/utils/ricerca.py)
+
+
+class NltCatalogoDaAggiornare(Base):
+    """Admin il cui catalogo va ricalcolato (riempita dai trigger)."""
+    __tablename__ = "nlt_catalogo_da_aggiornare"
+    __table_args__ = {"schema": "public"}
+
+    admin_id = Column(Integer, primary_key=True)
+    segnato_il = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
 
 class AIAssistente(Base):
     __tablename__ = "ai_assistenti"
@@ -1,10 +1,12 @@
 ﻿from fastapi import APIRouter, Depends, HTTPException, Request, Body, Header
 from sqlalchemy.orm import Session
-from sqlalchemy import func, desc, cast, Date
+from sqlalchemy import func, desc
 from datetime import datetime, timedelta
 
 from app.database import get_db
-from app.models import NltOfferteClick, NltOfferte, User, NltVetrinaClick, SiteAdminSettings
+from app.utils.tenant_cache import risolvi_tenant
+from app.utils.click_buffer import click_buffer
+from app.models import NltOfferteClickGiorno, NltOfferte, User, NltVetrinaClickGiorno
 from app.auth_helpers import (
     get_admin_id,
     get_dealer_id,
@@ -30,19 +32,19 @@ def offerte_piu_cliccate(
     if is_admin_user(current_user):
         # Admin → offerte cliccate dove id_admin == mio ID
         query = db.query(
-            NltOfferteClick.id_offerta,
-            func.count().label("totale_click"),
+            NltOfferteClickGiorno.id_offerta,
+            func.sum(NltOfferteClickGiorno.click).label("totale_click"),
             NltOfferte.marca,
             NltOfferte.modello,
             NltOfferte.versione,
             NltOfferte.solo_privati,
             User.id.label("dealer_id"),
             User.ragione_sociale
-        ).join(NltOfferte, NltOfferteClick.id_offerta == NltOfferte.id_offerta)\
-         .join(User, NltOfferteClick.id_dealer == User.id)\
+        ).join(NltOfferte, NltOfferteClickGiorno.id_offerta == NltOfferte.id_offerta)\
+         .join(User, NltOfferteClickGiorno.id_dealer == User.id)\
          .filter(NltOfferte.id_admin == admin_id)\
          .group_by(
-            NltOfferteClick.id_offerta,
+            NltOfferteClickGiorno.id_offerta,
             NltOfferte.marca,
             NltOfferte.modello,
             NltOfferte.versione,
@@ -57,7 +59,7 @@ def offerte_piu_cliccate(
                 "marca": r.marca,
                 "modello": r.modello,
                 "versione": r.versione,
-                "totale_click": r.totale_click,
+                "totale_click": int(r.totale_click),
                 "dealer_id": r.dealer_id,
                 "solo_privati": r.solo_privati,
                 "dealer_ragione_sociale": r.ragione_sociale
@@ -70,19 +72,19 @@ def offerte_piu_cliccate(
         # - il dealer è sé stesso
         # - oppure l’offerta è del suo admin
         query = db.query(
-            NltOfferteClick.id_offerta,
-            func.count().label("totale_click"),
+            NltOfferteClickGiorno.id_offerta,
+            func.sum(NltOfferteClickGiorno.click).label("totale_click"),
             NltOfferte.marca,
             NltOfferte.modello,
             NltOfferte.versione,
             NltOfferte.solo_privati
-        ).join(NltOfferte, NltOfferteClick.id_offerta == NltOfferte.id_offerta)\
+        ).join(NltOfferte, NltOfferteClickGiorno.id_offerta == NltOfferte.id_offerta)\
          .filter(
-            (NltOfferteClick.id_dealer == dealer_id) |
+            (NltOfferteClickGiorno.id_dealer == dealer_id) |
             (NltOfferte.id_admin == admin_id)
          )\
          .group_by(
-            NltOfferteClick.id_offerta,
+            NltOfferteClickGiorno.id_offerta,
             NltOfferte.marca,
             NltOfferte.modello,
             NltOfferte.versione,
@@ -95,7 +97,7 @@ def offerte_piu_cliccate(
                 "marca": r.marca,
                 "modello": r.modello,
                 "versione": r.versione,
-                "totale_click": r.totale_click,
+                "totale_click": int(r.totale_click),
                 "solo_privati": r.solo_privati
             }
             for r in query.all()
@@ -116,11 +118,11 @@ def clicks_giornalieri(
     # === Admin ===
     if is_admin_user(current_user):
         query = db.query(
-            cast(NltOfferteClick.clicked_at, Date).label("giorno"),
-            func.count().label("click")
-        ).join(NltOfferte, NltOfferteClick.id_offerta == NltOfferte.id_offerta)\
+            NltOfferteClickGiorno.giorno.label("giorno"),
+            func.sum(NltOfferteClickGiorno.click).label("click")
+        ).join(NltOfferte, NltOfferteClickGiorno.id_offerta == NltOfferte.id_offerta)\
          .filter(
-             NltOfferteClick.clicked_at >= inizio,
+             NltOfferteClickGiorno.giorno >= inizio,
              NltOfferte.id_admin == admin_id  # include offerte sue e dei suoi dealer
          )\
          .group_by("giorno").order_by("giorno")
@@ -133,12 +135,12 @@ def clicks_giornalieri(
     # === Dealer ===
     else:
         query = db.query(
-            cast(NltOfferteClick.clicked_at, Date).label("giorno"),
-            func.count().label("click")
-        ).join(NltOfferte, NltOfferteClick.id_offerta == NltOfferte.id_offerta)\
+            NltOfferteClickGiorno.giorno.label("giorno"),
+            func.sum(NltOfferteClickGiorno.click).label("click")
+        ).join(NltOfferte, NltOfferteClickGiorno.id_offerta == NltOfferte.id_offerta)\
          .filter(
-             NltOfferteClick.clicked_at >= inizio,
-             (NltOfferteClick.id_dealer == dealer_id) | (NltOfferte.id_admin == admin_id)
+             NltOfferteClickGiorno.giorno >= inizio,
+             (NltOfferteClickGiorno.id_dealer == dealer_id) | (NltOfferte.id_admin == admin_id)
          )\
          .group_by("giorno").order_by("giorno")
 
@@ -164,8 +166,8 @@ def offerte_piu_cliccate_global(
             NltOfferte.modello,
             NltOfferte.versione,
             NltOfferte.solo_privati,
-            func.count(NltOfferteClick.id).label("totale_click")
-        ).join(NltOfferte, NltOfferteClick.id_offerta == NltOfferte.id_offerta)
+            func.sum(NltOfferteClickGiorno.click).label("totale_click")
+        ).join(NltOfferte, NltOfferteClickGiorno.id_offerta == NltOfferte.id_offerta)
 
         if admin_id:
             query = query.filter(NltOfferte.id_admin == admin_id)
@@ -213,19 +215,19 @@ def clicks_per_dealer(
     subq_admin = db.query(
         literal(admin_id).label("dealer_id"),
         literal(current_user.ragione_sociale or "Admin").label("ragione_sociale"),
-        func.count(NltOfferteClick.id).label("totale_click")
-    ).join(NltOfferte, NltOfferteClick.id_offerta == NltOfferte.id_offerta)\
+        func.coalesce(func.sum(NltOfferteClickGiorno.click), 0).label("totale_click")
+    ).join(NltOfferte, NltOfferteClickGiorno.id_offerta == NltOfferte.id_offerta)\
      .filter(
          NltOfferte.id_admin == admin_id,
-         NltOfferteClick.id_dealer == admin_id  # cliccate sulla vetrina dell’admin
+         NltOfferteClickGiorno.id_dealer == admin_id  # cliccate sulla vetrina dell’admin
      )
 
     # 👥 Click per tutti i dealer figli dell’admin
     subq_dealer = db.query(
         User.id.label("dealer_id"),
         User.ragione_sociale.label("ragione_sociale"),
-        func.count(NltOfferteClick.id).label("totale_click")
-    ).join(User, NltOfferteClick.id_dealer == User.id)\
+        func.sum(NltOfferteClickGiorno.click).label("totale_click")
+    ).join(User, NltOfferteClickGiorno.id_dealer == User.id)\
      .filter(User.parent_id == admin_id)\
      .group_by(User.id, User.ragione_sociale)
 
@@ -261,19 +263,19 @@ def offerte_cliccate_per_dealer(
     if dealer_id == admin_id:
         # admin → deve vedere solo le sue offerte, cliccate sulla sua vetrina
         query = db.query(
-            NltOfferteClick.id_offerta,
+            NltOfferteClickGiorno.id_offerta,
             NltOfferte.marca,
             NltOfferte.modello,
             NltOfferte.versione,
             NltOfferte.solo_privati,
-            func.count().label("totale_click")
-        ).join(NltOfferte, NltOfferteClick.id_offerta == NltOfferte.id_offerta)\
+            func.sum(NltOfferteClickGiorno.click).label("totale_click")
+        ).join(NltOfferte, NltOfferteClickGiorno.id_offerta == NltOfferte.id_offerta)\
          .filter(
              NltOfferte.id_admin == admin_id,
-             NltOfferteClick.id_dealer == admin_id
+             NltOfferteClickGiorno.id_dealer == admin_id
          )\
          .group_by(
-             NltOfferteClick.id_offerta,
+             NltOfferteClickGiorno.id_offerta,
              NltOfferte.marca,
              NltOfferte.modello,
              NltOfferte.versione,
@@ -286,16 +288,16 @@ def offerte_cliccate_per_dealer(
             raise HTTPException(status_code=403, detail="Dealer non autorizzato")
 
         query = db.query(
-            NltOfferteClick.id_offerta,
+            NltOfferteClickGiorno.id_offerta,
             NltOfferte.marca,
             NltOfferte.modello,
             NltOfferte.versione,
             NltOfferte.solo_privati,
-            func.count().label("totale_click")
-        ).join(NltOfferte, NltOfferteClick.id_offerta == NltOfferte.id_offerta)\
-         .filter(NltOfferteClick.id_dealer == dealer_id)\
+            func.sum(NltOfferteClickGiorno.click).label("totale_click")
+        ).join(NltOfferte, NltOfferteClickGiorno.id_offerta == NltOfferte.id_offerta)\
+         .filter(NltOfferteClickGiorno.id_dealer == dealer_id)\
          .group_by(
-             NltOfferteClick.id_offerta,
+             NltOfferteClickGiorno.id_offerta,
              NltOfferte.marca,
              NltOfferte.modello,
              NltOfferte.versione,
@@ -325,21 +327,19 @@ async def registra_click_vetrina(
     db: Session = Depends(get_db)
 ):
     # 1. Recupera impostazioni del dealer
-    settings = db.query(SiteAdminSettings).filter(SiteAdminSettings.slug == dealer_slug).first()
-    if not settings:
+    tenant = risolvi_tenant(db, dealer_slug)
+    if not tenant:
         raise HTTPException(status_code=404, detail=f"Dealer '{dealer_slug}' non trovato.")
-    id_dealer = settings.dealer_id or settings.admin_id
+    id_dealer = tenant.dealer_id or tenant.settings.admin_id
 
-    # 2. Registra click vetrina
-    click = NltVetrinaClick(
+    # 2. Registra click vetrina nel buffer write-behind (vedi app/utils/click_buffer.py)
+    click_buffer.click_vetrina(
         id_dealer=id_dealer,
         evento=evento,
+        ip=request.client.host if request.client else None,
         user_agent=user_agent,
-        ip=request.client.host,
         referrer=request.headers.get("referer")
     )
-    db.add(click)
-    db.commit()
 
     return {"success": True}
 
@@ -357,8 +357,8 @@ def vetrine_piu_visitate(
     query = db.query(
         User.id.label("dealer_id"),
         User.ragione_sociale.label("ragione_sociale"),
-        func.count(NltVetrinaClick.id).label("totale_click")
-    ).join(User, NltVetrinaClick.id_dealer == User.id)\
+        func.sum(NltVetrinaClickGiorno.click).label("totale_click")
+    ).join(User, NltVetrinaClickGiorno.id_dealer == User.id)\
      .filter(
          (User.parent_id == admin_id) | (User.id == admin_id)
      )\
@@ -369,7 +369,7 @@ def vetrine_piu_visitate(
         {
             "dealer_id": r.dealer_id,
             "ragione_sociale": r.ragione_sociale,
-            "totale_click": r.totale_click
+            "totale_click": int(r.totale_click)
         }
         for r in query.all()
     ]
@@ -389,22 +389,22 @@ def clicks_vetrina_giornalieri(
     if is_admin_user(current_user):
         # Vetrine dei dealer figli + admin stesso
         subq = db.query(
-            cast(NltVetrinaClick.clicked_at, Date).label("giorno"),
-            func.count().label("click")
-        ).join(User, NltVetrinaClick.id_dealer == User.id)\
+            NltVetrinaClickGiorno.giorno.label("giorno"),
+            func.sum(NltVetrinaClickGiorno.click).label("click")
+        ).join(User, NltVetrinaClickGiorno.id_dealer == User.id)\
          .filter(
-            NltVetrinaClick.clicked_at >= inizio,
+            NltVetrinaClickGiorno.giorno >= inizio,
             (User.parent_id == admin_id) | (User.id == admin_id)
          )\
          .group_by("giorno").order_by("giorno")
     else:
         # Solo la propria vetrina
         subq = db.query(
-            cast(NltVetrinaClick.clicked_at, Date).label("giorno"),
-            func.count().label("click")
+            NltVetrinaClickGiorno.giorno.label("giorno"),
+            func.sum(NltVetrinaClickGiorno.click).label("click")
         ).filter(
-            NltVetrinaClick.clicked_at >= inizio,
-            NltVetrinaClick.id_dealer == dealer_id
+            NltVetrinaClickGiorno.giorno >= inizio,
+            NltVetrinaClickGiorno.id_dealer == dealer_id
         )\
         .group_by("giorno").order_by("giorno")
 
@@ -424,16 +424,16 @@ def offerte_cliccate_nella_mia_vetrina(
     dealer_id = current_user.id if current_user.role == "dealer" else current_user.parent_id
 
     query = db.query(
-        NltOfferteClick.id_offerta,
+        NltOfferteClickGiorno.id_offerta,
         NltOfferte.marca,
         NltOfferte.modello,
         NltOfferte.versione,
         NltOfferte.solo_privati,
-        func.count().label("totale_click")
-    ).join(NltOfferte, NltOfferteClick.id_offerta == NltOfferte.id_offerta)\
-     .filter(NltOfferteClick.id_dealer == dealer_id)\
+        func.sum(NltOfferteClickGiorno.click).label("totale_click")
+    ).join(NltOfferte, NltOfferteClickGiorno.id_offerta == NltOfferte.id_offerta)\
+     .filter(NltOfferteClickGiorno.id_dealer == dealer_id)\
      .group_by(
-        NltOfferteClick.id_offerta,
+        NltOfferteClickGiorno.id_offerta,
         NltOfferte.marca,
         NltOfferte.modello,
         NltOfferte.versione,
@@ -1,7 +1,8 @@
 ﻿from fastapi import APIRouter, Depends, HTTPException
 from pydantic import BaseModel
 from typing import Optional, List
-from sqlalchemy.orm import Session
+from sqlalchemy import text
+from sqlalchemy.orm import Session, selectinload
 from app.database import get_db
 from app.models import (
     AIAssistente,
@@ -9,13 +10,17 @@ from app.models import (
     AIChatLogAuto,
     AZLeaseUsatoAuto,
     AZLeaseUsatoIn,
+    MnetDettaglioUsato,
 )
+from app.utils.ricerca import filtro_ricerca, applica_soglia
 
 import httpx, os
 import logging
 
 logger = logging.getLogger("uvicorn.error")  # agganciato ai log di uvicorn
 
+MAX_AUTO_CONTESTO = int(os.getenv("ASSISTENTE_MAX_AUTO", "30"))
+
 
 router = APIRouter(prefix="/api/assistente", tags=["Assistente"])
 
@@ -85,68 +90,65 @@ async def call_ai(assistente: AIAssistente, domanda: str, auto: List[dict]) -> s
         return data["choices"][0]["message"]["content"]
 
 
-def get_auto_for_assistant(db: Session, assistente: AIAssistente, slug: str):
-
-    print("=== DEBUG get_auto_for_assistant ===")
-    print("Slug richiesto:", slug)
-    print("Assistente:", {
-        "id": str(assistente.id),
-        "dealer_user_id": assistente.dealer_user_id,
-        "slug": assistente.slug,
-        "modello": assistente.modello,
-        "attivo": assistente.attivo
-    })
-
-    try:
-        query = (
-            db.query(AZLeaseUsatoAuto)
-            .join(AZLeaseUsatoIn, AZLeaseUsatoAuto.id_usatoin == AZLeaseUsatoIn.id)
-            .filter(AZLeaseUsatoIn.visibile == True)
+def get_auto_for_assistant(db: Session, assistente: AIAssistente, slug: str, domanda: Optional[str] = None):
+    """
+    Auto da mettere nel contesto dell'assistente: se la domanda cita marca/modello
+    (anche con errori di battitura) le più rilevanti, altrimenti le ultime inserite.
+    Al massimo MAX_AUTO_CONTESTO auto.
+    """
+    query = (
+        db.query(
+            AZLeaseUsatoAuto,
+            MnetDettaglioUsato.marca_nome,
+            MnetDettaglioUsato.modello,
+            MnetDettaglioUsato.allestimento,
         )
+        .join(AZLeaseUsatoIn, AZLeaseUsatoAuto.id_usatoin == AZLeaseUsatoIn.id)
+        .outerjoin(MnetDettaglioUsato, MnetDettaglioUsato.codice_motornet_uni == AZLeaseUsatoAuto.codice_motornet)
+        .options(selectinload(AZLeaseUsatoAuto.usatoin))
+        .filter(AZLeaseUsatoIn.visibile == True)
+    )
 
-        if slug != "azure-automotive":  # se non admin → filtro per dealer
-            query = query.filter(AZLeaseUsatoIn.dealer_id == assistente.dealer_user_id)
-
-        autos = query.all()
-        print(f"Numero auto trovate: {len(autos)}")
-
-        results = []
-        for auto in autos:
-            try:
-                print(">> Auto:", str(auto.id), "targa:", auto.targa)
-
-                accessori = [a.descrizione for a in auto.accessori_optional if a.presente]
-                pacchetti = [p.descrizione for p in auto.accessori_pacchetti if p.presente]
+    if slug != "azure-automotive":  # se non admin → filtro per dealer
+        query = query.filter(AZLeaseUsatoIn.dealer_id == assistente.dealer_user_id)
+
+    rows = []
+    ricerca = filtro_ricerca(domanda, "mnet_dettagli_usato.testo_ricerca", "mnet_dettagli_usato.search_vector")
+    if ricerca:
+        applica_soglia(db)
+        rows = (
+            query.filter(text(ricerca.where))
+            .order_by(text(f"{ricerca.rilevanza} DESC"))
+            .params(**ricerca.params)
+            .limit(MAX_AUTO_CONTESTO)
+            .all()
+        )
+    if not rows:
+        rows = query.order_by(AZLeaseUsatoIn.data_inserimento.desc()).limit(MAX_AUTO_CONTESTO).all()
 
-                descr = auto.precisazioni or ""
-                if accessori:
-                    descr += " Accessori: " + ", ".join(accessori)
-                if pacchetti:
-                    descr += " Pacchetti: " + ", ".join(pacchetti)
+    logger.info("Auto per contesto assistente slug=%s: %d (ricerca=%s)", slug, len(rows), bool(ricerca))
 
-                prezzo = None
-                if auto.usatoin:
-                    prezzo = auto.usatoin.prezzo_vendita
-                else:
-                    print("⚠️  Attenzione: usatoin mancante per auto", str(auto.id))
+    results = []
+    for auto, marca_nome, modello, allestimento in rows:
+        accessori = [a.descrizione for a in auto.accessori_optional if a.presente]
+        pacchetti = [p.descrizione for p in auto.accessori_pacchetti if p.presente]
 
-                results.append({
-                    "id": str(auto.id),
-                    "marca": auto.codice_motornet or "n.d.",
-                    "modello": "",  # TODO: join su mnet_dettagli_usato
-                    "anno": auto.anno_immatricolazione,
-                    "prezzo": prezzo,
-                    "descrizione": descr
-                })
-            except Exception as e:
-                print("❌ Errore processando auto", str(auto.id), ":", e)
+        descr = auto.precisazioni or ""
+        if accessori:
+            descr += " Accessori: " + ", ".join(accessori)
+        if pacchetti:
+            descr += " Pacchetti: " + ", ".join(pacchetti)
 
-        print("=== Fine DEBUG get_auto_for_assistant ===")
-        return results
+        results.append({
+            "id": str(auto.id),
+            "marca": marca_nome or auto.codice_motornet or "n.d.",
+            "modello": " ".join(x for x in (modello, allestimento) if x),
+            "anno": auto.anno_immatricolazione,
+            "prezzo": auto.usatoin.prezzo_vendita if auto.usatoin else None,
+            "descrizione": descr
+        })
 
-    except Exception as e:
-        print("❌ Errore generale in get_auto_for_assistant:", e)
-        raise
+    return results
 
 
 
@@ -167,7 +169,7 @@ async def chat_with_assistant(slug: str, req: ChatRequest, db: Session = Depends
     )
 
     # Recupera le auto
-    auto = get_auto_for_assistant(db, assistente, slug)
+    auto = get_auto_for_assistant(db, assistente, slug, domanda=req.domanda)
     logger.info("Auto trovate per slug=%s: %s", slug, [a['id'] for a in auto])
 
     if not auto:
@@ -9,6 +9,7 @@ from jose import JWTError, jwt
 import os
 from dotenv import load_dotenv
 from fastapi_jwt_auth import AuthJWT
+from app.utils.principal_cache import risolvi_principal
 from pydantic import BaseModel
 
 load_dotenv()
@@ -63,7 +64,7 @@ def get_current_user(token: str = Security(oauth2_scheme), db: Session = Depends
     if user_email is None:
         raise HTTPException(status_code=401, detail="Token JWT non contiene il campo 'sub'")
 
-    user = db.query(User).filter(User.email == user_email).first()
+    user = risolvi_principal(db, user_email)
     if user is None:
         raise HTTPException(status_code=401, detail="Utente non trovato")
 
@@ -23,7 +23,17 @@ from app.routes.auth import get_current_user  # la funzione che decodifica JWT
 from typing import List
 import uuid
 from uuid import UUID
-from app.routes.motornet import get_motornet_token  # ✅ importa la funzione dove definita
+from app.utils.motornet_token import get_motornet_token  # ✅ importa la funzione dove definita
+from app.utils.usato_pubblico import (
+    lista_usato_pubblico_batch,
+    conta_usato_pubblico,
+    stream_usato_pubblico_ndjson,
+    codifica_cursore,
+    decodifica_cursore,
+)
+from app.utils.tenant_cache import TenantContext, get_tenant
+from app.utils.url_firmate import url_firmate
+from fastapi.responses import StreamingResponse
 from datetime import date
 import asyncio
 
@@ -126,7 +136,7 @@ async def inserisci_auto_usata(
 
             if not exists:
                 print(f"📡 Dettagli Motornet assenti per {codice}, provo a importarli...")
-                from app.routes.motornet import get_motornet_token
+                from app.utils.motornet_token import get_motornet_token
                 headers = {
                     "Authorization": f"Bearer {get_motornet_token()}",
                     "Content-Type": "application/json"
@@ -2041,167 +2051,80 @@ def elimina_perizia_usato(
 
 
 @router.get("/usato-pubblico/{slug}", tags=["Public AZLease"])
-async def lista_usato_pubblico(
+def lista_usato_pubblico(
     slug: str,
+    cursor: Optional[str] = Query(None),
+    limit: Optional[int] = Query(None, ge=1, le=500),
+    marca: Optional[str] = Query(None),
+    alimentazione: Optional[str] = Query(None),
+    prezzo_min: Optional[float] = Query(None),
+    prezzo_max: Optional[float] = Query(None),
+    km_max: Optional[int] = Query(None, ge=0),
+    search: Optional[str] = Query(None),
+    count_only: bool = Query(False),
+    stream: bool = Query(False),
+    tenant: TenantContext = Depends(get_tenant),
     db: Session = Depends(get_db)
 ):
-    # Settings del sito (admin o dealer)
-    settings = db.query(SiteAdminSettings).filter(SiteAdminSettings.slug == slug).first()
-    if not settings:
-        raise HTTPException(404, f"Slug '{slug}' non trovato")
+    """
+    Vetrina pubblica usato.
+    - senza `limit`/`cursor`: lista completa (compatibile con i client esistenti)
+    - con `limit`: pagina keyset `{results, next_cursor}`; passare `next_cursor` come `cursor`
+    - `count_only`: solo `{count}` con gli stessi filtri
+    - `stream`: NDJSON, una auto per riga
+    - `search`: marca/modello/allestimento per prefisso o con errori di battitura
+    """
+    # Settings del sito (admin o dealer), dalla cache tenant
+    settings = tenant.settings
+
+    filtri = {
+        "marca": marca,
+        "alimentazione": alimentazione,
+        "prezzo_min": prezzo_min,
+        "prezzo_max": prezzo_max,
+        "km_max": km_max,
+        "search": search,
+    }
 
-    admin_id = settings.admin_id
-    slug_dealer_id = settings.dealer_id  # None se brand admin
+    if count_only:
+        return {"count": conta_usato_pubblico(db, settings, **filtri)}
 
-    # Lista auto base
-    rows = db.execute(text("""
-        SELECT 
-            a.id AS id_auto,
-            a.anno_immatricolazione,
-            a.km_certificati,
-            a.colore,
-            a.codice_motornet,
-            a.cronologia_tagliandi,
-            i.prezzo_vendita,
-            i.iva_esposta,
-            i.data_inserimento,
-            i.opzionato_da,
-            i.venduto_da,
-            i.dealer_id,
-            d.marca_nome AS marca,
-            d.allestimento
-        FROM azlease_usatoauto a
-        JOIN azlease_usatoin i ON i.id = a.id_usatoin
-        LEFT JOIN mnet_dettagli_usato d ON d.codice_motornet_uni = a.codice_motornet
-        WHERE i.admin_id = :admin_id
-          AND i.visibile = TRUE
-          AND (:dealer_id IS NULL OR i.dealer_id = :dealer_id)
-        ORDER BY i.data_inserimento DESC
-    """), {"admin_id": admin_id, "dealer_id": slug_dealer_id}).fetchall()
-
-    # Prefetch settings per i dealer
-    dealer_ids = {r.dealer_id for r in rows if getattr(r, "dealer_id", None) is not None}
-    dealer_settings = {}
-    if dealer_ids:
-        q = (
-            db.query(SiteAdminSettings.dealer_id,
-                     SiteAdminSettings.logo_web,
-                     SiteAdminSettings.meta_title,
-                     SiteAdminSettings.contact_address)
-              .filter(SiteAdminSettings.dealer_id.in_(dealer_ids))
+    if stream:
+        if cursor:
+            decodifica_cursore(cursor)  # 400 prima di aprire lo stream
+        return StreamingResponse(
+            stream_usato_pubblico_ndjson(slug, cursor=cursor, limit=limit, **filtri),
+            media_type="application/x-ndjson"
         )
-        for r in q.all():
-            dealer_settings[r.dealer_id] = {
-                "logo": r.logo_web,
-                "nome": r.meta_title,
-                "indirizzo": r.contact_address,
-            }
 
-    admin_defaults = {
-        "logo": settings.logo_web,
-        "nome": settings.meta_title,
-        "indirizzo": settings.contact_address,
-    }
+    # Relazioni (foto, media AI, dettagli, vetrina) caricate a insiemi: query costanti per N auto
+    if limit is None and cursor is None:
+        return lista_usato_pubblico_batch(db, settings, **filtri)
 
-    risultato = []
-    for row in rows:
-        auto = dict(row._mapping)
-
-        # immagini classiche (fallback)
-        immagini = db.execute(text("""
-            SELECT id, foto AS foto_url, principale
-            FROM azlease_usatoimg
-            WHERE auto_id = :id_auto
-            ORDER BY principale DESC, id ASC
-        """), {"id_auto": auto["id_auto"]}).fetchall()
-
-        # immagine AI attiva (fallback)
-        img_ai = db.execute(text("""
-            SELECT public_url
-            FROM usato_leonardo
-            WHERE id_auto = :id_auto AND media_type = 'image' AND is_active = true
-            ORDER BY id DESC LIMIT 1
-        """), {"id_auto": auto["id_auto"]}).fetchone()
-
-        # video AI attivo (fallback)
-        vid_ai = db.execute(text("""
-            SELECT public_url
-            FROM usato_leonardo
-            WHERE id_auto = :id_auto AND media_type = 'video' AND is_active = true
-            ORDER BY id DESC LIMIT 1
-        """), {"id_auto": auto["id_auto"]}).fetchone()
-
-        # dettagli tecnici
-        dettagli = db.execute(text("""
-            SELECT 
-                alimentazione, cambio, trazione, hp, kw, cilindrata,
-                descrizione_motore, euro, consumo_medio, emissioni_co2,
-                segmento, categoria, tipo, porte, posti, bagagliaio,
-                lunghezza, larghezza, altezza,
-                velocita, accelerazione,
-                consumo_urbano, consumo_extraurbano,
-                emissioni_urbe, emissioni_extraurb,
-                neo_patentati
-            FROM mnet_dettagli_usato
-            WHERE codice_motornet_uni = :codice
-        """), {"codice": auto["codice_motornet"]}).fetchone()
-
-        # Dealer effettivo
-        auto_dealer_id = row.dealer_id if getattr(row, "dealer_id", None) is not None else None
-        info = dealer_settings.get(auto_dealer_id, admin_defaults)
-
-        # Cover da vetrina (priority=1)
-        cover = db.execute(text("""
-            SELECT
-              CASE v.media_type
-                WHEN 'foto' THEN (SELECT foto FROM public.azlease_usatoimg WHERE id = v.media_id)
-                WHEN 'ai'   THEN (SELECT public_url FROM public.usato_leonardo WHERE id = v.media_id)
-              END AS url
-            FROM public.usato_vetrina v
-            WHERE v.id_auto = :id_auto
-            ORDER BY v.priority ASC NULLS LAST, v.created_at ASC
-            LIMIT 1
-        """), {"id_auto": auto["id_auto"]}).fetchone()
-        cover_url = cover.url if cover else (img_ai.public_url if img_ai else (immagini[0].foto_url if immagini else None))
-
-        # Conteggio totale media vetrina
-        total_media = db.execute(text("""
-            SELECT COUNT(*) FROM public.usato_vetrina WHERE id_auto = :id_auto
-        """), {"id_auto": auto["id_auto"]}).scalar()
-
-        risultato.append({
-            "auto": auto,
-            "immagini": [dict(img._mapping) for img in immagini],
-            "dettagli": dict(dettagli._mapping) if dettagli else {},
-            "dealer_id": auto_dealer_id or admin_id,
-            "dealer_logo": info["logo"],
-            "dealer_nome": info["nome"],
-            "dealer_indirizzo": info["indirizzo"],
-            "immagine_ai": img_ai.public_url if img_ai else None,
-            "video_ai": vid_ai.public_url if vid_ai else None,
-            "cover_url": cover_url,
-            "total_media": total_media or 0,
-        })
+    # Una riga in più per sapere se esiste la pagina successiva
+    page_size = limit or 50
+    risultato = lista_usato_pubblico_batch(db, settings, cursor=cursor, limit=page_size + 1, **filtri)
+    next_cursor = None
+    if len(risultato) > page_size:
+        risultato = risultato[:page_size]
+        ultima = risultato[-1]["auto"]
+        next_cursor = codifica_cursore(ultima["data_inserimento"], ultima["id_auto"])
 
-    return risultato
+    return {"results": risultato, "next_cursor": next_cursor}
 
 
 
 
 @router.get("/usato-pubblico/{slug}/{id_auto}", tags=["Public AZLease"])
-async def dettaglio_usato_pubblico(
+def dettaglio_usato_pubblico(
     slug: str,
     id_auto: str,
+    tenant: TenantContext = Depends(get_tenant),
     db: Session = Depends(get_db)
 ):
-    # ✅ Recupera impostazioni sito (dallo slug)
-    settings = db.query(SiteAdminSettings).filter(SiteAdminSettings.slug == slug).first()
-    if not settings:
-        raise HTTPException(404, f"Slug '{slug}' non trovato")
-
-    # ✅ Recupera utente (dealer o admin)
-    user_id = settings.dealer_id or settings.admin_id
-    user = db.query(User).filter(User.id == user_id).first()
+    # ✅ Impostazioni sito e utente (dealer o admin) dalla cache tenant
+    settings = tenant.settings
+    user = tenant.user
     if not user:
         raise HTTPException(404, "Utente non trovato per questo slug")
 
@@ -2259,14 +2182,16 @@ async def dettaglio_usato_pubblico(
     }
     # ✅ Recupera media AI attivi (immagine + video)
     media_ai = db.execute(text("""
-        SELECT media_type, public_url
+        SELECT media_type, public_url, storage_path
         FROM usato_leonardo
         WHERE id_auto = :id_auto AND is_active = TRUE
     """), {"id_auto": id_auto}).fetchall()
 
-    # Estrai URL
-    immagine_ai = next((m.public_url for m in media_ai if m.media_type == "image"), None)
-    video_ai = next((m.public_url for m in media_ai if m.media_type == "video"), None)
+    # Estrai URL (firmate dal servizio, la colonna salvata come ripiego).
+    # Rotta sync: un'eventuale firma + commit gira nel threadpool, non sull'event loop
+    firmate = url_firmate(db, [m.storage_path for m in media_ai])
+    immagine_ai = next((firmate.get(m.storage_path) or m.public_url for m in media_ai if m.media_type == "image"), None)
+    video_ai = next((firmate.get(m.storage_path) or m.public_url for m in media_ai if m.media_type == "video"), None)
 
 
     # ✅ Response finale completa
@@ -2287,15 +2212,11 @@ async def dettaglio_usato_pubblico(
 async def foto_usato_pubblico(
     slug: str,
     id_auto: str,
+    tenant: TenantContext = Depends(get_tenant),
     db: Session = Depends(get_db)
 ):
-    # Recupera lo slug del dealer o admin
-    settings = db.query(SiteAdminSettings).filter(SiteAdminSettings.slug == slug).first()
-    if not settings:
-        raise HTTPException(404, f"Slug '{slug}' non trovato.")
-
-    user_id = settings.dealer_id or settings.admin_id
-    user = db.query(User).filter(User.id == user_id).first()
+    # Dealer o admin dello slug (cache tenant)
+    user = tenant.user
     if not user:
         raise HTTPException(404, "Utente non trovato per questo slug.")
 
@@ -2329,7 +2250,7 @@ async def foto_usato_pubblico(
     }
 
 from app.routes.notifiche import inserisci_notifica
-from app.utils.email import get_smtp_settings,  send_email
+from app.utils.email import get_smtp_settings, send_email_async
 from app.models import ClienteTemp
 from uuid import uuid4
 
@@ -2422,7 +2343,7 @@ async def invia_contatto_usato(
     """
     try:
         # firma già prevista: admin_id → seleziona SMTP corretto
-        send_email(admin_id=admin_id, to_email=destinatario.email, subject=subject, body=html_body)
+        await send_email_async(admin_id=admin_id, to_email=destinatario.email, subject=subject, body=html_body)
     except Exception:
         raise HTTPException(500, "Errore invio email")
 
@@ -2446,7 +2367,7 @@ from fastapi import Response
 from pydantic import BaseModel, Field
 from typing import List, Optional
 import requests
-from app.routes.motornet import get_motornet_token
+from app.utils.motornet_token import get_motornet_token
 from app.auth_helpers import is_admin_user, is_dealer_user
 from fastapi_jwt_auth import AuthJWT
 from datetime import datetime
@@ -1,10 +1,18 @@
-﻿from fastapi import APIRouter, Depends, HTTPException, Query, Response
+﻿from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
 from app.database import get_db
 from app.models import AzImage, MnetModelli, MnetMarche, User
 from app.routes.nlt import get_current_user
+import httpx
 import requests
 from typing import Optional
+import time
+from app.utils.executors import run_db
+from app.utils.image_cache import (
+    IMAGE_MAX_BYTES, ImmagineCache, image_cache, chiave_immagine,
+    calcola_etag, etag_corrisponde, get_http_client,
+)
 
 
 router = APIRouter(
@@ -13,20 +21,11 @@ router = APIRouter(
 )
 
 IMAGIN_CDN_BASE_URL = "https://cdn.imagin.studio/getImage"
+IMAGE_CACHE_CONTROL = "private, max-age=86400"
 
 
-@router.get("/{codice_modello}")
-async def get_vehicle_image(
-    codice_modello: str,
-    angle: int = Query(29),
-    random_paint: str = Query("true"),
-    width: int = Query(400, ge=150, le=2600),
-    return_url: bool = Query(False),  # 🔹 nuovo parametro per switch blob/url
-    surrounding: Optional[str] = Query(None),  # 👈 aggiunto chiaramente qui
-    viewPoint: Optional[str] = Query(None),    # 👈 aggiunto chiaramente qui
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
-):
+def _risolvi_marca_modello(db: Session, codice_modello: str):
+    """Marca/modello/variante per Imagin (alias AzImage o anagrafica Motornet)."""
     alias = db.query(AzImage).filter(AzImage.codice_modello == codice_modello).first()
 
     if alias:
@@ -52,6 +51,37 @@ async def get_vehicle_image(
         modello = modello_data.descrizione.lower().replace(" ", "-")
         model_variant = None
 
+    return marca, modello, model_variant
+
+
+@router.get("/{codice_modello}")
+async def get_vehicle_image(
+    request: Request,
+    codice_modello: str,
+    angle: int = Query(29),
+    random_paint: str = Query("true"),
+    width: int = Query(400, ge=150, le=2600),
+    return_url: bool = Query(False),  # 🔹 nuovo parametro per switch blob/url
+    surrounding: Optional[str] = Query(None),  # 👈 aggiunto chiaramente qui
+    viewPoint: Optional[str] = Query(None),    # 👈 aggiunto chiaramente qui
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    chiave = chiave_immagine(codice_modello, angle, width, random_paint, surrounding, viewPoint)
+    if_none_match = request.headers.get("if-none-match")
+
+    # ⚡ Cache (memoria → disco): niente DB né CDN, 304 se il client ha già l'immagine
+    if not return_url:
+        cached = await image_cache.get(chiave)
+        if cached:
+            headers = {"ETag": cached.etag, "Cache-Control": IMAGE_CACHE_CONTROL, "X-Cache": "HIT"}
+            if etag_corrisponde(if_none_match, cached.etag):
+                return Response(status_code=304, headers=headers)
+            return Response(content=cached.content, media_type=cached.content_type, headers=headers)
+
+    # query sincrone nel pool DB: non bloccano l'event loop
+    marca, modello, model_variant = await run_db(_risolvi_marca_modello, db, codice_modello)
+
     params = {
         "make": marca,
         "modelFamily": modello,
@@ -78,13 +108,46 @@ async def get_vehicle_image(
     if return_url:
         return {"url": cdn_url}
 
-    # 🔄 Altrimenti, ritorna l’immagine (blob)
-    response = requests.get(cdn_url)
+    # 🔄 Altrimenti, ritorna l’immagine (blob) in streaming dal CDN, salvandola in cache
+    client = get_http_client()
+    try:
+        upstream = await client.send(client.build_request("GET", cdn_url), stream=True)
+    except httpx.HTTPError:
+        raise HTTPException(status_code=502, detail="Errore CDN Imagin.")
 
-    if response.status_code != 200:
+    if upstream.status_code != 200:
+        await upstream.aclose()
         raise HTTPException(status_code=502, detail="Errore CDN Imagin.")
 
-    return Response(content=response.content, media_type=response.headers['Content-Type'])
+    content_type = upstream.headers.get("Content-Type", "image/png")
+    versione = (upstream.headers.get("ETag") or upstream.headers.get("Last-Modified")
+                or upstream.headers.get("Content-Length") or str(int(time.time())))
+    etag = calcola_etag(chiave, versione)
+    headers = {"ETag": etag, "Cache-Control": IMAGE_CACHE_CONTROL, "X-Cache": "MISS"}
+
+    if etag_corrisponde(if_none_match, etag):
+        await upstream.aclose()
+        return Response(status_code=304, headers=headers)
+    # aiter_bytes restituisce il corpo decodificato: la lunghezza del CDN vale solo senza Content-Encoding
+    if upstream.headers.get("Content-Length") and upstream.headers.get("Content-Encoding", "identity") == "identity":
+        headers["Content-Length"] = upstream.headers["Content-Length"]
+
+    async def _stream():
+        buffer, troppo_grande = bytearray(), False
+        try:
+            async for chunk in upstream.aiter_bytes():
+                if not troppo_grande:
+                    buffer.extend(chunk)
+                    if len(buffer) > IMAGE_MAX_BYTES:
+                        troppo_grande, buffer = True, bytearray()
+                yield chunk
+        finally:
+            await upstream.aclose()
+        # qui solo se il download è arrivato in fondo (client non disconnesso)
+        if buffer and not troppo_grande:
+            await image_cache.put(chiave, ImmagineCache(bytes(buffer), content_type, etag, time.time()))
+
+    return StreamingResponse(_stream(), media_type=content_type, headers=headers)
 
 @router.get("/public/{codice_modello}")
 async def get_vehicle_image_public(
@@ -20,56 +20,21 @@ router_nuovo = APIRouter(prefix="/nuovo/motornet")
 
 
 # Configurazioni API Motornet
-MOTORN_AUTH_URL = "https://webservice.motornet.it/auth/realms/webservices/protocol/openid-connect/token"
 MOTORN_MARCHE_URL = "https://webservice.motornet.it/api/v3_0/rest/public/usato/auto/marche"
 # NUOVO - Endpoint Motornet per veicoli NUOVI
 MOTORN_NUOVO_MARCHE_URL = "https://webservice.motornet.it/api/v3_0/rest/public/nuovo/auto/marche"
 MOTORN_NUOVO_MODELLI_URL = "https://webservice.motornet.it/api/v3_0/rest/public/nuovo/auto/marca/modelli"
 MOTORN_NUOVO_ALLESTIMENTI_URL = "https://webservice.motornet.it/api/v3_0/rest/public/nuovo/auto/modello/versioni"
 
-# Credenziali API Motornet
-MOTORN_CLIENT_ID = "azure447"
-MOTORN_CLIENT_SECRET = "azwsn557"
+# Token Motornet condiviso (rinnovo anticipato + metriche)
+from app.utils.motornet_token import motornet_tokens
 
-import time
 
-cached_token = None
-token_expiry = 0
-
-def get_motornet_token():
-    """Ottiene e memorizza il token di accesso da Motornet per evitare richieste ripetute"""
-    global cached_token, token_expiry
-
-    # Se abbiamo un token valido, lo riutilizziamo
-    if cached_token and time.time() < token_expiry:
-        print("🔍 DEBUG: Riutilizzo token esistente")
-        return cached_token
-
-    headers = {
-        "Content-Type": "application/x-www-form-urlencoded"
-    }
-
-    payload = {
-        "grant_type": "password",
-        "client_id": "webservice",
-        "username": MOTORN_CLIENT_ID,
-        "password": MOTORN_CLIENT_SECRET
-    }
-
-    response = requests.post(MOTORN_AUTH_URL, headers=headers, data=payload)
-
-    print(f"🔍 DEBUG: Status Code Token Motornet = {response.status_code}")
-
-    if response.status_code == 200:
-        token_data = response.json()
-        cached_token = token_data.get("access_token")
-        token_expiry = time.time() + token_data.get("expires_in", 300) - 10  # Riduciamo 10 sec per sicurezza
-
-        print(f"🔍 DEBUG: Nuovo token salvato: {cached_token}")
-        return cached_token
-    
-    print(f"❌ DEBUG: Errore nel recupero del token: {response.text}")
-    raise HTTPException(status_code=response.status_code, detail="Errore nel recupero del token")
+@router_generic.get("/motornet/token-metrics", tags=["Motornet"])
+async def get_motornet_token_metrics(Authorize: AuthJWT = Depends()):
+    """Metriche del token Motornet condiviso: rinnovi, errori e tasso di 401."""
+    Authorize.jwt_required()
+    return motornet_tokens.metrics()
 
 
 @router_usato.get("/marche", tags=["Usato"])
@@ -297,7 +262,7 @@ async def get_valutazione_auto(
     if not user:
         raise HTTPException(status_code=401, detail="Utente non trovato")
 
-    token = get_motornet_token()  # 🔹 Otteniamo il token da Motornet prima della richiesta
+    token = await motornet_tokens.aget_token()  # 🔹 Otteniamo il token da Motornet prima della richiesta
 
     headers = {
         "Authorization": f"Bearer {token}"
@@ -318,6 +283,7 @@ async def get_valutazione_auto(
     )
 
     response = requests.get(motornet_url, headers=headers)
+    motornet_tokens.registra_risposta(response.status_code, token)
 
     print(f"🔍 DEBUG: Risposta Motornet Valutazione: {response.text}")  # 🔹 Stampa la risposta ricevuta
 
@@ -613,7 +579,7 @@ async def get_accessori_nuovo(
         anno = anno or oggi.year
         mese = mese or oggi.month
 
-    token = get_motornet_token()
+    token = await motornet_tokens.aget_token()
 
     headers = {"Authorization": f"Bearer {token}"}
 
@@ -624,6 +590,7 @@ async def get_accessori_nuovo(
 
     async with httpx.AsyncClient() as client:
         response = await client.get(motornet_url, headers=headers)
+    motornet_tokens.registra_risposta(response.status_code, token)
 
     if response.status_code == 200:
         return response.json()
@@ -641,11 +608,12 @@ async def get_messa_su_strada(codice_univoco: str, Authorize: AuthJWT = Depends(
     if not user:
         raise HTTPException(status_code=401, detail="Utente non trovato")
 
-    token = get_motornet_token()
+    token = await motornet_tokens.aget_token()
     headers = { "Authorization": f"Bearer {token}" }
 
     url = f"https://webservice.motornet.it/api/v3_0/rest/public/nuovo/auto/messa-strada?codice_motornet_uni={codice_univoco}"
     response = requests.get(url, headers=headers)
+    motornet_tokens.registra_risposta(response.status_code, token)
 
     if response.status_code == 200:
         return response.json()
@@ -687,7 +655,7 @@ async def get_accessori_auto_usato(
     if not user:
         raise HTTPException(status_code=401, detail="Utente non trovato")
 
-    token = get_motornet_token()
+    token = await motornet_tokens.aget_token()
 
     headers = {
         "Authorization": f"Bearer {token}"
@@ -700,6 +668,7 @@ async def get_accessori_auto_usato(
     )
 
     response = requests.get(motornet_url, headers=headers)
+    motornet_tokens.registra_risposta(response.status_code, token)
 
     print(f"🔍 DEBUG Motornet Accessori {codice_motornet}: {response.status_code}")
     print(f"🔍 Response: {response.text}")
@@ -1,9 +1,9 @@
-﻿from fastapi import APIRouter, Depends, Body, UploadFile, File, Form, HTTPException, Security, Query, Request
+﻿from fastapi import APIRouter, Depends, Body, UploadFile, File, Form, HTTPException, Security, Query
 
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from sqlalchemy.orm import Session, joinedload
 from app.database import get_db
-from app.models import NltPneumatici, NltPipeline,NltPipelineLog, NltAutoSostitutiva, NltService, NltDocumentiRichiesti, NltPreventivi, Cliente, User, NltPreventivi, NltPreventiviLinks, NltPreventiviTimeline, NltClientiPubblici
+from app.models import NltPipeline,NltPipelineLog, NltService, NltDocumentiRichiesti, NltPreventivi, Cliente, User, NltPreventivi, NltPreventiviLinks, NltPreventiviTimeline, NltClientiPubblici
 from pydantic import BaseModel, BaseSettings
 from jose import jwt, JWTError  # ✅ Aggiunto import corretto per decodificare il token JWT
 from fastapi_jwt_auth import AuthJWT
@@ -12,14 +12,15 @@ from typing import List, Optional
 from datetime import datetime, timedelta  # aggiunto timedelta
 from app.utils.email import send_email
 from app.utils.calcola_scadenza_azione import calcola_scadenza_azione_intelligente
+from app.utils.servizi_extra import diametro_cerchio, listini_servizi_extra
+from app.utils.principal_cache import get_principal, get_principal_optional
 
 import uuid
 from uuid import UUID
-from app.utils.email import get_smtp_settings  # se vuoi usare direttamente la funzione già definita in email.py
+from app.utils.email import get_smtp_settings, invia_messaggio_async  # se vuoi usare direttamente la funzione già definita in email.py
 import smtplib
 from email.mime.text import MIMEText
 from email.utils import formataddr
-from app.routes.motornet import get_motornet_token  # Assicurati che questa funzione sia definita correttamente
 from app.auth_helpers import (
     get_admin_id,
     get_dealer_id,
@@ -44,13 +45,8 @@ router = APIRouter(
 )
 
 def get_current_user(Authorize: AuthJWT = Depends(), db: Session = Depends(get_db)):
-    Authorize.jwt_required()
-    user_email = Authorize.get_jwt_subject()
-
-    user = db.query(User).filter(User.email == user_email).first()
-    if not user:
-        raise HTTPException(status_code=401, detail="Utente non trovato")
-    return user
+    # ⚡ Principal in cache (app/utils/principal_cache.py): niente query utenti a ogni richiesta
+    return get_principal(Authorize, db)
 
 
 
@@ -512,15 +508,8 @@ async def get_preventivo_completo(preventivo_id: str, dealerId: Optional[int] =
 
 
 def get_current_user_optional(Authorize: AuthJWT = Depends(), db: Session = Depends(get_db)):
-    try:
-        Authorize.jwt_required()
-        user_email = Authorize.get_jwt_subject()
-        user = db.query(User).filter(User.email == user_email).first()
-        if not user:
-            return None
-        return user
-    except:
-        return None  # Utente non autenticato (chiamata interna server)
+    # None se utente non autenticato (chiamata interna server)
+    return get_principal_optional(Authorize, db)
 
 @router.post("/preventivi/{preventivo_id}/genera-link")
 async def genera_link_preventivo(
@@ -642,15 +631,7 @@ async def invia_mail_preventivo(
     # 4) Invio email al cliente + notifica dealer/admin + timeline/log
     try:
         # 4.1 Invio al cliente
-        if smtp_settings.use_ssl:
-            server = smtplib.SMTP_SSL(smtp_settings.smtp_host, smtp_settings.smtp_port)
-        else:
-            server = smtplib.SMTP(smtp_settings.smtp_host, smtp_settings.smtp_port)
-            server.starttls()
-
-        server.login(smtp_settings.smtp_user, smtp_settings.smtp_password)
-        server.send_message(msg)
-        server.quit()
+        await invia_messaggio_async(smtp_settings, msg)
         print("✅ Email inviata correttamente a", email_destinatario)
 
         # 4.2 Invio notifica dedicata al dealer/admin (NO BCC)
@@ -681,15 +662,7 @@ async def invia_mail_preventivo(
                 msg_notify["To"] = dealer_user.email
 
                 try:
-                    if dealer_smtp.use_ssl:
-                        server_notify = smtplib.SMTP_SSL(dealer_smtp.smtp_host, dealer_smtp.smtp_port)
-                    else:
-                        server_notify = smtplib.SMTP(dealer_smtp.smtp_host, dealer_smtp.smtp_port)
-                        server_notify.starttls()
-
-                    server_notify.login(dealer_smtp.smtp_user, dealer_smtp.smtp_password)
-                    server_notify.send_message(msg_notify)
-                    server_notify.quit()
+                    await invia_messaggio_async(dealer_smtp, msg_notify)
                     print(f"📧 Notifica dealer inviata a {dealer_user.email}")
                 except Exception as e:
                     print(f"❌ Errore invio notifica dealer: {e}")
@@ -767,59 +740,30 @@ def recupera_preventivo_da_token_cliente(token: str, db: Session = Depends(get_d
     return {"preventivo_id": str(preventivo.id)}
 
 @router.get("/pneumatici/{codice_motornet}", tags=["Servizi Extra"])
-async def get_costo_pneumatici_da_motornet(
+def get_costo_pneumatici_da_motornet(
     codice_motornet: str,
-    request: Request,
+    Authorize: AuthJWT = Depends(),
     db: Session = Depends(get_db)
 ):
-    import re
-    import httpx
-
-
-    # ⏬ Prendi il token già presente (utente loggato)
-    jwt_token = request.headers.get("Authorization")
-    if not jwt_token:
-        raise HTTPException(status_code=401, detail="Token mancante")
-
-    headers = {"Authorization": jwt_token}
-
-    url = f"https://coreapi-production-ca29.up.railway.app/api/nuovo/motornet/dettagli/{codice_motornet}"
-
-    async with httpx.AsyncClient() as client:
-        res = await client.get(url, headers=headers)
-
-    if res.status_code != 200:
-        raise HTTPException(status_code=res.status_code, detail="Errore nel recupero dati motornet")
-
-    data = res.json()
-    modello = data.get("modello", {})
-
-    anteriori = modello.get("pneumatici_anteriori", "")
-    posteriori = modello.get("pneumatici_posteriori", "")
-
-    diametri = []
-    for misura in [anteriori, posteriori]:
-        match = re.search(r"R(\d{2})", misura)
-        if match:
-            diametri.append(int(match.group(1)))
+    Authorize.jwt_required()
 
-    if not diametri:
+    # ⚡ Diametro precalcolato al sync dettagli, listino in memoria: niente chiamate HTTP
+    diametro_maggiore = diametro_cerchio(db, codice_motornet)
+    if not diametro_maggiore:
         raise HTTPException(status_code=422, detail="Diametro non trovato nei dati ricevuti")
 
-    diametro_maggiore = max(diametri)
-
-    record = db.query(NltPneumatici).filter(NltPneumatici.diametro == diametro_maggiore).first()
-    if not record:
+    costo_treno = listini_servizi_extra.costo_treno(db, diametro_maggiore)
+    if costo_treno is None:
         raise HTTPException(status_code=404, detail=f"Nessun costo trovato per cerchi R{diametro_maggiore}")
 
     return {
-        "costo_treno": float(record.costo_treno)
+        "costo_treno": costo_treno
     }
 
 
 @router.get("/autosostitutiva/{segmento}")
 def get_costo_autosostitutiva(segmento: str, db: Session = Depends(get_db)):
-    record = db.query(NltAutoSostitutiva).filter(NltAutoSostitutiva.segmento == segmento.upper()).first()
-    if not record:
+    costo_mensile = listini_servizi_extra.costo_sostitutiva(db, segmento)
+    if costo_mensile is None:
         raise HTTPException(status_code=404, detail="Segmento non trovato")
-    return {"segmento": record.segmento, "costo_mensile": float(record.costo_mensile)}
+    return {"segmento": segmento.upper(), "costo_mensile": costo_mensile}
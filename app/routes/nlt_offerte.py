@@ -1,14 +1,14 @@
-﻿from fastapi import APIRouter, Depends, HTTPException, Request, Query, Body
+﻿from fastapi import APIRouter, Depends, HTTPException, Request, Query, Body, Header, Response
 from sqlalchemy.orm import Session, selectinload
 from sqlalchemy import func
 
 from typing import Optional, List
 from app.database import get_db
-from app.models import Services, PurchasedServices, NltOfferteRating, MnetDettagli,NltPneumatici, NltAutoSostitutiva, NltQuotazioni, NltPlayers, NltImmagini,MnetModelli, NltOfferteTag, NltOffertaTag, User, NltOffertaAccessori,SiteAdminSettings, NltOfferte, SmtpSettings, ImmaginiNlt, NltOfferteClick
+from app.models import Services, PurchasedServices, NltOfferteRating, MnetDettagli, NltQuotazioni, NltPlayers, NltImmagini,MnetModelli, NltOfferteTag, NltOffertaTag, User, NltOffertaAccessori,SiteAdminSettings, NltOfferte, SmtpSettings, ImmaginiNlt, NltOfferteClickGiorno
 from app.auth_helpers import is_admin_user, is_dealer_user, get_admin_id, get_dealer_id
 from app.routes.nlt import get_current_user  
 from datetime import date, datetime
-from .motornet import get_motornet_token
+from app.utils.motornet_token import get_motornet_token
 from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_exception_type
 from app.routes.openai_config import genera_descrizione_gpt
 from supabase import create_client
@@ -19,11 +19,19 @@ import os
 import logging
 import unidecode
 import re
+import json
 import requests
 import httpx
 from app.routes.image import get_vehicle_image
 from sqlalchemy import or_
-from app.utils.quotazioni import calcola_quotazione, calcola_quotazione_custom
+from app.utils.quotazioni import calcola_quotazione, calcola_quotazione_custom, calcola_quotazioni, calcola_quotazioni_custom, canone_configuratore, colonne_popolate
+from app.utils.tenant_cache import TenantContext, get_tenant, get_tenant_dealer, risolvi_tenant
+from app.utils.catalogo_nlt import query_catalogo
+from app.utils.ricerca import applica_soglia
+from app.utils.servizi_extra import diametro_da_misure, ricorda_diametro, listini_servizi_extra
+from app.utils.image_cache import calcola_etag, etag_corrisponde
+from app.utils.click_buffer import click_buffer
+from app.utils.storage import storage, StorageError
 from app.schemas import CanoneRequest
 from urllib.parse import urlencode
 
@@ -33,7 +41,7 @@ from fastapi.templating import Jinja2Templates
 
 from sqlalchemy.orm import joinedload
 from sqlalchemy import not_
-from sqlalchemy import select, desc
+from sqlalchemy import select, desc, text
 from datetime import datetime, timedelta
 
 
@@ -216,24 +224,14 @@ BUCKET_NAME = "nlt-images"
 supabase_client = create_client(SUPABASE_URL, SUPABASE_KEY)
 
 
-def upload_to_supabase(file_bytes, filename, content_type="image/webp"):
-    from supabase import create_client
-    import os
-
-    SUPABASE_URL = os.getenv("SUPABASE_URL")
-    SUPABASE_KEY = os.getenv("SUPABASE_KEY")
-    client = create_client(SUPABASE_URL, SUPABASE_KEY)
-
+async def upload_to_supabase(file_bytes, filename, content_type="image/webp"):
     try:
-        result = client.storage.from_("nlt-images").upload(
-            filename, file_bytes, {"content-type": content_type}
-        )
-    except Exception as e:  # 👈 cattura l'errore generale chiaramente qui
-        print(f"❌ Errore Supabase: {e}")
+        await storage.upload("nlt-images", filename, file_bytes, content_type, upsert=False)
+    except StorageError as e:  # 👈 cattura l'errore generale chiaramente qui
+        logging.error(f"❌ Errore Supabase: {e}")
         raise HTTPException(status_code=500, detail=f"Errore upload Supabase: {e}")
 
-    public_url = client.storage.from_("nlt-images").get_public_url(filename)
-    return public_url
+    return storage.url_pubblico("nlt-images", filename)
 
 
 
@@ -450,7 +448,7 @@ async def crea_offerta(
         # Upload su Supabase
         unique_filename = f"{nuova_offerta.id_offerta}_{view}.webp"
         try:
-            supabase_url = upload_to_supabase(
+            supabase_url = await upload_to_supabase(
                 file_bytes=img_byte_arr.getvalue(),
                 filename=unique_filename,
                 content_type="image/webp"
@@ -518,18 +516,15 @@ async def offerte_nlt_pubbliche(
     slug: str,
     offset: int = Query(0, ge=0),
     limit: int = Query(50, le=500),
+    tenant: TenantContext = Depends(get_tenant),
     db: Session = Depends(get_db)
 ):
-    settings = db.query(SiteAdminSettings).filter(SiteAdminSettings.slug == slug).first()
-    if not settings:
-        raise HTTPException(status_code=404, detail=f"Slug '{slug}' non trovato.")
-
-    user_id = settings.dealer_id if settings.dealer_id else settings.admin_id
-    user = db.query(User).filter(User.id == user_id).first()
+    settings = tenant.settings
+    user = tenant.user
     if not user:
         raise HTTPException(status_code=404, detail="Utente non trovato per questo slug.")
 
-    admin_id = user.parent_id if user.role == "dealer" and user.parent_id else user.id
+    admin_id = tenant.admin_id
 
     offerte_query = db.query(NltOfferte, NltQuotazioni).join(
         NltQuotazioni, NltOfferte.id_offerta == NltQuotazioni.id_offerta
@@ -548,15 +543,10 @@ async def offerte_nlt_pubbliche(
 
     risultato = []
 
-    for offerta, quotazione in offerte:
-        dealer_context = settings.dealer_id is not None
-        dealer_id_for_context = settings.dealer_id if dealer_context else None
-
-        durata_mesi, km_inclusi, canone, dealer_slug = calcola_quotazione(
-            offerta, quotazione, user, db,
-            dealer_context=dealer_context, dealer_id=dealer_id_for_context
-        )
+    # ✅ Quotazioni dell'intera pagina in un solo lotto
+    quotazioni = calcola_quotazioni(db, offerte, settings_corrente=settings)
 
+    for (offerta, quotazione), (durata_mesi, km_inclusi, canone, dealer_slug) in zip(offerte, quotazioni):
         if canone is None:
             continue
 
@@ -623,14 +613,11 @@ async def offerte_nlt_pubbliche(
 @router.get("/offerte-nlt-pubbliche/tantastrada/{slug}")
 async def offerte_nlt_tantastrada(
     slug: str,
+    tenant: TenantContext = Depends(get_tenant),
     db: Session = Depends(get_db)
 ):
-    settings = db.query(SiteAdminSettings).filter(SiteAdminSettings.slug == slug).first()
-    if not settings:
-        raise HTTPException(status_code=404, detail=f"Slug '{slug}' non trovato.")
-
-    user_id = settings.dealer_id if settings.dealer_id else settings.admin_id
-    user = db.query(User).filter(User.id == user_id).first()
+    settings = tenant.settings
+    user = tenant.user
     if not user:
         raise HTTPException(status_code=404, detail="Utente non trovato per questo slug.")
 
@@ -663,22 +650,14 @@ async def offerte_nlt_tantastrada(
 
     risultato = []
 
-    for offerta, quotazione, dettagli in offerte:
-        canone_base = quotazione.mesi_60_40
-        if not canone_base:
-            continue
-
-        dealer_context = settings.dealer_id is not None
-        dealer_id_for_context = settings.dealer_id if dealer_context else None
-
-        durata_mesi = 60
-        km_inclusi = 40000
-
-        durata, km, canone, dealer_slug = calcola_quotazione_custom(
-            offerta, durata_mesi, km_inclusi, canone_base, user, db,
-            dealer_context=dealer_context, dealer_id=dealer_id_for_context
-        )
+    # ✅ Quotazioni 60/40 in un solo lotto
+    quotazioni = calcola_quotazioni_custom(
+        db,
+        [(offerta, 60, 40000, quotazione.mesi_60_40) for offerta, quotazione, _ in offerte],
+        settings_corrente=settings
+    )
 
+    for (offerta, quotazione, dettagli), (durata, km, canone, dealer_slug) in zip(offerte, quotazioni):
         if canone is None:
             continue
 
@@ -732,143 +711,31 @@ async def offerte_filtrate_nlt_pubbliche(
     count_only: bool = Query(False),
     rating_min: Optional[int] = Query(None, ge=1, le=5),
     order_by: Optional[str] = Query(None, regex="^(rating_desc|prezzo_asc|marca_asc)$"),
+    tenant: TenantContext = Depends(get_tenant),
     db: Session = Depends(get_db)
     
 ):
-    settings = db.query(SiteAdminSettings).filter(SiteAdminSettings.slug == slug).first()
-    if not settings:
-        raise HTTPException(status_code=404, detail=f"Slug '{slug}' non trovato.")
-
-    user_id = settings.dealer_id if settings.dealer_id else settings.admin_id
-    user = db.query(User).filter(User.id == user_id).first()
+    settings = tenant.settings
+    user = tenant.user
     if not user:
         raise HTTPException(status_code=404, detail="Utente non trovato per questo slug.")
 
-    admin_id = user.parent_id if user.role == "dealer" and user.parent_id else user.id
-
-    # Join rating + alias rating_convenienza per accesso diretto
-    offerte_query = db.query(
-        NltOfferte,
-        NltQuotazioni,
-        NltOfferteRating.rating_convenienza.label("rating_convenienza")
-    ).join(
-        NltQuotazioni, NltOfferte.id_offerta == NltQuotazioni.id_offerta
-    ).outerjoin(
-        NltOfferteRating, NltOfferte.id_offerta == NltOfferteRating.id_offerta
-    ).filter(
-        NltOfferte.id_admin == admin_id,
-        NltOfferte.attivo.is_(True),
-        NltOfferte.prezzo_listino.isnot(None),
-        or_(
-            NltQuotazioni.mesi_36_10.isnot(None),
-            NltQuotazioni.mesi_48_10.isnot(None),
-            NltQuotazioni.mesi_48_30.isnot(None)
-        )
-    )
-
-    # Filtro rating se richiesto
-    if rating_min is not None:
-        offerte_query = offerte_query.filter(NltOfferteRating.rating_convenienza >= rating_min)
-
-    if search:
-        terms = search.lower().strip().split()
-        search_filters = []
-        for term in terms:
-            search_filters.append(func.lower(NltOfferte.marca).like(f"%{term}%"))
-            search_filters.append(func.lower(NltOfferte.modello).like(f"%{term}%"))
-            search_filters.append(func.lower(NltOfferte.versione).like(f"%{term}%"))
-    
-        offerte_query = offerte_query.filter(or_(*search_filters))
-
-
-    if marca:
-        offerte_query = offerte_query.filter(
-            func.lower(NltOfferte.marca) == marca.lower().strip()
-        )
-
-    if budget_max:
-        offerte_query = offerte_query.filter(
-            NltOfferte.prezzo_listino <= budget_max * 60
-        )
-
-    if tipo:
-        tipo_clean = tipo.lower().strip()
-        if tipo_clean == "privato":
-            offerte_query = offerte_query.filter(NltOfferte.solo_privati.is_(True))
-        elif tipo_clean == "business":
-            offerte_query = offerte_query.filter(NltOfferte.solo_privati.is_(False))
-
-  # Serve join se uno dei filtri usa mnet_dettagli
-    if segmento or carrozzeria or tanti_km:
-        offerte_query = offerte_query.join(
-            MnetDettagli, MnetDettagli.codice_motornet_uni == NltOfferte.codice_motornet
-        )
-    if segmento:
-        offerte_query = offerte_query.filter(
-            func.upper(MnetDettagli.segmento) == segmento.upper().strip()
-        )
-
-    if carrozzeria:
-        offerte_query = offerte_query.filter(
-            func.lower(MnetDettagli.tipo_descrizione) == carrozzeria.lower().strip()
-        )
-
-    if tanti_km:
-        offerte_query = offerte_query.filter(
-            NltOfferte.id_player == 5,
-            NltQuotazioni.mesi_60_40.isnot(None),
-            not_(MnetDettagli.segmento_descrizione.in_([
-                "Superutilitarie",
-                "Utilitarie",
-                "SUV piccoli",
-                "Medio-inferiori"
-            ]))
-        )
-
-    if prezzo_min is not None and prezzo_max is not None:
-        offerte_query = offerte_query.filter(
-            NltOfferte.prezzo_listino.between(prezzo_min, prezzo_max)
-        )
-    elif prezzo_min is not None:
-        offerte_query = offerte_query.filter(
-            NltOfferte.prezzo_listino >= prezzo_min
-        )
-    elif prezzo_max is not None:
-        offerte_query = offerte_query.filter(
-            NltOfferte.prezzo_listino <= prezzo_max
-        )
-
-    if alimentazione:
-        offerte_query = offerte_query.filter(
-            func.lower(NltOfferte.alimentazione) == alimentazione.lower().strip()
-        )
+    admin_id = tenant.admin_id
 
-    if cambio:
-        cambio_clean = cambio.lower().strip()
-        if cambio_clean == "manuale":
-            offerte_query = offerte_query.filter(
-                func.lower(NltOfferte.cambio).like("%manuale%")
-            )
-        elif cambio_clean == "automatico":
-            offerte_query = offerte_query.filter(
-                or_(
-                    func.lower(NltOfferte.cambio).like("%automatico%"),
-                    func.lower(NltOfferte.cambio).like("%cvt%")
-                )
-            )
-    
+    id_offerte_top = None
     if top:
+        # contatori giornalieri: ultimi 30 giorni interi
         subquery_clicks = (
             db.query(
-                NltOfferteClick.id_offerta,
-                func.count(NltOfferteClick.id).label("clicks")
+                NltOfferteClickGiorno.id_offerta,
+                func.sum(NltOfferteClickGiorno.click).label("clicks")
             )
-            .join(NltOfferte, NltOfferte.id_offerta == NltOfferteClick.id_offerta)
+            .join(NltOfferte, NltOfferte.id_offerta == NltOfferteClickGiorno.id_offerta)
             .filter(
                 NltOfferte.id_admin == admin_id,
-                NltOfferteClick.clicked_at >= datetime.utcnow() - timedelta(days=30)
+                NltOfferteClickGiorno.giorno >= (datetime.utcnow() - timedelta(days=30)).date()
             )
-            .group_by(NltOfferteClick.id_offerta)
+            .group_by(NltOfferteClickGiorno.id_offerta)
             .order_by(desc("clicks"))
             .limit(10)
             .subquery()
@@ -879,96 +746,60 @@ async def offerte_filtrate_nlt_pubbliche(
         if not id_offerte_top:
             return []
 
-        offerte_query = offerte_query.filter(
-            NltOfferte.id_offerta.in_(id_offerte_top)
-        )
-
-    if count_only:
-        total = offerte_query.count()
-        return {"count": total}
+    # ✅ Una sola query sul catalogo del tenant (canone già calcolato, totale via window function)
+    filtri = dict(
+        search=search, marca=marca, budget_max=budget_max, tipo=tipo, segmento=segmento,
+        carrozzeria=carrozzeria, alimentazione=alimentazione, cambio=cambio,
+        prezzo_min=prezzo_min, prezzo_max=prezzo_max, tanti_km=tanti_km,
+        rating_min=rating_min, id_offerte=id_offerte_top,
+    )
 
-    total = offerte_query.count()
+    if search:
+        applica_soglia(db)
 
-    # ✅ Ordinamento intelligente
-    if order_by == "rating_desc":
-        offerte_query = offerte_query.order_by(NltOfferteRating.rating_convenienza.desc().nullslast())
-    elif order_by == "marca_asc":
-        offerte_query = offerte_query.order_by(NltOfferte.marca.asc(), NltOfferte.modello.asc())
-    else:
-        offerte_query = offerte_query.order_by(NltOfferte.prezzo_listino.asc())
+    if count_only:
+        sql, params = query_catalogo(settings.id, count_only=True, **filtri)
+        return {"count": db.execute(text(sql), params).scalar() or 0}
 
+    sql, params = query_catalogo(settings.id, order_by=order_by, offset=offset, limit=limit, **filtri)
+    righe = db.execute(text(sql), params).fetchall()
 
-    offerte = offerte_query.offset(offset).limit(limit).all()
+    total = righe[0].totale if righe else 0
+    if not righe and offset:
+        # pagina oltre la fine: il totale non arriva dalla window function
+        sql, params = query_catalogo(settings.id, count_only=True, **filtri)
+        total = db.execute(text(sql), params).scalar() or 0
 
     risultato = []
-
-    for offerta, quotazione, rating in offerte:
-        dealer_context = settings.dealer_id is not None
-        dealer_id_for_context = settings.dealer_id if dealer_context else None
-
+    for r in righe:
         if tanti_km:
-            durata_mesi = 60
-            km_inclusi = 40000
-            canone_base = quotazione.mesi_60_40
-
-            if not canone_base:
-                continue
-
-            try:
-                canone = round(float(canone_base), 2)
-            except (TypeError, ValueError):
-                print(f"❌ Canone_base non valido per offerta {offerta.id_offerta}: {canone_base}")
-                continue
-
-            dealer_slug = settings.slug if settings else None
-
+            durata_mesi, km_inclusi = 60, 40000
+            canone = r.canone_60_40
         else:
-            durata_mesi, km_inclusi, canone, dealer_slug = calcola_quotazione(
-                offerta, quotazione, user, db,
-                settings_corrente=settings
-            )
-
-
-        if canone is None:
-            continue
-
-        # continua come già hai
-
-
-        dettagli = db.query(MnetDettagli).filter(
-            MnetDettagli.codice_motornet_uni == offerta.codice_motornet
-        ).first()
-
-        tipo_descrizione = dettagli.tipo_descrizione if dettagli else None
-        segmento_descrizione = dettagli.segmento_descrizione if dettagli else None
-
-        modello_db = db.query(MnetModelli).filter(
-            MnetModelli.codice_modello == offerta.codice_modello
-        ).first()
-
-        immagine_url = modello_db.default_img if modello_db and modello_db.default_img else "/default-placeholder.png"
+            durata_mesi, km_inclusi = r.durata_mesi, r.km_inclusi
+            canone = r.canone_mensile
 
         risultato.append({
-            "id_offerta": offerta.id_offerta,
-            "immagine": immagine_url,
-            "marca": offerta.marca,
-            "modello": offerta.modello,
-            "versione": offerta.versione,
-            "cambio": offerta.cambio,
-            "alimentazione": offerta.alimentazione,
-            "segmento": offerta.segmento,
-            "segmento_descrizione": segmento_descrizione,
-            "tipo_descrizione": tipo_descrizione,
-            "canone_mensile": float(canone),
-            "prezzo_listino": float(offerta.prezzo_listino),
-            "prezzo_totale": float(offerta.prezzo_totale or offerta.prezzo_listino),
-            "slug": offerta.slug,
-            "solo_privati": offerta.solo_privati,
+            "id_offerta": r.id_offerta,
+            "immagine": r.immagine or "/default-placeholder.png",
+            "marca": r.marca,
+            "modello": r.modello,
+            "versione": r.versione,
+            "cambio": r.cambio,
+            "alimentazione": r.alimentazione,
+            "segmento": r.segmento,
+            "segmento_descrizione": r.segmento_descrizione,
+            "tipo_descrizione": r.tipo_descrizione,
+            "canone_mensile": round(float(canone), 2),
+            "prezzo_listino": float(r.prezzo_listino),
+            "prezzo_totale": float(r.prezzo_totale or r.prezzo_listino),
+            "slug": r.slug,
+            "solo_privati": r.solo_privati,
             "durata_mesi": durata_mesi,
             "km_inclusi": km_inclusi,
             "logo_web": settings.logo_web or "",
-            "rating_convenienza": rating if rating is not None else None,
-            "dealer_slug": dealer_slug
+            "rating_convenienza": r.rating_convenienza,
+            "dealer_slug": settings.slug
         })
 
     # ✅ DEMO se il servizio "Vetrina NLT" non è attivo (admin escluso)
@@ -999,14 +830,11 @@ async def offerta_nlt_unificata(
     slug_dealer: str,
     slug_offerta: str,
     modalita: Optional[str] = Query(None),
+    tenant: TenantContext = Depends(get_tenant_dealer),
     db: Session = Depends(get_db)
 ):
-    settings = db.query(SiteAdminSettings).filter(SiteAdminSettings.slug == slug_dealer).first()
-    if not settings:
-        raise HTTPException(status_code=404, detail=f"Dealer '{slug_dealer}' non trovato.")
-
-    user_id = settings.dealer_id or settings.admin_id
-    user = db.query(User).filter(User.id == user_id).first()
+    settings = tenant.settings
+    user = tenant.user
     if not user:
         raise HTTPException(status_code=404, detail="Utente admin non trovato per questo dealer.")
 
@@ -1238,14 +1066,15 @@ def get_dati_nd():
     }
 
 @router.get("/offerte-nlt-pubbliche/{slug_dealer}/{slug_offerta}")
-async def offerta_nlt_pubblica(slug_dealer: str, slug_offerta: str, db: Session = Depends(get_db)):
+async def offerta_nlt_pubblica(
+    slug_dealer: str,
+    slug_offerta: str,
+    tenant: TenantContext = Depends(get_tenant_dealer),
+    db: Session = Depends(get_db)
+):
     # Recupera settings del dealer
-    settings = db.query(SiteAdminSettings).filter(SiteAdminSettings.slug == slug_dealer).first()
-    if not settings:
-        raise HTTPException(status_code=404, detail=f"Dealer '{slug_dealer}' non trovato.")
-
-    user_id = settings.dealer_id if settings.dealer_id else settings.admin_id
-    user = db.query(User).filter(User.id == user_id).first()
+    settings = tenant.settings
+    user = tenant.user
     if not user:
         raise HTTPException(status_code=404, detail="Utente admin non trovato per questo dealer.")
 
@@ -1271,10 +1100,8 @@ async def offerta_nlt_pubblica(slug_dealer: str, slug_offerta: str, db: Session
     quotazione = db.query(NltQuotazioni).filter(NltQuotazioni.id_offerta == offerta.id_offerta).first()
 
     # Calcolo canone
-    dealer_context = settings.dealer_id is not None
-    dealer_id_for_context = settings.dealer_id if dealer_context else None
     durata_mesi, km_inclusi, canone, dealer_slug = calcola_quotazione(
-        offerta, quotazione, user, db, dealer_context=dealer_context, dealer_id=dealer_id_for_context
+        offerta, quotazione, user, db, settings_corrente=settings
     )
 
     return {
@@ -1306,14 +1133,11 @@ async def offerta_nlt_pubblica(slug_dealer: str, slug_offerta: str, db: Session
 async def offerta_nlt_tantastrada(
     slug_dealer: str,
     slug_offerta: str,
+    tenant: TenantContext = Depends(get_tenant_dealer),
     db: Session = Depends(get_db)
 ):
-    settings = db.query(SiteAdminSettings).filter(SiteAdminSettings.slug == slug_dealer).first()
-    if not settings:
-        raise HTTPException(status_code=404, detail=f"Dealer '{slug_dealer}' non trovato.")
-
-    user_id = settings.dealer_id if settings.dealer_id else settings.admin_id
-    user = db.query(User).filter(User.id == user_id).first()
+    settings = tenant.settings
+    user = tenant.user
     if not user:
         raise HTTPException(status_code=404, detail="Utente admin non trovato per questo dealer.")
 
@@ -1338,12 +1162,8 @@ async def offerta_nlt_tantastrada(
     km = 40000
 
     # Calcola canone finale con provvigioni
-    dealer_context = settings.dealer_id is not None
-    dealer_id_for_context = settings.dealer_id if dealer_context else None
-
     _, _, canone_finale, dealer_slug = calcola_quotazione_custom(
-        offerta, durata, km, canone_base, user, db,
-        dealer_context=dealer_context, dealer_id=dealer_id_for_context
+        offerta, durata, km, canone_base, user, db, settings_corrente=settings
     )
 
     # Recupera dettagli motornet
@@ -1419,35 +1239,51 @@ def aggiorna_quotazioni(
 
 
 
-async def recupera_diametro_pneumatici(codice_motornet: str, jwt_token: str) -> int:
-    url = f"https://coreapi-production-ca29.up.railway.app/api/nuovo/motornet/dettagli/{codice_motornet}"
-    headers = {"Authorization": f"Bearer {jwt_token}"}
-
-    async with httpx.AsyncClient() as client:
-        res = await client.get(url, headers=headers)
-
-    if res.status_code != 200:
-        raise HTTPException(status_code=res.status_code, detail="Errore dati motornet")
-
-    data = res.json()
-    modello = data.get("modello", {})
-
-    anteriori = modello.get("pneumatici_anteriori", "")
-    posteriori = modello.get("pneumatici_posteriori", "")
-
-    diametri = []
-    for misura in [anteriori, posteriori]:
-        match = re.search(r"R(\d{2})", misura)
-        if match:
-            diametri.append(int(match.group(1)))
-
-    if not diametri:
-        raise HTTPException(status_code=422, detail="Diametro non trovato")
+from fastapi import Request
 
-    return max(diametri)
+MAX_OFFERTE_MATRICE = 100
+MATRICE_CACHE_CONTROL = "private, max-age=300"
+
+
+def _righe_configuratore(db: Session, id_offerte: list) -> dict:
+    """
+    id_offerta -> (offerta, prima quotazione, diametro cerchio, provvigione admin) con UNA query.
+    Listini pneumatici/auto sostitutiva dalla cache in memoria (app/utils/servizi_extra.py).
+    """
+    prov_admin_sq = (
+        select(SiteAdminSettings.prov_vetrina)
+        .where(SiteAdminSettings.admin_id == NltOfferte.id_admin, SiteAdminSettings.dealer_id.is_(None))
+        .order_by(SiteAdminSettings.id)
+        .limit(1)
+        .correlate(NltOfferte)
+        .scalar_subquery()
+    )
+    rows = (
+        db.query(
+            NltOfferte,
+            NltQuotazioni,
+            MnetDettagli.diametro_cerchio,
+            MnetDettagli.pneumatici_anteriori,
+            MnetDettagli.pneumatici_posteriori,
+            prov_admin_sq,
+        )
+        .outerjoin(NltQuotazioni, NltQuotazioni.id_offerta == NltOfferte.id_offerta)
+        .outerjoin(MnetDettagli, MnetDettagli.codice_motornet_uni == NltOfferte.codice_motornet)
+        .filter(NltOfferte.id_offerta.in_(id_offerte))
+        .order_by(NltOfferte.id_offerta, NltQuotazioni.id_quotazione)
+        .all()
+    )
 
+    righe = {}
+    for offerta, quotazione, diametro, anteriori, posteriori, prov_admin in rows:
+        if offerta.id_offerta in righe:
+            continue
+        diametro = diametro or diametro_da_misure(anteriori, posteriori)
+        if diametro:
+            ricorda_diametro(offerta.codice_motornet, diametro)
+        righe[offerta.id_offerta] = (offerta, quotazione, diametro, prov_admin or 0.0)
+    return righe
 
-from fastapi import Request
 
 @router.post("/nlt/calcola-canone")
 async def calcola_canone(
@@ -1456,11 +1292,11 @@ async def calcola_canone(
     current_user=Depends(get_current_user),
     request: Request = None
 ):
-    offerta = db.query(NltOfferte).filter(NltOfferte.id_offerta == payload.id_offerta).first()
-    if not offerta:
+    riga = _righe_configuratore(db, [payload.id_offerta]).get(payload.id_offerta)
+    if not riga:
         raise HTTPException(status_code=404, detail="Offerta non trovata")
 
-    quotazione = db.query(NltQuotazioni).filter(NltQuotazioni.id_offerta == offerta.id_offerta).first()
+    offerta, quotazione, diametro, prov_admin = riga
     if not quotazione:
         raise HTTPException(status_code=404, detail="Quotazione non trovata")
 
@@ -1469,51 +1305,103 @@ async def calcola_canone(
     if not canone_base:
         raise HTTPException(status_code=400, detail=f"Nessuna quotazione trovata per {campo}")
 
-    prov_admin = db.query(SiteAdminSettings.prov_vetrina).filter(
-        SiteAdminSettings.admin_id == offerta.id_admin,
-        SiteAdminSettings.dealer_id.is_(None)
-    ).scalar() or 0.0
-
-    # 🔒 Eccezione per Unipolrental (id_player = 5)
-    if offerta.id_player == 5:
-        prov_totale = prov_admin  # agency_type ignorata
-    else:
-        prov_totale = prov_admin + payload.provvigione_extra
-
-    incremento = float(offerta.prezzo_totale) * float(prov_totale) / 100.0
-    canone_finale = float(canone_base) + (incremento / payload.durata)
-
-    if payload.anticipo > 0:
-        canone_finale -= (payload.anticipo / payload.durata)
-
+    costo_treno = None
     if payload.pneumatici:
-        jwt_token = request.headers.get("Authorization").split(" ")[1]
-        diametro = await recupera_diametro_pneumatici(offerta.codice_motornet, jwt_token)
-        record_pneumatico = db.query(NltPneumatici).filter(
-            NltPneumatici.diametro == diametro
-        ).first()
-
-        if record_pneumatico:
-            costo_treno = float(record_pneumatico.costo_treno)
-            canone_finale += (costo_treno * payload.n_treni) / payload.durata
-        else:
+        if not diametro:
+            raise HTTPException(status_code=422, detail="Diametro non trovato")
+        costo_treno = listini_servizi_extra.costo_treno(db, diametro)
+        if costo_treno is None:
             raise HTTPException(status_code=404, detail=f"Costo pneumatici R{diametro} non trovato")
 
+    costo_sost = None
     if payload.auto_sostitutiva and payload.categoria_sostitutiva:
-        record_sost = db.query(NltAutoSostitutiva).filter(
-            NltAutoSostitutiva.segmento == payload.categoria_sostitutiva.upper()
-        ).first()
-
-        if record_sost:
-            costo_sost = float(record_sost.costo_mensile)
-            canone_finale += costo_sost
-        else:
+        costo_sost = listini_servizi_extra.costo_sostitutiva(db, payload.categoria_sostitutiva)
+        if costo_sost is None:
             raise HTTPException(status_code=404, detail=f"Segmento auto sostitutiva {payload.categoria_sostitutiva} non trovato")
 
-    if offerta.solo_privati:
-        canone_finale *= 1.22
+    canone = canone_configuratore(
+        offerta, canone_base, payload.durata, prov_admin,
+        provvigione_extra=payload.provvigione_extra,
+        anticipo=payload.anticipo,
+        costo_treno=costo_treno,
+        n_treni=payload.n_treni or 1,
+        costo_sostitutiva=costo_sost,
+    )
+    return {"canone": canone}
+
+
+@router.get("/nlt/calcola-canone/matrice")
+async def calcola_canone_matrice(
+    id_offerte: List[int] = Query(...),
+    provvigione_extra: float = Query(0.0, ge=0),
+    anticipo: float = Query(0.0, ge=0),
+    pneumatici: bool = Query(False),
+    n_treni: int = Query(1, ge=1),
+    auto_sostitutiva: bool = Query(False),
+    categoria_sostitutiva: Optional[str] = Query(None),
+    db: Session = Depends(get_db),
+    current_user=Depends(get_current_user),
+    if_none_match: Optional[str] = Header(None),
+):
+    """
+    Matrice completa durata × km (tutte le colonne di quotazione valorizzate) per più offerte,
+    con le stesse opzioni di /nlt/calcola-canone. ETag sul contenuto: 304 se invariata.
+    """
+    id_offerte = list(dict.fromkeys(id_offerte))
+    if len(id_offerte) > MAX_OFFERTE_MATRICE:
+        raise HTTPException(status_code=400, detail=f"Massimo {MAX_OFFERTE_MATRICE} offerte per richiesta")
+
+    costo_sost = None
+    if auto_sostitutiva and categoria_sostitutiva:
+        costo_sost = listini_servizi_extra.costo_sostitutiva(db, categoria_sostitutiva)
+        if costo_sost is None:
+            raise HTTPException(status_code=404, detail=f"Segmento auto sostitutiva {categoria_sostitutiva} non trovato")
+
+    righe = _righe_configuratore(db, id_offerte)
+    offerte = []
+    for id_offerta in id_offerte:
+        riga = righe.get(id_offerta)
+        if not riga:
+            offerte.append({"id_offerta": id_offerta, "errore": "Offerta non trovata", "canoni": []})
+            continue
+        offerta, quotazione, diametro, prov_admin = riga
+        if not quotazione:
+            offerte.append({"id_offerta": id_offerta, "errore": "Quotazione non trovata", "canoni": []})
+            continue
 
-    return {"canone": round(canone_finale, 2)}
+        costo_treno = None
+        if pneumatici:
+            costo_treno = listini_servizi_extra.costo_treno(db, diametro) if diametro else None
+            if costo_treno is None:
+                errore = f"Costo pneumatici R{diametro} non trovato" if diametro else "Diametro non trovato"
+                offerte.append({"id_offerta": id_offerta, "errore": errore, "canoni": []})
+                continue
+
+        offerte.append({
+            "id_offerta": id_offerta,
+            "canoni": [
+                {
+                    "durata": durata,
+                    "km_annui": km,
+                    "canone": canone_configuratore(
+                        offerta, canone_base, durata, prov_admin,
+                        provvigione_extra=provvigione_extra,
+                        anticipo=anticipo,
+                        costo_treno=costo_treno,
+                        n_treni=n_treni,
+                        costo_sostitutiva=costo_sost,
+                    ),
+                }
+                for durata, km, canone_base in colonne_popolate(quotazione)
+            ],
+        })
+
+    body = json.dumps({"offerte": offerte}, separators=(",", ":"))
+    etag = calcola_etag(body, "matrice")
+    headers = {"ETag": etag, "Cache-Control": MATRICE_CACHE_CONTROL}
+    if etag_corrisponde(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
 
 @router.post("/click")
@@ -1523,24 +1411,15 @@ async def registra_click_offerta(
     db: Session = Depends(get_db)
 ):
     # 1. Recupera settings dealer/admin
-    settings = db.query(SiteAdminSettings).filter(SiteAdminSettings.slug == dealer_slug).first()
-    if not settings:
+    tenant = risolvi_tenant(db, dealer_slug)
+    if not tenant:
         raise HTTPException(status_code=404, detail=f"Dealer '{dealer_slug}' non trovato.")
 
-    id_dealer = settings.dealer_id if settings.dealer_id else settings.admin_id
+    id_dealer = tenant.dealer_id if tenant.dealer_id else tenant.settings.admin_id
 
-    # 2. Verifica che l'offerta esista e sia collegata all'admin corretto
-    offerta = db.query(NltOfferte).filter(NltOfferte.id_offerta == id_offerta).first()
-    if not offerta:
-        raise HTTPException(status_code=404, detail="Offerta non trovata.")
-
-    # 3. Registra click (sempre dealer o admin)
-    nuovo_click = NltOfferteClick(
-        id_offerta=id_offerta,
-        id_dealer=id_dealer
-    )
-    db.add(nuovo_click)
-    db.commit()
+    # 2. Registra click (sempre dealer o admin) nel buffer write-behind:
+    #    le offerte inesistenti vengono scartate al flush (vedi app/utils/click_buffer.py)
+    click_buffer.click_offerta(id_offerta, id_dealer)
 
     return {"success": True}
 
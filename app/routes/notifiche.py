@@ -3,6 +3,7 @@ from pydantic import BaseModel, EmailStr
 from typing import List, Optional, Union
 from sqlalchemy.orm import Session
 from app.database import get_db
+from app.utils.principal_cache import risolvi_principal
 from app.models import User, Cliente, SiteAdminSettings, NotificaType, Notifica
 from app.utils.email import get_smtp_settings
 from email.mime.text import MIMEText
@@ -114,7 +115,7 @@ def invia_notifica_broadcast(
 ):
     Authorize.jwt_required()
     user_email = Authorize.get_jwt_subject()
-    admin = db.query(User).filter(User.email == user_email).first()
+    admin = risolvi_principal(db, user_email)
 
     if not admin or not is_admin_user(admin):
         raise HTTPException(status_code=403, detail="Solo admin autorizzati")
@@ -225,7 +226,7 @@ def get_notifiche_mie(
 ):
     Authorize.jwt_required()
     email = Authorize.get_jwt_subject()
-    user = db.query(User).filter(User.email == email).first()
+    user = risolvi_principal(db, email)
     if not user:
         raise HTTPException(status_code=404, detail="Utente non trovato")
 
@@ -259,7 +260,7 @@ def segna_notifica_letta(
 ):
     Authorize.jwt_required()
     email = Authorize.get_jwt_subject()
-    user = db.query(User).filter(User.email == email).first()
+    user = risolvi_principal(db, email)
     if not user:
         raise HTTPException(status_code=404, detail="Utente non trovato")
 
@@ -286,7 +287,7 @@ def archivia_notifica(
 ):
     Authorize.jwt_required()
     email = Authorize.get_jwt_subject()
-    user = db.query(User).filter(User.email == email).first()
+    user = risolvi_principal(db, email)
     if not user:
         raise HTTPException(status_code=404, detail="Utente non trovato")
 
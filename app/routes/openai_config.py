@@ -7,7 +7,7 @@ from sqlalchemy.orm import Session
 from pydantic import BaseModel, Field
 
 # --- Utilità app interne ---
-from app.database import get_db, supabase_client
+from app.database import get_db
 from app.models import (
     User,
     PurchasedServices,
@@ -31,6 +31,11 @@ import base64
 import asyncio
 import logging
 import requests
+from app.utils.executors import run_cpu, run_io
+from app.utils.immagini_ai_worker import metriche_coda_immagini
+from app.utils.principal_cache import risolvi_principal
+from app.utils.media_encoding import converti
+from app.utils.storage import storage, StorageError
 import unicodedata
 from datetime import datetime, timedelta
 from uuid import uuid4, UUID
@@ -258,16 +263,20 @@ async def _fetch_image_base64_from_url(url: str) -> tuple[str, str]:
             raise HTTPException(502, f"Download immagine fallito: {r.text}")
         mime = r.headers.get("content-type", "image/png")
 
-        # Apri immagine e forza resize
-        img = Image.open(BytesIO(r.content)).convert("RGB")
-        img = img.resize((1024, 1024), Image.LANCZOS)
-
-        buf = BytesIO()
-        img.save(buf, format="PNG")
-        b64 = base64.b64encode(buf.getvalue()).decode("utf-8")
+        # Apri immagine e forza resize (PIL nel pool CPU, non sul loop)
+        b64 = await run_cpu(_png_1024_base64, r.content)
         return "image/png", b64
 
 
+def _png_1024_base64(content: bytes) -> str:
+    img = Image.open(BytesIO(content)).convert("RGB")
+    img = img.resize((1024, 1024), Image.LANCZOS)
+
+    buf = BytesIO()
+    img.save(buf, format="PNG")
+    return base64.b64encode(buf.getvalue()).decode("utf-8")
+
+
 async def _gemini_start_video(
     prompt: str,
     start_image_url: Optional[str] = None,
@@ -609,7 +618,7 @@ async def check_video_status(
     try:
         blob = await _download_bytes(uri)
         storage_path = f"{rec.id_auto}/{rec.id}.mp4"
-        full_path, public_url = _sb_upload_and_sign(storage_path, blob, "video/mp4")
+        full_path, public_url = await _sb_upload_and_sign(storage_path, blob, "video/mp4")
 
         rec.status = "completed"
         rec.storage_path = full_path
@@ -723,6 +732,18 @@ def _gemini_build_prompt_with_override(auto, override: str, det: Optional[MnetDe
 
 
 
+def _converti_formato(images: list, formato: str) -> list:
+    """Una sola codifica nel formato richiesto; se un'immagine non è leggibile la lascia com'è."""
+    convertite = []
+    for raw in images:
+        try:
+            convertite.append(converti(raw, formato))
+        except Exception as e:
+            logging.warning(f"errore conversione {formato}: {e}")
+            convertite.append(raw)
+    return convertite
+
+
 async def _gemini_generate_image_sync(
     prompt: str,
     start_image_url: Optional[str] = None,
@@ -730,11 +751,14 @@ async def _gemini_generate_image_sync(
     subject_image_url: Optional[str] = None,
     background_image_url: Optional[str] = None,
     num_images: int = 1,
-    size: Optional[str] = None
+    size: Optional[str] = None,
+    formato: Optional[str] = None
 ) -> list[bytes]:
     """
     Genera una o più immagini con Gemini.
     Retry in memoria su errori transitori o risposte vuote.
+    Restituisce i byte originali di Gemini; con `formato` ("webp", "png", "jpeg")
+    li codifica una volta sola (chi compone logo/varianti usa app/utils/media_encoding.py).
     """
     _gemini_assert_api()
     url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-image-preview:generateContent"
@@ -813,18 +837,9 @@ async def _gemini_generate_image_sync(
                         images.append(base64.b64decode(inline["data"]))
 
             if images:
-                images_webp = []
-                for raw in images:
-                    try:
-                        im = Image.open(io.BytesIO(raw)).convert("RGB")
-                        buf = io.BytesIO()
-                        im.save(buf, format="WEBP", quality=85, method=6)
-                        buf.seek(0)
-                        images_webp.append(buf.getvalue())
-                    except Exception as e:
-                        logging.warning(f"errore conversione webp: {e}")
-                        images_webp.append(raw)
-                return images_webp  # ✅ successo
+                if formato:
+                    return await run_cpu(_converti_formato, images, formato)
+                return images  # ✅ successo
 
 
             msg = (
@@ -1013,7 +1028,7 @@ async def genera_image_hero_veo3(
         # Upload su Supabase
         ext = ".png"
         path = f"{str(rec.id_auto)}/{str(rec.id)}{ext}"
-        _, signed_url = _sb_upload_and_sign(path, img_bytes, "image/png")
+        _, signed_url = await _sb_upload_and_sign(path, img_bytes, "image/png")
 
         rec.public_url = signed_url
         rec.storage_path = path
@@ -1101,6 +1116,19 @@ async def check_image_status(
     return GeminiImageStatusResponse(status=rec.status or "processing", usato_leonardo_id=str(rec.id))
 
 
+@router.get("/veo3/image-queue-metrics", tags=["Gemini Image"])
+def image_queue_metrics(Authorize: AuthJWT = Depends(), db: Session = Depends(get_db)):
+    """Coda immagini AI: job in attesa e in lavorazione, età del più vecchio, immagini/minuto."""
+    Authorize.jwt_required()
+
+    # 🔐 metriche interne di coda, worker e cache: solo admin
+    utente = risolvi_principal(db, Authorize.get_jwt_subject())
+    if not utente or utente.role not in ["admin", "superadmin"]:
+        raise HTTPException(403, detail="Accesso non autorizzato")
+
+    return metriche_coda_immagini(db)
+
+
 
 
 
@@ -1119,22 +1147,9 @@ SUPABASE_BUCKET = os.getenv("SUPABASE_BUCKET_LEONARDO", "leonardo-video")
 LEONARDO_WEBHOOK_SECRET = os.getenv("LEONARDO_WEBHOOK_SECRET", "")
 
 
-def _sb_upload_and_sign(path: str, blob: bytes, content_type: str) -> tuple[str, str | None]:
-    # Upload con upsert usando l’SDK già autenticato (supabase_client)
-    supabase_client.storage.from_(SUPABASE_BUCKET).upload(
-        path=path,
-        file=blob,
-        file_options={"content-type": content_type, "upsert": "true"}
-    )
-    # URL firmata 30 giorni
-    res = supabase_client.storage.from_(SUPABASE_BUCKET).create_signed_url(
-        path=path,
-        expires_in=60 * 60 * 24 * 30
-    )
-    signed = res.get("signedURL") or res.get("signed_url") or res.get("signedUrl")
-    if signed and signed.startswith("/storage"):
-        base = os.getenv("SUPABASE_URL", "").rstrip("/")
-        signed = f"{base}{signed}"
+async def _sb_upload_and_sign(path: str, blob, content_type: str) -> tuple[str, str | None]:
+    # upload con upsert + URL firmata 30 giorni, client storage async condiviso (app/utils/storage.py)
+    signed = await storage.upload_e_firma(SUPABASE_BUCKET, path, blob, content_type)
     return path, signed
 # Costo crediti per Dealer (override da env)
 LEONARDO_CREDIT_COST = float(os.getenv("LEONARDO_CREDIT_COST", "5.0"))
@@ -1375,7 +1390,7 @@ async def leonardo_webhook(payload: dict, db: Session = Depends(get_db)):
     blob = await _download_bytes(uri)
     ext = ".mp4" if rec.media_type == "video" else ".png"
     path = f"{str(rec.id_auto)}/{str(rec.id)}{ext}"
-    public_url = _sb_upload_and_sign(path, blob, "video/mp4" if rec.media_type == "video" else "image/png")
+    public_url = await _sb_upload_and_sign(path, blob, "video/mp4" if rec.media_type == "video" else "image/png")
 
     rec.public_url = public_url
     rec.storage_path = path
@@ -1414,32 +1429,17 @@ from io import BytesIO
 
 SUPABASE_BUCKET_SCENARI = os.getenv("SUPABASE_BUCKET_SCENARI", "scenari-dealer")
 
-def _sb_upload_scenario(path: str, blob: bytes, content_type: str = "image/png") -> tuple[str, str | None]:
-    # upload con bytes grezzi, come per _sb_upload_and_sign
-    up = supabase_client.storage.from_(SUPABASE_BUCKET_SCENARI).upload(
-        path=path,
-        file=blob,
-        file_options={"content-type": content_type, "upsert": "true"}
-    )
-    # log e hard-fail se l’SDK ritorna error
-    if isinstance(up, dict) and up.get("error"):
-        msg = up["error"].get("message", "unknown")
-        logging.error(f"[SCENARIO-UPLOAD] error bucket={SUPABASE_BUCKET_SCENARI} path={path}: {msg}")
-        raise HTTPException(502, f"Supabase upload error: {msg}")
-
-    res = supabase_client.storage.from_(SUPABASE_BUCKET_SCENARI).create_signed_url(
-        path=path, expires_in=60*60*24*30
-    )
-    url = res.get("signedURL") or res.get("signed_url") or res.get("signedUrl")
+async def _sb_upload_scenario(path: str, blob: bytes, content_type: str = "image/png") -> tuple[str, str | None]:
+    try:
+        url = await storage.upload_e_firma(SUPABASE_BUCKET_SCENARI, path, blob, content_type)
+    except StorageError as e:
+        # log e hard-fail se lo storage risponde con errore
+        logging.error(f"[SCENARIO-UPLOAD] error bucket={SUPABASE_BUCKET_SCENARI} path={path}: {e}")
+        raise HTTPException(502, f"Supabase upload error: {e}")
 
     # fallback public url
     if not url:
-        pub = supabase_client.storage.from_(SUPABASE_BUCKET_SCENARI).get_public_url(path)
-        url = pub.get("publicURL") or pub.get("publicUrl") or pub.get("public_url")
-
-    if url and url.startswith("/storage"):
-        base = os.getenv("SUPABASE_URL", "").rstrip("/")
-        url = f"{base}{url}"
+        url = storage.url_pubblico(SUPABASE_BUCKET_SCENARI, path)
 
     logging.warning(f"[SCENARIO-UPLOAD] ok bucket={SUPABASE_BUCKET_SCENARI} path={path} url={url}")
     return path, url
@@ -1477,7 +1477,7 @@ async def upload_scenario_image(
     ctype = file.content_type or "image/png"
 
     try:
-        _, signed_url = _sb_upload_scenario(path, blob, ctype)
+        _, signed_url = await _sb_upload_scenario(path, blob, ctype)
         return {"success": True, "url": signed_url}
     except Exception as e:
         logging.exception("Scenario upload failed")
@@ -1625,6 +1625,13 @@ class WebpImageRequest(BaseModel):
 
 
 
+def _webp_bytes(img_bytes: bytes, quality: int) -> bytes:
+    img = Image.open(io.BytesIO(img_bytes))
+    buf = io.BytesIO()
+    img.save(buf, format="WEBP", quality=quality)
+    return buf.getvalue()
+
+
 @router.post("/veo3/image-webp", tags=["Gemini VEO 3"])
 async def genera_image_webp(payload: WebpImageRequest):
     try:
@@ -1684,14 +1691,11 @@ async def genera_image_webp(payload: WebpImageRequest):
             if not img_bytes:
                 raise HTTPException(502, f"Gemini image: nessuna immagine trovata. Resp: {data}")
 
-        # Converti in .webp in memoria
-        img = Image.open(io.BytesIO(img_bytes))
-        buf = io.BytesIO()
-        img.save(buf, format="WEBP", quality=90)
-        buf.seek(0)
+        # Converti in .webp in memoria (pool CPU)
+        content = await run_cpu(_webp_bytes, img_bytes, 90)
 
         return Response(
-            content=buf.read(),
+            content=content,
             media_type="image/webp",
             headers={"Content-Disposition": 'attachment; filename="output.webp"'}
         )
@@ -1736,6 +1740,13 @@ class DalleCombineResponse(BaseModel):
     usato_leonardo_id: _UUID
     status: str = "completed"
 
+def _serializza_png(im: Image.Image) -> BytesIO:
+    out = BytesIO()
+    im.save(out, format="PNG")
+    out.seek(0)
+    return out
+
+
 def _load_image_from_url(url: str, field: str) -> Image.Image:
     try:
         r = requests.get(url, timeout=30)
@@ -1745,6 +1756,19 @@ def _load_image_from_url(url: str, field: str) -> Image.Image:
         raise HTTPException(400, f"Invalid image URL for '{field}'")
 
 
+def _affianca_png(i1: Image.Image, i2: Image.Image) -> BytesIO:
+    w, h = i1.width + i2.width, max(i1.height, i2.height)
+    canvas = Image.new("RGB", (w, h), (255, 255, 255))
+    canvas.paste(i1, (0, 0))
+    canvas.paste(i2, (i1.width, 0))
+
+    buf = BytesIO()
+    canvas.save(buf, format="PNG")
+    buf.seek(0)
+    buf.name = "canvas.png"
+    return buf
+
+
 # --- DALLE COMBINE (enqueue asincrono: JWT + credito + storico) ------------
 import os
 import logging
@@ -1916,18 +1940,10 @@ async def dalle_combine(
         raise HTTPException(400, "orientation must be one of: square, landscape, portrait")
     size = ORIENTATION_SIZE[payload.orientation]
 
-    # --- carica immagini e composizione ---
-    i1 = _load_image_from_url(payload.img1_url, "img1_url")
-    i2 = _load_image_from_url(payload.img2_url, "img2_url")
-    w, h = i1.width + i2.width, max(i1.height, i2.height)
-    canvas = Image.new("RGB", (w, h), (255, 255, 255))
-    canvas.paste(i1, (0, 0))
-    canvas.paste(i2, (i1.width, 0))
-
-    buf = BytesIO()
-    canvas.save(buf, format="PNG")
-    buf.seek(0)
-    buf.name = "canvas.png"
+    # --- carica immagini e composizione (download nel pool I/O, PIL nel pool CPU) ---
+    i1 = await run_io(_load_image_from_url, payload.img1_url, "img1_url")
+    i2 = await run_io(_load_image_from_url, payload.img2_url, "img2_url")
+    buf = await run_cpu(_affianca_png, i1, i2)
 
     # --- crea record storico (queued) ---
     rec = UsatoLeonardo(
@@ -1997,15 +2013,13 @@ async def dalle_combine(
             db.commit()
             raise HTTPException(400, rec.error_message)
 
-    # --- serializza PNG ---
-    output_png = BytesIO()
-    final.save(output_png, format="PNG")
-    output_png.seek(0)
+    # --- serializza PNG (pool CPU) ---
+    output_png = await run_cpu(_serializza_png, final)
 
     # --- upload su Supabase + finalize ---
     try:
         path = f"{str(rec.id_auto)}/{str(rec.id)}.png"
-        _, signed_url = _sb_upload_and_sign(path, output_png.getvalue(), "image/png")
+        _, signed_url = await _sb_upload_and_sign(path, output_png.getvalue(), "image/png")
         rec.public_url = signed_url
         rec.storage_path = path
         rec.status = "completed"
@@ -2327,11 +2341,11 @@ async def gemini_auto_scenario(
             raise HTTPException(502, "Gemini non ha restituito immagini allo step A")
 
         img_bytes = img_bytes_list[0]
-        img_bytes = ensure_transparency(img_bytes)     # forza PNG RGBA
+        img_bytes = await run_cpu(ensure_transparency, img_bytes)     # forza PNG RGBA (rembg nel pool CPU)
         car_bytes_ready = img_bytes                    # usa questi bytes nello step B
 
         pathA = f"{str(rec_clean.id_auto)}/{str(rec_clean.id)}.png"
-        _, signed_urlA = _sb_upload_and_sign(pathA, img_bytes, "image/png")
+        _, signed_urlA = await _sb_upload_and_sign(pathA, img_bytes, "image/png")
 
         rec_clean.public_url = signed_urlA
         rec_clean.storage_path = pathA
@@ -2387,9 +2401,10 @@ async def gemini_auto_scenario(
                 x_offset_rel = payload.x_offset_rel if payload.x_offset_rel is not None else 0.00
                 pedana_rel   = payload.pedana_rel   if payload.pedana_rel   is not None else 0.60
 
-                bg_img  = _download_image(img2)
+                bg_img  = await run_io(_download_image, img2)
                 car_img = Image.open(io.BytesIO(car_bytes_ready)).convert("RGBA")
-                img_bytesB = _compose_with_pedana_images(
+                img_bytesB = await run_cpu(
+                    _compose_with_pedana_images,
                     car_img, bg_img,
                     scale_rel=scale_rel,
                     y_offset_rel=y_offset_rel,
@@ -2406,7 +2421,7 @@ async def gemini_auto_scenario(
                 img_bytesB = img_bytesB_list[0]
 
             pathB = f"{str(rec_final.id_auto)}/{str(rec_final.id)}.png"
-            _, signed_urlB = _sb_upload_and_sign(pathB, img_bytesB, "image/png")
+            _, signed_urlB = await _sb_upload_and_sign(pathB, img_bytesB, "image/png")
 
             rec_final.public_url = signed_urlB
             rec_final.storage_path = pathB
@@ -2452,7 +2467,7 @@ async def gemini_auto_scenario(
 
                 ref_bytes = ref_list[0]
                 pathC = f"{str(rec_ref.id_auto)}/{str(rec_ref.id)}.png"
-                _, signed_urlC = _sb_upload_and_sign(pathC, ref_bytes, "image/png")
+                _, signed_urlC = await _sb_upload_and_sign(pathC, ref_bytes, "image/png")
 
                 rec_ref.public_url = signed_urlC
                 rec_ref.storage_path = pathC
@@ -5,6 +5,7 @@ from fastapi_jwt_auth import AuthJWT
 from fastapi import Body
 from app.auth_helpers import is_admin_user, is_dealer_user, is_team_user, get_admin_id, get_dealer_id
 from app.database import get_db
+from app.utils.principal_cache import risolvi_principal
 from app.models import NltPipeline, NltPipelineStati, NltPreventivi, User, CrmAzione, NltPipelineLog, SiteAdminSettings
 from typing import List, Optional
 from pydantic import BaseModel
@@ -86,13 +87,12 @@ class PipelineStatoOut(BaseModel):
 def get_pipeline(Authorize: AuthJWT = Depends(), db: Session = Depends(get_db)):
     from app.auth_helpers import (
         is_admin_user, is_dealer_user,
-        get_admin_id, get_dealer_id
     )
 
     Authorize.jwt_required()
     user_email = Authorize.get_jwt_subject()
 
-    user = db.query(User).filter(User.email == user_email).first()
+    user = risolvi_principal(db, user_email)
     if not user:
         raise HTTPException(status_code=401, detail="Utente non trovato")
 
@@ -101,18 +101,14 @@ def get_pipeline(Authorize: AuthJWT = Depends(), db: Session = Depends(get_db)):
     utenti_visibili = []
 
     if ruolo in ["admin", "admin_team"]:
-        admin_id = get_admin_id(user)
         utenti_visibili.append(user_id)  # sempre se stesso
         if ruolo == "admin":
-            team_ids = db.query(User.id).filter(User.parent_id == admin_id, User.role == "admin_team").all()
-            utenti_visibili += [u.id for u in team_ids]
+            utenti_visibili += user.membri("admin_team")
 
     elif ruolo in ["dealer", "dealer_team"]:
-        dealer_id = get_dealer_id(user)
         utenti_visibili.append(user_id)
         if ruolo == "dealer":
-            team_ids = db.query(User.id).filter(User.parent_id == dealer_id, User.role == "dealer_team").all()
-            utenti_visibili += [u.id for u in team_ids]
+            utenti_visibili += user.membri("dealer_team")
 
     elif ruolo == "superadmin":
         utenti_visibili = db.query(User.id).all()
@@ -176,7 +172,7 @@ def get_pipeline(Authorize: AuthJWT = Depends(), db: Session = Depends(get_db)):
 def update_pipeline(id: str, payload: PipelineItemUpdate, Authorize: AuthJWT = Depends(), db: Session = Depends(get_db)):
     Authorize.jwt_required()
     user_email = Authorize.get_jwt_subject()
-    user = db.query(User).filter(User.email == user_email).first()
+    user = risolvi_principal(db, user_email)
     if not user:
         raise HTTPException(status_code=401, detail="Utente non trovato")
     user_id = user.id
@@ -222,7 +218,7 @@ def attiva_pipeline(
 ):
     Authorize.jwt_required()
     user_email = Authorize.get_jwt_subject()
-    user = db.query(User).filter(User.email == user_email).first()
+    user = risolvi_principal(db, user_email)
     if not user:
         raise HTTPException(status_code=401, detail="Utente non trovato")
 
@@ -323,7 +319,7 @@ def crea_log_pipeline(payload: PipelineLogCreate, db: Session = Depends(get_db),
     Authorize.jwt_required()
     user_email = Authorize.get_jwt_subject()
 
-    user = db.query(User).filter(User.email == user_email).first()
+    user = risolvi_principal(db, user_email)
     if not user:
         raise HTTPException(status_code=401, detail="Utente non trovato")
 
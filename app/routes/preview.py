@@ -2,23 +2,23 @@
 from fastapi.responses import HTMLResponse, RedirectResponse
 from sqlalchemy.orm import Session
 from app.database import get_db
-from app.models import NltOfferte, MnetModelli, User, SiteAdminSettings
+from app.utils.tenant_cache import risolvi_tenant
+from app.models import NltOfferte, MnetModelli
 
 
 router = APIRouter()
 
 @router.get("/vetrina-offerte/{slug}", response_class=HTMLResponse)
 async def meta_preview(slug: str, request: Request, db: Session = Depends(get_db)):
-    settings = db.query(SiteAdminSettings).filter(SiteAdminSettings.slug == slug).first()
-    if not settings:
+    tenant = risolvi_tenant(db, slug)
+    if not tenant:
         raise HTTPException(status_code=404, detail=f"Dealer con slug '{slug}' non trovato.")
+    settings = tenant.settings
 
-    # 🔹 Recupera ragione sociale del dealer
+    # 🔹 Ragione sociale del dealer (dalla cache tenant)
     dealer_name = slug
-    if settings.dealer_id:
-        dealer = db.query(User).filter(User.id == settings.dealer_id).first()
-        if dealer and dealer.ragione_sociale:
-            dealer_name = dealer.ragione_sociale
+    if tenant.dealer_user and tenant.dealer_user.ragione_sociale:
+        dealer_name = tenant.dealer_user.ragione_sociale
 
     # 🔹 Parametri dalla query string
     query = request.query_params
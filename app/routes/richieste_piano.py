@@ -2,7 +2,7 @@
 from fastapi.responses import JSONResponse
 from sqlalchemy.orm import Session
 from app.database import get_db
-from app.utils.email import send_email  # Adatta al tuo path reale se diverso
+from app.utils.email import send_email_async
 
 router = APIRouter()
 
@@ -30,7 +30,7 @@ async def invia_richiesta_piano(
     """
 
     try:
-        send_email(admin_id=admin_id, to_email="richieste@nlt.rent", subject=subject, body=body)
+        await send_email_async(admin_id=admin_id, to_email="richieste@nlt.rent", subject=subject, body=body)
         return JSONResponse(content={"success": True, "message": "Richiesta inviata correttamente."})
     
     except Exception as e:
@@ -6,6 +6,7 @@ from app.models import SiteAdminSettings, User, NltOfferte, NltQuotazioni, SmtpS
 
 from pydantic import BaseModel
 from app.auth_helpers import get_admin_id, get_dealer_id, is_admin_user, is_dealer_user, get_settings_owner_id
+from app.utils.tenant_cache import TenantContext, get_tenant, invalida_tenant, risolvi_tenant
 import re, unidecode
 from supabase import create_client, Client
 import uuid, os
@@ -196,6 +197,7 @@ async def create_or_update_site_settings(
         ).first()
 
     # gestione slug
+    slug_precedente = settings.slug if settings else None
     if settings:  # record esistente
         if payload.slug and payload.slug != settings.slug:
             # utente vuole cambiare slug -> controlla unicità
@@ -265,6 +267,7 @@ async def create_or_update_site_settings(
 
     db.commit()
     db.refresh(settings)
+    invalida_tenant(slug_precedente, settings.slug)
 
     return {"status": "success", "slug": settings.slug, "id": settings.id}
 
@@ -339,6 +342,7 @@ async def upload_logo_web(
 
     db.commit()
     db.refresh(settings)
+    invalida_tenant(settings.slug)
 
     return {
         "status": "success",
@@ -536,14 +540,10 @@ async def get_site_settings(
 
 
 @router.get("/site-settings-public/{slug}")
-async def get_site_settings_public(slug: str, db: Session = Depends(get_db)):
-    settings = db.query(SiteAdminSettings).filter(SiteAdminSettings.slug == slug).first()
-    if not settings:
-        raise HTTPException(status_code=404, detail=f"Slug '{slug}' non trovato.")
-
-    admin_user = db.query(User).filter(User.id == settings.admin_id).first()
-    dealer_user = db.query(User).filter(User.id == settings.dealer_id).first() if settings.dealer_id else None
-    visible_user = dealer_user or admin_user
+async def get_site_settings_public(slug: str, tenant: TenantContext = Depends(get_tenant)):
+    settings = tenant.settings
+    admin_user = tenant.admin_user
+    visible_user = tenant.dealer_user or admin_user
 
     contact_email = settings.contact_email or (admin_user.email if admin_user else "")
     contact_phone = settings.contact_phone or (admin_user.cellulare if admin_user else "")
@@ -648,6 +648,7 @@ async def upload_hero_image(
 
     db.commit()
     db.refresh(settings)
+    invalida_tenant(settings.slug)
 
     return {
         "status": "success",
@@ -696,7 +697,8 @@ async def upload_servizio_image(
 
 @router.get("/site-settings-public/{slug}/recensioni")
 async def get_google_reviews(slug: str, db: Session = Depends(get_db)):
-    settings = db.query(SiteAdminSettings).filter(SiteAdminSettings.slug == slug).first()
+    tenant = risolvi_tenant(db, slug)
+    settings = tenant.settings if tenant else None
     if not settings or not settings.google_place_id:
         raise HTTPException(status_code=404, detail="Dealer non trovato o Place ID mancante")
 
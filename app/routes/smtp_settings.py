@@ -5,7 +5,7 @@ from app.database import get_db
 from app.models import SmtpSettings, User
 from pydantic import BaseModel
 from app.auth_helpers import get_admin_id, is_admin_user
-import smtplib
+from app.utils.email import invia_messaggio_async
 from email.mime.text import MIMEText
 from email.utils import formataddr
 
@@ -82,15 +82,7 @@ async def test_smtp_settings(
         msg["From"] = formataddr((current_user.email, smtp_settings.smtp_user))
         msg["To"] = test.test_email
 
-        if smtp_settings.use_ssl:
-            server = smtplib.SMTP_SSL(smtp_settings.smtp_host, smtp_settings.smtp_port)
-        else:
-            server = smtplib.SMTP(smtp_settings.smtp_host, smtp_settings.smtp_port)
-            server.starttls()
-
-        server.login(smtp_settings.smtp_user, smtp_settings.smtp_password)
-        server.send_message(msg)
-        server.quit()
+        await invia_messaggio_async(smtp_settings, msg)
 
         return {"success": True, "message": f"Email inviata con successo a {test.test_email}"}
 
@@ -1,7 +1,8 @@
 ﻿from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.orm import Session
 from app.database import SessionLocal
-from app.models import User, PurchasedServices, Services  # aggiunto Services
+from app.utils.principal_cache import risolvi_principal
+from app.models import PurchasedServices, Services  # aggiunto Services
 from fastapi_jwt_auth import AuthJWT
 from datetime import datetime, timedelta
 from sqlalchemy import text
@@ -21,7 +22,7 @@ def days_until_renewal(Authorize: AuthJWT = Depends(), db: Session = Depends(get
     Authorize.jwt_required()
     user_email = Authorize.get_jwt_subject()
 
-    user = db.query(User).filter(User.email == user_email).first()
+    user = risolvi_principal(db, user_email)
 
     if not user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Utente non trovato")
@@ -1,98 +1,54 @@
-﻿import requests
-from datetime import datetime
+﻿from datetime import datetime
 from sqlalchemy import text
 from app.database import SessionLocal
-import requests
-import time
-from sqlalchemy.orm import Session
-from app.models import MnetModelli
+from app.utils.motornet_sync import esegui_sync
 
-MOTORN_AUTH_URL = "https://webservice.motornet.it/auth/realms/webservices/protocol/openid-connect/token"
 VERSIONI_URL = "https://webservice.motornet.it/api/v3_0/rest/public/nuovo/auto/versioni"
 ANNO_CORRENTE = datetime.now().year
 
-def get_motornet_token():
-    data = {
-        'grant_type': 'password',
-        'client_id': 'webservice',
-        'username': 'azure447',
-        'password': 'azwsn557',
-    }
-    response = requests.post(MOTORN_AUTH_URL, data=data)
-    response.raise_for_status()
-    return response.json().get('access_token')
 
-def sync_allestimenti():
-    db = SessionLocal()
-    modelli = db.execute(text("""
-    SELECT m.codice_modello
-    FROM mnet_modelli m
-    JOIN mnet_marche ma ON m.marca_acronimo = ma.acronimo
-    WHERE ma.utile IS TRUE
-""")).fetchall()
-
-
-    for row in modelli:
-        codice_modello = row[0]
-        print(f"\n🔎 Recupero allestimenti per modello: {codice_modello}")
-
-        token = get_motornet_token()
-        headers = {"Authorization": f"Bearer {token}"}
-        url = f"{VERSIONI_URL}?codice_modello={codice_modello}&anno={ANNO_CORRENTE}"
-
-        for attempt in range(5):
-            response = requests.get(url, headers=headers)
-
-            if response.status_code == 200:
-                break
-            elif response.status_code == 401:
-                print("🔄 Token scaduto o non valido, rigenero...")
-                token = get_motornet_token()
-                headers = {"Authorization": f"Bearer {token}"}
-                time.sleep(1.5)
-            else:
-                print(f"❌ Errore {response.status_code} per modello {codice_modello}, tentativo {attempt+1}")
-                time.sleep(1.5)
-        else:
-            print(f"❌ Errore permanente su modello {codice_modello}, salto.")
-            continue
+def _salva_allestimenti(db, codice_modello, versioni):
+    inseriti = 0
+    for v in versioni:
+        result = db.execute(text("""
+            INSERT INTO mnet_allestimenti (
+                codice_modello, codice_motornet_uni, nome, data_da, data_a
+            ) VALUES (
+                :codice_modello, :codice_motornet_uni, :nome, :data_da, :data_a
+            )
+            ON CONFLICT (codice_motornet_uni) DO NOTHING
+        """), {
+            "codice_modello": codice_modello,
+            "codice_motornet_uni": v["codiceMotornetUnivoco"],
+            "nome": v["nome"],
+            "data_da": v.get("da"),
+            "data_a": v.get("a"),
+        })
+        inseriti += result.rowcount
+    return inseriti
+
+
+async def _sync_modello(engine, codice_modello):
+    data = await engine.get_json(f"{VERSIONI_URL}?codice_modello={codice_modello}&anno={ANNO_CORRENTE}")
+    versioni = (data or {}).get("versioni", [])
+    inseriti = await engine.scrivi(_salva_allestimenti, codice_modello, versioni)
+    if inseriti:
+        print(f"✅ {codice_modello}: {inseriti} nuovi allestimenti")
 
-        versioni = response.json().get("versioni", [])
 
-        for v in versioni:
-            codice_uni = v["codiceMotornetUnivoco"]
-            nome = v["nome"]
-            data_da = v.get("da")
-            data_a = v.get("a")
-
-            check = db.execute(
-                text("SELECT 1 FROM mnet_allestimenti WHERE codice_motornet_uni = :cod"),
-                {"cod": codice_uni}
-            ).fetchone()
-
-            if check:
-                print(f"⏩ Allestimento {codice_uni} già presente, salto.")
-                continue
-
-            insert_query = text("""
-                INSERT INTO mnet_allestimenti (
-                    codice_modello, codice_motornet_uni, nome, data_da, data_a
-                ) VALUES (
-                    :codice_modello, :codice_motornet_uni, :nome, :data_da, :data_a
-                )
-            """)
-
-            db.execute(insert_query, {
-                "codice_modello": codice_modello,
-                "codice_motornet_uni": codice_uni,
-                "nome": nome,
-                "data_da": data_da,
-                "data_a": data_a
-            })
-            db.commit()
-            print(f"✅ Inserito allestimento {codice_uni}")
-
-    db.close()
+def sync_allestimenti():
+    db = SessionLocal()
+    try:
+        modelli = db.execute(text("""
+            SELECT m.codice_modello
+            FROM mnet_modelli m
+            JOIN mnet_marche ma ON m.marca_acronimo = ma.acronimo
+            WHERE ma.utile IS TRUE
+        """)).fetchall()
+    finally:
+        db.close()
+
+    return esegui_sync("nuovo_allestimenti", [m[0] for m in modelli], _sync_modello)
 
 
 if __name__ == "__main__":
@@ -4,43 +4,29 @@ import logging
 from datetime import datetime
 from app.database import SessionLocal
 from app.models import MnetAllestimenti, MnetImmagini
+from app.utils.motornet_token import get_motornet_token, motornet_tokens
 
-MOTORN_AUTH_URL = "https://webservice.motornet.it/auth/realms/webservices/protocol/openid-connect/token"
 MOTORN_FOTO_URL = "https://webservice.motornet.it/api/v3_0/rest/public/nuovo/auto/foto"
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 
-def get_motornet_token():
-    data = {
-        "grant_type": "password",
-        "client_id": "webservice",
-        "username": "azure447",
-        "password": "azwsn557",
-    }
-    r = requests.post(MOTORN_AUTH_URL, data=data)
-    r.raise_for_status()
-    return r.json().get("access_token")
-
 def sync_foto_mnet(max_retries=5, delay_base=2):
     db = SessionLocal()
 
     allestimenti = db.query(MnetAllestimenti.codice_motornet_uni).all()
     logging.info(f"📸 Avvio sync_foto_mnet: {len(allestimenti)} allestimenti da processare")
 
-    token = get_motornet_token()
-    headers = {"Authorization": f"Bearer {token}"}
-
     for (codice_uni,) in allestimenti:
         attempt = 0
         while attempt < max_retries:
             try:
                 url = f"{MOTORN_FOTO_URL}?codice_motornet_uni={codice_uni}&risoluzione=H"
-                r = requests.get(url, headers=headers, timeout=30)
+                token = get_motornet_token()
+                r = requests.get(url, headers={"Authorization": f"Bearer {token}"}, timeout=30)
+                motornet_tokens.registra_risposta(r.status_code, token)
 
                 if r.status_code == 401:
                     logging.warning(f"🔑 Token scaduto durante {codice_uni}, rinnovo...")
-                    token = get_motornet_token()
-                    headers = {"Authorization": f"Bearer {token}"}
                     attempt += 1
                     continue
 
@@ -6,7 +6,9 @@ from sqlalchemy.orm import Session
 from sqlalchemy import text
 from uuid import UUID
 from app.database import get_db
-from app.models import UsatoVetrina, User, SiteAdminSettings
+from app.models import UsatoVetrina, User
+from app.utils.tenant_cache import risolvi_tenant
+from app.utils.url_firmate import url_firmate
 from datetime import datetime
 from pydantic import BaseModel
 from typing import Optional, List
@@ -65,14 +67,20 @@ def get_vetrina_auto(id_auto: UUID, db: Session = Depends(get_db)):
             v.created_at,
             CASE v.media_type
               WHEN 'foto' THEN (SELECT foto FROM public.azlease_usatoimg WHERE id = v.media_id)
-              WHEN 'ai'   THEN (SELECT public_url FROM public.usato_leonardo WHERE id = v.media_id)
-            END AS media_url
+              WHEN 'ai'   THEN l.public_url
+            END AS media_url,
+            l.storage_path
         FROM public.usato_vetrina v
+        LEFT JOIN public.usato_leonardo l ON v.media_type = 'ai' AND l.id = v.media_id
         WHERE v.id_auto = :id_auto
         ORDER BY v.priority ASC NULLS LAST, v.created_at ASC
     """)
     rows = db.execute(query, {"id_auto": str(id_auto)}).mappings().all()
-    return [VetrinaOutExtended(**r) for r in rows]
+    firmate = url_firmate(db, [r["storage_path"] for r in rows])
+    return [
+        VetrinaOutExtended(**{**r, "media_url": firmate.get(r["storage_path"]) or r["media_url"]})
+        for r in rows
+    ]
 
 
 
@@ -124,10 +132,11 @@ def add_media_vetrina(
         media_url = row.foto if row else None
     elif data.media_type == "ai":
         row = db.execute(
-            text("SELECT public_url FROM public.usato_leonardo WHERE id = :id"),
+            text("SELECT public_url, storage_path FROM public.usato_leonardo WHERE id = :id"),
             {"id": str(data.media_id)},
         ).fetchone()
-        media_url = row.public_url if row else None
+        if row:
+            media_url = url_firmate(db, [row.storage_path]).get(row.storage_path) or row.public_url
 
     return VetrinaOutExtended(
         id=rec.id,
@@ -185,12 +194,12 @@ def lista_vetrina_cards(slug: str, db: Session = Depends(get_db)):
     per popolare le card nella lista pubblica.
     """
     # 1. Recupera impostazioni sito (admin o dealer)
-    settings = db.query(SiteAdminSettings).filter(SiteAdminSettings.slug == slug).first()
-    if not settings:
+    tenant = risolvi_tenant(db, slug)
+    if not tenant:
         raise HTTPException(404, f"Slug '{slug}' non trovato")
 
-    admin_id = settings.admin_id
-    dealer_id = settings.dealer_id
+    admin_id = tenant.settings.admin_id
+    dealer_id = tenant.dealer_id
 
     # 2. Query: autos + cover + count
     query = text("""
@@ -219,14 +228,16 @@ def lista_vetrina_cards(slug: str, db: Session = Depends(get_db)):
           -- cover (priority 1 o più bassa)
           CASE v.media_type
             WHEN 'foto' THEN (SELECT foto FROM azlease_usatoimg WHERE id = v.media_id)
-            WHEN 'ai'   THEN (SELECT public_url FROM usato_leonardo WHERE id = v.media_id)
+            WHEN 'ai'   THEN l.public_url
           END AS cover_url,
+          l.storage_path AS cover_path,
           -- count totale immagini vetrina
           (SELECT COUNT(*) FROM usato_vetrina vv WHERE vv.id_auto = a.id) AS total_media
         FROM azlease_usatoauto a
         JOIN azlease_usatoin i ON i.id = a.id_usatoin
         LEFT JOIN mnet_dettagli_usato d ON d.codice_motornet_uni = a.codice_motornet
         LEFT JOIN v ON v.id_auto = a.id AND v.rn = 1
+        LEFT JOIN usato_leonardo l ON v.media_type = 'ai' AND l.id = v.media_id
         WHERE i.visibile = TRUE
           AND (:dealer_id IS NULL OR i.dealer_id = :dealer_id)
           AND i.admin_id = :admin_id
@@ -235,4 +246,12 @@ def lista_vetrina_cards(slug: str, db: Session = Depends(get_db)):
 
     rows = db.execute(query, {"dealer_id": dealer_id, "admin_id": admin_id}).mappings().all()
 
-    return [dict(r) for r in rows]
+    # cover AI: URL firmata dal servizio, non quella salvata all'upload
+    firmate = url_firmate(db, [r["cover_path"] for r in rows])
+    cards = []
+    for r in rows:
+        card = dict(r)
+        path = card.pop("cover_path")
+        card["cover_url"] = firmate.get(path) or card["cover_url"]
+        cards.append(card)
+    return cards
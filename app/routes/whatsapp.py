@@ -1,17 +1,24 @@
-﻿from fastapi import APIRouter, HTTPException, Depends, Request
+﻿from fastapi import APIRouter, HTTPException, Depends, Request, Response, Query, WebSocket, WebSocketDisconnect
 from pydantic import BaseModel
-from typing import Dict, List
+from typing import Dict, List, Optional
 from app.utils.twilio_client import send_whatsapp_template, send_whatsapp_message
-from app.models import WhatsappSessione, NltMessaggiWhatsapp, Cliente, User, WhatsAppTemplate
+from app.models import WhatsappSessione, NltMessaggiWhatsapp, Cliente, WhatsAppTemplate
 from sqlalchemy.orm import Session
-from sqlalchemy import func, or_, select
+from sqlalchemy import func, text
 from app.database import get_db
 from fastapi_jwt_auth import AuthJWT
 import logging
-from datetime import datetime
+from datetime import datetime, timezone
 from app.auth_helpers import is_admin_user, is_dealer_user, get_admin_id, get_dealer_id
 import os
+import uuid
+import asyncio
 import requests
+from fastapi_jwt_auth.exceptions import AuthJWTException
+from app.database import SessionLocal
+from app.utils.executors import run_db
+from app.utils.whatsapp_eventi import broker_whatsapp, pubblica_evento
+from app.utils.principal_cache import risolvi_principal
 
 
 router = APIRouter(prefix="/api/whatsapp", tags=["WhatsApp"])
@@ -23,6 +30,41 @@ class TemplateRequest(BaseModel):
 class FreeMessageRequest(BaseModel):
     messaggio: str
 
+
+def _serializza_messaggio(m: NltMessaggiWhatsapp) -> dict:
+    return {
+        "id": str(m.id),
+        "mittente": m.mittente,
+        "messaggio": m.messaggio,
+        "data_invio": m.data_invio.isoformat(),
+        "direzione": m.direzione,
+        "template_usato": m.template_usato,
+        "twilio_sid": m.twilio_sid,
+        "utente_id": m.utente_id,
+        "stato_messaggio": m.stato_messaggio
+    }
+
+
+def _nuovo_messaggio(db: Session, sessione: WhatsappSessione, dealer_id: int, **campi) -> NltMessaggiWhatsapp:
+    """Registra il messaggio e pubblica l'evento push (consegnato al commit)."""
+    # id e data valorizzati qui: l'evento non richiede flush/refresh
+    messaggio = NltMessaggiWhatsapp(
+        id=uuid.uuid4(),
+        sessione_id=sessione.id,
+        data_invio=datetime.now(timezone.utc),
+        **campi
+    )
+    sessione.ultimo_aggiornamento = datetime.utcnow()
+    db.add(messaggio)
+    pubblica_evento(db, {
+        "tipo": "messaggio",
+        "sessione_id": str(sessione.id),
+        "dealer_id": dealer_id,
+        "messaggio": _serializza_messaggio(messaggio),
+        "non_letti_delta": 1 if messaggio.direzione == "in" else 0,
+    })
+    return messaggio
+
 @router.post("/sessioni/{sessione_id}/send-template")
 def invia_template_whatsapp(
     sessione_id: str,
@@ -31,7 +73,7 @@ def invia_template_whatsapp(
     db: Session = Depends(get_db)
 ):
     Authorize.jwt_required()
-    utente = db.query(User).filter_by(email=Authorize.get_jwt_subject()).first()
+    utente = risolvi_principal(db, Authorize.get_jwt_subject())
     if not utente:
         raise HTTPException(404, detail="Utente non trovato")
 
@@ -58,8 +100,8 @@ def invia_template_whatsapp(
     if not sid:
         raise HTTPException(500, detail="Errore invio messaggio WhatsApp")
 
-    nuovo_log = NltMessaggiWhatsapp(
-        sessione_id=sessione.id,
+    _nuovo_messaggio(
+        db, sessione, sessione.cliente.dealer_id,
         mittente="utente",
         messaggio=template.descrizione or "Messaggio inviato tramite template",
         twilio_sid=sid,
@@ -67,8 +109,6 @@ def invia_template_whatsapp(
         direzione="out",
         utente_id=utente.id
     )
-    sessione.ultimo_aggiornamento = datetime.utcnow()
-    db.add(nuovo_log)
     db.commit()
 
     return {"status": "ok", "sid": sid, "numero": numero, "template": data.template}
@@ -81,7 +121,7 @@ def invia_messaggio_libero(
     db: Session = Depends(get_db)
 ):
     Authorize.jwt_required()
-    utente = db.query(User).filter_by(email=Authorize.get_jwt_subject()).first()
+    utente = risolvi_principal(db, Authorize.get_jwt_subject())
     if not utente:
         raise HTTPException(404, detail="Utente non trovato")
 
@@ -102,8 +142,8 @@ def invia_messaggio_libero(
     if not sid:
         raise HTTPException(500, detail="Errore invio messaggio WhatsApp")
 
-    nuovo_log = NltMessaggiWhatsapp(
-        sessione_id=sessione.id,
+    _nuovo_messaggio(
+        db, sessione, sessione.cliente.dealer_id,
         mittente="utente",
         messaggio=data.messaggio.strip(),
         twilio_sid=sid,
@@ -111,8 +151,6 @@ def invia_messaggio_libero(
         direzione="out",
         utente_id=utente.id
     )
-    sessione.ultimo_aggiornamento = datetime.utcnow()
-    db.add(nuovo_log)
     db.commit()
 
     return {"status": "ok", "sid": sid, "numero": numero, "messaggio": data.messaggio}
@@ -132,20 +170,7 @@ def get_messaggi_sessione(
         .all()
     )
 
-    return [
-        {
-            "id": str(m.id),
-            "mittente": m.mittente,
-            "messaggio": m.messaggio,
-            "data_invio": m.data_invio.isoformat(),
-            "direzione": m.direzione,
-            "template_usato": m.template_usato,
-            "twilio_sid": m.twilio_sid,
-            "utente_id": m.utente_id,
-            "stato_messaggio": m.stato_messaggio
-        }
-        for m in messaggi
-    ]
+    return [_serializza_messaggio(m) for m in messaggi]
 
 @router.post("/log-inbound")
 async def log_messaggio_inbound(
@@ -179,8 +204,8 @@ async def log_messaggio_inbound(
         db.add(sessione)
         db.flush()
 
-    nuovo_log = NltMessaggiWhatsapp(
-        sessione_id=sessione.id,
+    _nuovo_messaggio(
+        db, sessione, cliente.dealer_id,
         mittente="cliente",
         messaggio=message,
         twilio_sid=msg_sid,
@@ -188,75 +213,88 @@ async def log_messaggio_inbound(
         direzione="in",
         utente_id=None
     )
-    sessione.ultimo_aggiornamento = datetime.utcnow()
-    db.add(nuovo_log)
     db.commit()
 
     return {"status": "ok"}
 
 
+# ⚡ Lista sessioni in UNA query: ultimo messaggio via LATERAL e non letti con
+# subquery correlata, entrambi serviti dagli indici di whatsapp_schema.sql
+LISTA_SESSIONI_SQL = """
+    SELECT
+        s.id,
+        s.numero,
+        s.ultimo_aggiornamento,
+        c.ragione_sociale,
+        c.nome,
+        c.cognome,
+        ultimo.messaggio AS ultimo_messaggio,
+        (
+            SELECT count(*) FROM nlt_messaggi_whatsapp m
+            WHERE m.sessione_id = s.id AND m.direzione = 'in' AND m.stato_messaggio IS NULL
+        ) AS non_letti,
+        COUNT(*) OVER () AS totale
+    FROM public.whatsapp_sessioni s
+    JOIN public.clienti c ON c.id = s.cliente_id
+    LEFT JOIN LATERAL (
+        SELECT m.messaggio FROM nlt_messaggi_whatsapp m
+        WHERE m.sessione_id = s.id
+        ORDER BY m.data_invio DESC
+        LIMIT 1
+    ) ultimo ON true
+    WHERE {filtro}
+    ORDER BY s.ultimo_aggiornamento DESC, s.id
+    OFFSET :offset
+"""
+
+
 @router.get("/sessioni")
 def get_lista_sessioni(
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=500),
+    offset: int = Query(0, ge=0),
     Authorize: AuthJWT = Depends(),
     db: Session = Depends(get_db)
 ):
     Authorize.jwt_required()
     email = Authorize.get_jwt_subject()
 
-    utente = db.query(User).filter_by(email=email).first()
+    utente = risolvi_principal(db, email)
     if not utente:
         raise HTTPException(status_code=404, detail="Utente non trovato")
 
-    sessioni_query = db.query(WhatsappSessione).join(Cliente, WhatsappSessione.cliente_id == Cliente.id)
-
     if is_dealer_user(utente):
-        dealer_id = get_dealer_id(utente)
-        sessioni_query = sessioni_query.filter(Cliente.dealer_id == dealer_id)
+        filtro = "c.dealer_id = :dealer_id"
+        params = {"dealer_id": get_dealer_id(utente)}
 
     elif is_admin_user(utente):
-        admin_id = get_admin_id(utente)
-        membri_team_subq = select(User.id).where(User.parent_id == admin_id)
-        sessioni_query = sessioni_query.filter(
-            or_(
-                Cliente.dealer_id == admin_id,
-                Cliente.dealer_id.in_(membri_team_subq)
-            )
-        )
+        filtro = "(c.dealer_id = :admin_id OR c.dealer_id IN (SELECT u.id FROM public.utenti u WHERE u.parent_id = :admin_id))"
+        params = {"admin_id": get_admin_id(utente)}
 
     else:
         raise HTTPException(status_code=403, detail="Ruolo non autorizzato")
 
-    sessioni = sessioni_query.order_by(WhatsappSessione.ultimo_aggiornamento.desc()).all()
+    sql = LISTA_SESSIONI_SQL.format(filtro=filtro)
+    params["offset"] = offset
+    if limit is not None:
+        sql += "    LIMIT :limit\n"
+        params["limit"] = limit
 
-    risposta = []
-    for s in sessioni:
-        ultimo = (
-            db.query(NltMessaggiWhatsapp)
-            .filter(NltMessaggiWhatsapp.sessione_id == s.id)
-            .order_by(NltMessaggiWhatsapp.data_invio.desc())
-            .first()
-        )
-
-        non_letti = (
-            db.query(func.count())
-            .select_from(NltMessaggiWhatsapp)
-            .filter_by(sessione_id=s.id, direzione="in", stato_messaggio=None)
-            .scalar()
-        )
-
-        cliente = s.cliente
-        nome = cliente.ragione_sociale or f"{cliente.nome} {cliente.cognome}"
+    righe = db.execute(text(sql), params).fetchall()
+    # totale per la paginazione (senza limit coincide con la lunghezza della lista)
+    response.headers["X-Total-Count"] = str(righe[0].totale if righe else 0)
 
-        risposta.append({
-            "sessione_id": str(s.id),
-            "cliente_nome": nome,
-            "numero": s.numero,
-            "ultimo_messaggio": ultimo.messaggio if ultimo else "",
-            "data_ultima_attivita": s.ultimo_aggiornamento.isoformat(),
-            "non_letti": non_letti
-        })
-
-    return risposta
+    return [
+        {
+            "sessione_id": str(r.id),
+            "cliente_nome": r.ragione_sociale or f"{r.nome} {r.cognome}",
+            "numero": r.numero,
+            "ultimo_messaggio": r.ultimo_messaggio or "",
+            "data_ultima_attivita": r.ultimo_aggiornamento.isoformat(),
+            "non_letti": int(r.non_letti)
+        }
+        for r in righe
+    ]
 
 
 @router.get("/messaggi-sessione/{sessione_id}/since/{timestamp}")
@@ -277,17 +315,7 @@ def get_nuovi_messaggi(sessione_id: str, timestamp: str, Authorize: AuthJWT = De
         .all()
     )
 
-    return [{
-        "id": str(m.id),
-        "mittente": m.mittente,
-        "messaggio": m.messaggio,
-        "data_invio": m.data_invio.isoformat(),
-        "direzione": m.direzione,
-        "template_usato": m.template_usato,
-        "twilio_sid": m.twilio_sid,
-        "utente_id": m.utente_id,
-        "stato_messaggio": m.stato_messaggio
-    } for m in messaggi]
+    return [_serializza_messaggio(m) for m in messaggi]
 
 class WhatsAppTemplateOut(BaseModel):
     nome: str
@@ -328,7 +356,7 @@ def sync_twilio_templates(
     Authorize.jwt_required()
 
     # 🔐 Opzionale: limita agli admin
-    utente = db.query(User).filter_by(email=Authorize.get_jwt_subject()).first()
+    utente = risolvi_principal(db, Authorize.get_jwt_subject())
     if not utente or utente.role not in ["admin", "superadmin"]:
         raise HTTPException(403, detail="Accesso non autorizzato")
 
@@ -415,7 +443,85 @@ def segna_sessione_come_letta(
         .update({"stato_messaggio": "letto"})
     )
 
+    if aggiornati:
+        dealer_id = (
+            db.query(Cliente.dealer_id)
+            .join(WhatsappSessione, WhatsappSessione.cliente_id == Cliente.id)
+            .filter(WhatsappSessione.id == sessione_id)
+            .scalar()
+        )
+        pubblica_evento(db, {"tipo": "letti", "sessione_id": sessione_id, "dealer_id": dealer_id, "non_letti": 0})
+
     db.commit()
     return {"status": "ok", "aggiornati": aggiornati}
 
 
+# === Push eventi (sostituisce il polling di /messaggi-sessione/{id}/since/{timestamp}) ===
+# ws(s)://.../api/whatsapp/eventi?token=<JWT>[&sessione_id=<uuid>]
+# Eventi JSON: "messaggio" (con non_letti_delta), "letti", "risincronizza", "ping".
+
+PING_SECONDI = 25
+
+
+def _dealer_visibili(email: str) -> Optional[set]:
+    """Dealer le cui sessioni sono visibili all'utente (come la lista sessioni)."""
+    db = SessionLocal()
+    try:
+        utente = risolvi_principal(db, email)
+        if not utente:
+            return None
+        if is_dealer_user(utente):
+            return {utente.dealer_id}
+        if is_admin_user(utente):
+            return {utente.admin_id, *utente.membri()}
+        return None
+    finally:
+        db.close()
+
+
+async def _attendi_chiusura(websocket: WebSocket):
+    # il client non manda nulla: serve solo ad accorgersi della disconnessione
+    try:
+        while True:
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        return
+
+
+@router.websocket("/eventi")
+async def eventi_whatsapp(
+    websocket: WebSocket,
+    token: str = Query(...),
+    sessione_id: Optional[str] = Query(None),
+    Authorize: AuthJWT = Depends()
+):
+    await websocket.accept()
+    try:
+        Authorize.jwt_required("websocket", token=token)
+        email = Authorize.get_raw_jwt(token)["sub"]
+    except AuthJWTException:
+        await websocket.close(code=1008)
+        return
+
+    dealer_ids = await run_db(_dealer_visibili, email)
+    if not dealer_ids:
+        await websocket.close(code=1008)
+        return
+
+    iscrizione = broker_whatsapp.iscrivi(dealer_ids, sessione_id)
+    chiusura = asyncio.create_task(_attendi_chiusura(websocket))
+    try:
+        while not chiusura.done():
+            prossimo = asyncio.create_task(iscrizione.coda.get())
+            fatti, _ = await asyncio.wait({prossimo, chiusura}, timeout=PING_SECONDI, return_when=asyncio.FIRST_COMPLETED)
+            if prossimo in fatti:
+                await websocket.send_json(prossimo.result())
+                continue
+            prossimo.cancel()
+            if not fatti:
+                await websocket.send_json({"tipo": "ping"})
+    except (WebSocketDisconnect, RuntimeError):
+        pass
+    finally:
+        broker_whatsapp.disiscrivi(iscrizione)
+        chiusura.cancel()
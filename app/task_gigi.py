@@ -1,35 +1,21 @@
 ﻿# tasks_gigi.py
-import logging, os
-from io import BytesIO
-from PIL import Image
+import logging
 from sqlalchemy.orm import Session
 from sqlalchemy import text  # ✅ fix SQLAlchemy
-from app.database import SessionLocal, supabase_client
+from app.database import SessionLocal
 from app.routes.gigigorilla import expand_aliases  
+from app.utils.executors import run_cpu, run_io
+from app.utils.media_encoding import elabora_immagine
+from app.utils.logo_cache import logo_cache
+from app.utils.storage import storage
 from app.routes.openai_config import (
     _gemini_generate_image_sync,
     _fetch_image_base64_from_url,
     _gemini_assert_api
 )
 
-def _apply_logo(final: Image.Image, logo_url: str, h: int, y: int) -> Image.Image:
-    import requests
-    r = requests.get(logo_url, timeout=30); r.raise_for_status()
-    logo = Image.open(BytesIO(r.content)).convert("RGBA")
-    ow, oh = logo.size
-    new_h = max(1, int(h or 100)); new_w = int((ow/oh)*new_h)
-    logo = logo.resize((new_w, new_h))
-    if final.height < new_h + y: raise ValueError(f"image too small for logo offset {y}px")
-    final.paste(logo, ((final.width-new_w)//2, y), logo)
-    return final
-
-def _sb_upload_and_sign_to(bucket: str, path: str, blob: bytes, content_type: str) -> str:
-    supabase_client.storage.from_(bucket).upload(path=path, file=blob,
-        file_options={"content-type": content_type, "upsert":"true"})
-    res = supabase_client.storage.from_(bucket).create_signed_url(path=path, expires_in=60*60*24*30)
-    url = res.get("signedURL") or res.get("signed_url") or res.get("signedUrl")
-    base = os.getenv("SUPABASE_URL","").rstrip("/")
-    return f"{base}{url}" if url and url.startswith("/storage") else url
+async def _sb_upload_and_sign_to(bucket: str, path: str, blob: bytes, content_type: str) -> str:
+    return await storage.upload_e_firma(bucket, path, blob, content_type)
 
 async def processa_gigi_gorilla_jobs():
     db: Session = SessionLocal()
@@ -65,25 +51,17 @@ async def processa_gigi_gorilla_jobs():
                     num_images=j.num_images
                 )
 
+                # download/rivalidazione del logo bloccanti: sul pool io, non sull'event loop
+                logo = await run_io(logo_cache.get, j.logo_url, j.logo_height or 100) if j.logo_url else None
+                formato = "webp" if j.output_format == "webp" else "png"
+
                 done = 0
                 for i, img_bytes in enumerate(imgs):
-                    img = Image.open(BytesIO(img_bytes)).convert("RGBA")
-                    if j.logo_url:
-                        img = _apply_logo(img, j.logo_url, j.logo_height or 100, j.logo_offset_y or 100)
-
-                    buf = BytesIO()
-                    if j.output_format == "webp":
-                        img.save(buf, format="WEBP", quality=90)
-                        mime = "image/webp"
-                        ext = ".webp"
-                    else:
-                        img.save(buf, format="PNG")
-                        mime = "image/png"
-                        ext = ".png"
-                    buf.seek(0)
+                    # byte grezzi Gemini → una decodifica, logo, una codifica
+                    img = (await run_cpu(elabora_immagine, img_bytes, formato, logo, j.logo_offset_y or 100))["originale"]
 
-                    path = f"{j.storage_prefix}{j.id}/{i}{ext}"
-                    url = _sb_upload_and_sign_to(j.bucket, path, buf.getvalue(), mime)
+                    path = f"{j.storage_prefix}{j.id}/{i}{img.estensione}"
+                    url = await _sb_upload_and_sign_to(j.bucket, path, img.dati, img.mime)
 
                     db.execute(text("""
                         insert into public.gigi_gorilla_job_outputs
@@ -91,7 +69,7 @@ async def processa_gigi_gorilla_jobs():
                         values
                             (:job, :idx, 'completed', :url, :path, :mime, :w, :h)
                     """), {
-                        "job": j.id, "idx": i, "url": url, "path": path, "mime": mime,
+                        "job": j.id, "idx": i, "url": url, "path": path, "mime": img.mime,
                         "w": img.width, "h": img.height
                     })
                     done += 1
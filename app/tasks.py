@@ -12,12 +12,14 @@ from app.routes.sync_marche_completo import sync_marche as sync_marche_nuovo
 from app.routes.sync_modelli_nuovo import sync_modelli as sync_modelli_nuovo
 from app.routes.sync_allestimenti_nuovo import sync_allestimenti as sync_allestimenti_nuovo
 from app.routes.sync_dettagli_nuovo import sync_dettagli_auto as sync_dettagli_nuovo
+from app.routes.sync_dettagli_nuovo import sync_dettagli_auto_incrementale as sync_dettagli_nuovo_incrementale
 
 # === Catena USATO ===
 from app.routes.sync_marche_usato import sync_marche_usato as sync_marche_usato
 from app.routes.sync_modelli_usato import sync_modelli_usato as sync_modelli_usato
 from app.routes.sync_allestimenti_usato import sync_allestimenti_usato as sync_allestimenti_usato
 from app.routes.sync_dettagli_usato import sync_dettagli_usato as sync_dettagli_usato
+from app.routes.sync_dettagli_usato import sync_dettagli_usato_incrementale as sync_dettagli_usato_incrementale
 from app.routes.sync_anni_usato import sync_all_marche
 
 
@@ -206,6 +208,33 @@ def aggiorna_rating_convenienza_job():
         db.close()
 
 
+from app.utils.catalogo_nlt import aggiorna_catalogo_nlt, ricostruisci_catalogo_nlt
+
+def aggiorna_catalogo_nlt_job():
+    """Ricalcola il catalogo vetrina degli admin segnati dai trigger."""
+    db = SessionLocal()
+    try:
+        n = aggiorna_catalogo_nlt(db)
+        if n:
+            logging.info(f"📚 Catalogo NLT aggiornato per {n} admin")
+    except Exception as e:
+        logging.error(f"❌ Errore aggiornamento catalogo NLT: {e}")
+    finally:
+        db.close()
+
+
+def ricostruisci_catalogo_nlt_job():
+    """Giro notturno completo: raccoglie anche modifiche a dettagli e immagini Motornet."""
+    db = SessionLocal()
+    try:
+        n = ricostruisci_catalogo_nlt(db)
+        logging.info(f"✅ Catalogo NLT ricostruito per {n} admin")
+    except Exception as e:
+        logging.error(f"❌ Errore ricostruzione catalogo NLT: {e}")
+    finally:
+        db.close()
+
+
 from app.routes.openai_config import _gemini_get_operation, _download_bytes, _sb_upload_and_sign
 from app.models import UsatoLeonardo
 import logging
@@ -266,7 +295,7 @@ async def polla_video_gemini():
                 blob = await _download_bytes(uri)
                 ext = ".mp4"
                 path = f"{str(rec.id_auto)}/{str(rec.id)}{ext}"
-                _, public_url = _sb_upload_and_sign(path, blob, "video/mp4")
+                _, public_url = await _sb_upload_and_sign(path, blob, "video/mp4")
 
                 # Attiva solo se nessun altro attivo
                 other_active = db.query(UsatoLeonardo).filter(
@@ -304,15 +333,8 @@ async def polla_video_gemini():
         db.close()
         logging.warning("✅ Fine polling Gemini video VEO3\n")
 
-import logging
-from io import BytesIO
-from PIL import Image
-import requests
-from collections import defaultdict
-
-from app.database import SessionLocal
-from app.models import UsatoLeonardo
-from app.routes.openai_config import _gemini_generate_image_sync, _sb_upload_and_sign
+from app.utils.immagini_ai_worker import processa_coda_immagini
+from app.utils.url_firmate import rinnova_url_firmate
 
 
 def _put_in_vetrina(db, id_auto: str, media_id: str, priority: int):
@@ -324,135 +346,12 @@ def _put_in_vetrina(db, id_auto: str, media_id: str, priority: int):
     db.commit()
 
 
-MAX_RETRY = 3
-
-def _apply_logo(final: Image.Image, logo_url: str, logo_height: int, offset_y: int) -> Image.Image:
-    """Scarica e applica il logo sull'immagine finale."""
-    r = requests.get(logo_url, timeout=30)
-    r.raise_for_status()
-    logo = Image.open(BytesIO(r.content)).convert("RGBA")
-    ow, oh = logo.size
-    new_h = max(1, int(logo_height or 100))
-    new_w = int((ow / oh) * new_h)
-    logo = logo.resize((new_w, new_h))
-    if final.height < new_h + offset_y:
-        raise ValueError(f"image too small for logo offset {offset_y}px")
-    logo_x = (final.width - new_w) // 2
-    logo_y = offset_y
-    final.paste(logo, (logo_x, logo_y), logo)
-    return final
-
 async def processa_immagini_gemini():
-    logging.info("🚀 INIZIO cronjob processa_immagini_gemini")
-    db = SessionLocal()
+    # claim con SKIP LOCKED + lease per riga, gruppi in parallelo: vedi app/utils/immagini_ai_worker.py
     try:
-        recs = db.query(UsatoLeonardo).filter(
-            UsatoLeonardo.media_type == "image",
-            UsatoLeonardo.status == "queued"
-        ).all()
-
-        logging.info(f"📊 Trovati {len(recs)} record immagine in coda")
-
-        # --- Raggruppa per (id_auto, prompt, subject_url, background_url, logo_url) ---
-        grouped = defaultdict(list)
-        for rec in recs:
-            key = (rec.id_auto, rec.prompt, rec.subject_url, rec.background_url, rec.logo_url)
-            grouped[key].append(rec)
-
-        for key, batch in grouped.items():
-            try:
-                logging.info(f"🟡 Generazione batch da {len(batch)} immagini per auto={batch[0].id_auto}")
-
-                # 1) chiamata Gemini per N immagini
-                responses = await _gemini_generate_image_sync(
-                    batch[0].prompt,
-                    subject_image_url=batch[0].subject_url,
-                    background_image_url=batch[0].background_url,
-                    num_images=len(batch)   # <-- importante
-                )
-
-                # responses = lista di byte immagini
-                if not isinstance(responses, list):
-                    responses = [responses]
-
-                # 2) assegna immagini ai record disponibili
-                for rec, img_bytes in zip(batch, responses):
-                    try:
-                        # 👇 fix: normalizza se Gemini restituisce lista annidata
-                        if isinstance(img_bytes, list):
-                            img_bytes = img_bytes[0]
-                        final = Image.open(BytesIO(img_bytes)).convert("RGBA")
-
-                        # logo opzionale
-                        if rec.logo_url:
-                            final = _apply_logo(final, rec.logo_url, rec.logo_height or 100, rec.logo_offset_y or 100)
-
-                        # salva PNG
-                        buf = BytesIO()
-                        final.save(buf, format="PNG")
-                        buf.seek(0)
-
-                        path = f"{str(rec.id_auto)}/{str(rec.id)}.png"
-                        _, public_url = _sb_upload_and_sign(path, buf.getvalue(), "image/png")
-
-                        rec.public_url = public_url
-                        rec.storage_path = path
-                        rec.status = "completed"
-                        rec.retry_count = 0
-
-                        # 👉 se è Boost e non ancora messa in vetrina
-                        if rec.is_boost and not rec.boost_vetrina_done:
-                            _put_in_vetrina(db, rec.id_auto, rec.id, priority=1)
-                            rec.boost_vetrina_done = True
-
-                        db.commit()
-                        logging.info(f"✅ Immagine completata per rec_id={rec.id} (boost_vetrina_done={rec.boost_vetrina_done})")
-
-
-                    except Exception as e:
-                        db.rollback()
-                        rec.retry_count = (rec.retry_count or 0) + 1
-                        if rec.retry_count >= MAX_RETRY:
-                            rec.status = "failed"
-                        rec.error_message = str(e)
-                        db.commit()
-                        logging.error(f"❌ Errore singolo rec_id={rec.id}: {e}")
-
-                # 3) se Gemini ha restituito meno immagini del richiesto
-                if len(responses) < len(batch):
-                    missing = batch[len(responses):]
-                    for rec in missing:
-                        rec.retry_count = (rec.retry_count or 0) + 1
-                        if rec.retry_count >= MAX_RETRY:
-                            rec.status = "failed"
-                        else:
-                            rec.status = "queued"  # tornerà al prossimo giro
-                        rec.error_message = (
-                            f"Gemini non ha generato abbastanza immagini "
-                            f"(richieste {len(batch)}, ricevute {len(responses)})"
-                        )
-                    db.commit()
-                    logging.warning(
-                        f"⚠️ Ricevute solo {len(responses)} immagini su {len(batch)} "
-                        f"per auto={batch[0].id_auto}"
-                    )
-
-            except Exception as e:
-                db.rollback()
-                for rec in batch:
-                    rec.retry_count = (rec.retry_count or 0) + 1
-                    if rec.retry_count >= MAX_RETRY:
-                        rec.status = "failed"
-                    rec.error_message = str(e)
-                db.commit()
-                logging.error(f"❌ Errore batch {len(batch)} recs per auto={batch[0].id_auto}: {e}")
-
+        await processa_coda_immagini()
     except Exception as e:
-        db.rollback()
         logging.critical(f"🔥 Errore fatale cron immagini: {e}")
-    finally:
-        db.close()
-        logging.info("✅ Fine cronjob immagini Gemini\n")
 
 
 
@@ -475,10 +374,16 @@ scheduler.add_job(sync_all_marche,         'cron', id='usato_anni',         name
 scheduler.add_job(sync_allestimenti_usato, 'cron', id='usato_allestimenti', name='USATO: allestimenti', day_of_week='tue', hour=3,  minute=0, timezone=TZ)
 scheduler.add_job(sync_dettagli_usato,     'cron', id='usato_dettagli',     name='USATO: dettagli',     day_of_week='tue', hour=4,  minute=0, timezone=TZ)
 
+# === Refresh incrementale dettagli (mercoledì): codici scaduti, scrive solo se l'hash cambia ===
+scheduler.add_job(sync_dettagli_nuovo_incrementale, 'cron', id='nuovo_dettagli_incr', name='NUOVO: dettagli incrementale', day_of_week='wed', hour=1, minute=0, timezone=TZ)
+scheduler.add_job(sync_dettagli_usato_incrementale, 'cron', id='usato_dettagli_incr', name='USATO: dettagli incrementale', day_of_week='wed', hour=2, minute=0, timezone=TZ)
+
 # === Altri job già presenti ===
 scheduler.add_job(check_and_charge_services, 'cron', hour=5, minute=0)
 scheduler.add_job(pulisci_modelli_settimanale, 'cron', day_of_week='fri', hour=3, minute=0)
 scheduler.add_job(aggiorna_rating_convenienza_job, 'cron', hour=3, minute=30)
+scheduler.add_job(ricostruisci_catalogo_nlt_job, 'cron', hour=3, minute=50)
+scheduler.add_job(aggiorna_catalogo_nlt_job, 'interval', minutes=1, coalesce=True, max_instances=1)
 scheduler.add_job(aggiorna_usato_settimanale, 'cron', day_of_week='tue', hour=1, minute=0)
 scheduler.add_job(invia_reminder_pipeline, 'interval', minutes=30)
 
@@ -500,6 +405,9 @@ scheduler.add_job(processa_immagini_gemini, IntervalTrigger(seconds=15))
 # Polling Gigi Gorilla immagini ogni 30 secondi
 scheduler.add_job(processa_gigi_gorilla_jobs, 'interval', seconds=15)
 
+# URL firmate dei media in storage: rinnovo in blocco prima della scadenza
+scheduler.add_job(rinnova_url_firmate, 'interval', hours=1, coalesce=True, max_instances=1)
+
 
 
 
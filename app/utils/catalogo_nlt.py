@@ -0,0 +1,277 @@
+import logging
+from typing import Optional
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from app.models import (
+    SiteAdminSettings, NltOfferte, NltQuotazioni, NltOfferteRating, MnetDettagli, MnetModelli
+)
+from app.utils.quotazioni import calcola_quotazioni
+from app.utils.motornet_sync import inserisci_righe
+from app.utils.ricerca import filtro_ricerca
+
+# === Catalogo NLT per tenant (nlt_catalogo_vetrina, vedi nlt_catalogo_schema.sql) ===
+# Una riga per (settings sito, offerta attiva) con canone finale, segmento, carrozzeria,
+# immagine di default e rating già risolti. I trigger su offerte, quotazioni, rating e
+# provvigioni segnano l'admin in nlt_catalogo_da_aggiornare; il job lo ricostruisce
+# per intero (tutti i settings dell'admin) in una transazione.
+
+TABELLA = "public.nlt_catalogo_vetrina"
+BLOCCO_INSERT = 500
+PLACEHOLDER_IMG = "/default-placeholder.png"
+
+
+SEGMENTI_ESCLUSI_TANTI_KM = ["Superutilitarie", "Utilitarie", "SUV piccoli", "Medio-inferiori"]
+
+
+def query_catalogo(
+    settings_id: int,
+    search: Optional[str] = None,
+    marca: Optional[str] = None,
+    budget_max: Optional[float] = None,
+    tipo: Optional[str] = None,
+    segmento: Optional[str] = None,
+    carrozzeria: Optional[str] = None,
+    alimentazione: Optional[str] = None,
+    cambio: Optional[str] = None,
+    prezzo_min: Optional[float] = None,
+    prezzo_max: Optional[float] = None,
+    tanti_km: bool = False,
+    rating_min: Optional[int] = None,
+    id_offerte: Optional[list] = None,
+    order_by: Optional[str] = None,
+    offset: int = 0,
+    limit: Optional[int] = None,
+    count_only: bool = False,
+) -> tuple[str, dict]:
+    """
+    Query della vetrina filtrata sul catalogo del tenant: filtri, ordinamento e
+    totale (COUNT(*) OVER ()) in un solo giro. Restituisce (sql, parametri).
+    """
+    where = ["c.settings_id = :settings_id", "c.canone_mensile IS NOT NULL"]
+    params = {"settings_id": settings_id}
+
+    if rating_min is not None:
+        where.append("c.rating_convenienza >= :rating_min")
+        params["rating_min"] = rating_min
+    ricerca = filtro_ricerca(search, "c.testo_ricerca", "c.search_vector")
+    if ricerca:
+        where.append(ricerca.where)
+        params.update(ricerca.params)
+    if marca:
+        where.append("lower(c.marca) = :marca")
+        params["marca"] = marca.lower().strip()
+    if budget_max:
+        where.append("c.prezzo_listino <= :budget_listino")
+        params["budget_listino"] = budget_max * 60
+    if tipo:
+        tipo_clean = tipo.lower().strip()
+        if tipo_clean == "privato":
+            where.append("c.solo_privati IS TRUE")
+        elif tipo_clean == "business":
+            where.append("c.solo_privati IS FALSE")
+    if segmento or carrozzeria or tanti_km:
+        where.append("c.ha_dettagli")
+    if segmento:
+        where.append("upper(c.segmento_mnet) = :segmento")
+        params["segmento"] = segmento.upper().strip()
+    if carrozzeria:
+        where.append("lower(c.tipo_descrizione) = :carrozzeria")
+        params["carrozzeria"] = carrozzeria.lower().strip()
+    if tanti_km:
+        where.append("c.id_player = 5")
+        where.append("c.canone_60_40 IS NOT NULL")
+        where.append("c.segmento_descrizione <> ALL(:segmenti_esclusi)")
+        params["segmenti_esclusi"] = SEGMENTI_ESCLUSI_TANTI_KM
+    if prezzo_min is not None:
+        where.append("c.prezzo_listino >= :prezzo_min")
+        params["prezzo_min"] = prezzo_min
+    if prezzo_max is not None:
+        where.append("c.prezzo_listino <= :prezzo_max")
+        params["prezzo_max"] = prezzo_max
+    if alimentazione:
+        where.append("lower(c.alimentazione) = :alimentazione")
+        params["alimentazione"] = alimentazione.lower().strip()
+    if cambio:
+        cambio_clean = cambio.lower().strip()
+        if cambio_clean == "manuale":
+            where.append("lower(c.cambio) LIKE '%manuale%'")
+        elif cambio_clean == "automatico":
+            where.append("(lower(c.cambio) LIKE '%automatico%' OR lower(c.cambio) LIKE '%cvt%')")
+    if id_offerte is not None:
+        where.append("c.id_offerta = ANY(:id_offerte)")
+        params["id_offerte"] = list(id_offerte)
+
+    filtri = "\n      AND ".join(where)
+    if count_only:
+        return f"SELECT COUNT(*) FROM {TABELLA} c\n    WHERE {filtri}", params
+
+    if order_by == "rating_desc":
+        ordine = "c.rating_convenienza DESC NULLS LAST, c.id_offerta"
+    elif order_by == "marca_asc":
+        ordine = "c.marca ASC, c.modello ASC, c.id_offerta"
+    elif ricerca:
+        ordine = f"{ricerca.rilevanza} DESC, c.prezzo_listino ASC, c.id_offerta"
+    else:
+        ordine = "c.prezzo_listino ASC, c.id_offerta"
+
+    sql = f"""
+    SELECT c.*, COUNT(*) OVER () AS totale
+    FROM {TABELLA} c
+    WHERE {filtri}
+    ORDER BY {ordine}
+    OFFSET :offset"""
+    params["offset"] = offset
+    if limit is not None:
+        sql += "\n    LIMIT :limit"
+        params["limit"] = limit
+    return sql, params
+
+
+def _righe_offerte(db: Session, admin_id: int) -> list:
+    rows = (
+        db.query(
+            NltOfferte,
+            NltQuotazioni,
+            NltOfferteRating.rating_convenienza,
+            MnetDettagli.segmento,
+            MnetDettagli.segmento_descrizione,
+            MnetDettagli.tipo_descrizione,
+            MnetDettagli.codice_motornet_uni,
+            MnetModelli.default_img,
+        )
+        .join(NltQuotazioni, NltOfferte.id_offerta == NltQuotazioni.id_offerta)
+        .outerjoin(NltOfferteRating, NltOfferte.id_offerta == NltOfferteRating.id_offerta)
+        .outerjoin(MnetDettagli, MnetDettagli.codice_motornet_uni == NltOfferte.codice_motornet)
+        .outerjoin(MnetModelli, MnetModelli.codice_modello == NltOfferte.codice_modello)
+        .filter(
+            NltOfferte.id_admin == admin_id,
+            NltOfferte.attivo.is_(True),
+            NltOfferte.prezzo_listino.isnot(None),
+        )
+        .order_by(NltOfferte.id_offerta, NltQuotazioni.id_quotazione)
+        .all()
+    )
+    # una riga per offerta (la prima quotazione), come chiave primaria del catalogo
+    uniche = {}
+    for r in rows:
+        uniche.setdefault(r[0].id_offerta, r)
+    return list(uniche.values())
+
+
+def ricostruisci_catalogo_admin(db: Session, admin_id: int) -> int:
+    """Ricalcola le righe di catalogo di tutti i siti (admin + dealer) dell'admin. Non fa commit."""
+    settings_list = db.query(SiteAdminSettings).filter(SiteAdminSettings.admin_id == admin_id).all()
+    offerte = _righe_offerte(db, admin_id) if settings_list else []
+    coppie = [(r[0], r[1]) for r in offerte]
+
+    righe = []
+    for settings in settings_list:
+        quotazioni = calcola_quotazioni(db, coppie, settings_corrente=settings)
+        for r, (durata, km, canone, _) in zip(offerte, quotazioni):
+            offerta, quotazione, rating, segmento_mnet, segmento_desc, tipo_desc, codice_det, default_img = r
+            righe.append({
+                "settings_id": settings.id,
+                "id_offerta": offerta.id_offerta,
+                "admin_id": admin_id,
+                "slug": offerta.slug,
+                "marca": offerta.marca,
+                "modello": offerta.modello,
+                "versione": offerta.versione,
+                "cambio": offerta.cambio,
+                "alimentazione": offerta.alimentazione,
+                "segmento": offerta.segmento,
+                "segmento_mnet": segmento_mnet,
+                "segmento_descrizione": segmento_desc,
+                "tipo_descrizione": tipo_desc,
+                "id_player": offerta.id_player,
+                "solo_privati": bool(offerta.solo_privati),
+                "prezzo_listino": offerta.prezzo_listino,
+                "prezzo_totale": offerta.prezzo_totale,
+                "canone_mensile": canone,
+                "durata_mesi": durata,
+                "km_inclusi": km,
+                "canone_60_40": quotazione.mesi_60_40,
+                "ha_dettagli": codice_det is not None,
+                "immagine": default_img or PLACEHOLDER_IMG,
+                "rating_convenienza": rating,
+            })
+
+    db.execute(text(f"DELETE FROM {TABELLA} WHERE admin_id = :admin_id"), {"admin_id": admin_id})
+    for i in range(0, len(righe), BLOCCO_INSERT):
+        inserisci_righe(db, TABELLA, righe[i:i + BLOCCO_INSERT])
+    return len(righe)
+
+
+def aggiorna_catalogo_nlt(db: Session, max_admin: int = 50) -> int:
+    """
+    Svuota la coda nlt_catalogo_da_aggiornare: un admin per transazione,
+    preso con SKIP LOCKED (più worker non si pestano i piedi).
+    Se la ricostruzione fallisce l'admin torna in fondo alla coda e si passa al successivo.
+    """
+    aggiornati, falliti = 0, set()
+    for _ in range(max_admin):
+        admin_id = db.execute(text("""
+            DELETE FROM public.nlt_catalogo_da_aggiornare
+            WHERE admin_id = (
+                SELECT admin_id FROM public.nlt_catalogo_da_aggiornare
+                ORDER BY segnato_il
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING admin_id
+        """)).scalar()
+        if admin_id is None:
+            break
+        if admin_id in falliti:
+            # in coda restano solo admin già falliti in questo giro
+            db.rollback()
+            break
+        try:
+            righe = ricostruisci_catalogo_admin(db, admin_id)
+            db.commit()
+            aggiornati += 1
+            logging.info(f"📚 Catalogo NLT admin {admin_id}: {righe} righe")
+        except Exception as e:
+            db.rollback()
+            logging.error(f"❌ Catalogo NLT admin {admin_id} non aggiornato: {e}")
+            # il rollback lo rimette in testa (segnato_il originale): in fondo, così non blocca gli altri
+            falliti.add(admin_id)
+            db.execute(text("""
+                UPDATE public.nlt_catalogo_da_aggiornare SET segnato_il = now() WHERE admin_id = :admin_id
+            """), {"admin_id": admin_id})
+            db.commit()
+    return aggiornati
+
+
+def ricostruisci_catalogo_nlt(db: Session) -> int:
+    """Ricostruzione completa (backfill e giro notturno): mette in coda tutti gli admin con un sito."""
+    db.execute(text("""
+        INSERT INTO public.nlt_catalogo_da_aggiornare (admin_id)
+        SELECT DISTINCT admin_id FROM public.site_admin_settings
+        ON CONFLICT DO NOTHING
+    """))
+    # admin spariti: via le loro righe
+    db.execute(text(f"""
+        DELETE FROM {TABELLA} c
+        WHERE NOT EXISTS (SELECT 1 FROM public.site_admin_settings s WHERE s.id = c.settings_id)
+    """))
+    db.commit()
+
+    totale = 0
+    while True:
+        n = aggiorna_catalogo_nlt(db)
+        totale += n
+        if n == 0:
+            return totale
+
+
+if __name__ == "__main__":
+    # Backfill:  python -m app.utils.catalogo_nlt
+    from app.database import SessionLocal
+
+    logging.basicConfig(level=logging.INFO)
+    db = SessionLocal()
+    try:
+        print(f"✅ Catalogo NLT ricostruito per {ricostruisci_catalogo_nlt(db)} admin")
+    finally:
+        db.close()
@@ -0,0 +1,251 @@
+import os
+import logging
+import threading
+from datetime import datetime
+from typing import Optional
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from app.database import SessionLocal
+
+# === Ingestione click write-behind (click offerta e click vetrina) ===
+# Gli endpoint pubblici /click e /analytics/click-vetrina accodano in memoria e
+# rispondono subito; un thread dedicato scrive a lotti con un INSERT multi-riga
+# (unnest di array) quando il buffer supera CLICK_FLUSH_RIGHE o ogni CLICK_FLUSH_SECONDI.
+# Lo stesso statement incrementa i contatori giornalieri (click_rollup_schema.sql).
+# Allo shutdown il buffer viene svuotato. Una sola connessione per flush,
+# invece di una per click presa dal pool condiviso.
+# Un lotto che fallisce resta sospeso e si riprova da solo (i click nuovi non lo
+# aspettano); dopo CLICK_MAX_TENTATIVI si divide a metà finché le righe che
+# falliscono restano isolate: quelle si loggano e si scartano, le altre si scrivono.
+# Errori di connessione (OperationalError) non scartano nulla.
+
+CLICK_FLUSH_SECONDI = float(os.getenv("CLICK_FLUSH_SECONDI", "2"))
+CLICK_FLUSH_RIGHE = int(os.getenv("CLICK_FLUSH_RIGHE", "500"))
+CLICK_BUFFER_MAX = int(os.getenv("CLICK_BUFFER_MAX", "50000"))  # oltre si scarta (e si conta)
+CLICK_MAX_TENTATIVI = int(os.getenv("CLICK_MAX_TENTATIVI", "3"))
+
+# Click offerta: le offerte sparite nel frattempo vengono saltate, non fanno fallire il lotto
+INSERT_CLICK_OFFERTE = text("""
+    WITH inseriti AS (
+        INSERT INTO nlt_offerte_click (id_offerta, id_dealer, clicked_at)
+        SELECT c.id_offerta, c.id_dealer, c.clicked_at
+        FROM unnest(
+            CAST(:id_offerta AS integer[]),
+            CAST(:id_dealer AS integer[]),
+            CAST(:clicked_at AS timestamp[])
+        ) AS c(id_offerta, id_dealer, clicked_at)
+        WHERE EXISTS (SELECT 1 FROM nlt_offerte o WHERE o.id_offerta = c.id_offerta)
+        RETURNING id_offerta, id_dealer, clicked_at
+    )
+    INSERT INTO nlt_offerte_click_giorno AS g (giorno, id_offerta, id_dealer, click)
+    SELECT clicked_at::date, id_offerta, id_dealer, count(*)
+    FROM inseriti
+    GROUP BY 1, 2, 3
+    ON CONFLICT (giorno, id_offerta, id_dealer) DO UPDATE SET click = g.click + EXCLUDED.click
+""")
+
+INSERT_CLICK_VETRINA = text("""
+    WITH inseriti AS (
+        INSERT INTO nlt_vetrina_click (id_dealer, evento, ip, user_agent, referrer, clicked_at)
+        SELECT * FROM unnest(
+            CAST(:id_dealer AS integer[]),
+            CAST(:evento AS varchar[]),
+            CAST(:ip AS varchar[]),
+            CAST(:user_agent AS text[]),
+            CAST(:referrer AS text[]),
+            CAST(:clicked_at AS timestamp[])
+        )
+        RETURNING id_dealer, clicked_at
+    )
+    INSERT INTO nlt_vetrina_click_giorno AS g (giorno, id_dealer, click)
+    SELECT clicked_at::date, id_dealer, count(*)
+    FROM inseriti
+    GROUP BY 1, 2
+    ON CONFLICT (giorno, id_dealer) DO UPDATE SET click = g.click + EXCLUDED.click
+""")
+
+
+def _colonne(righe: list, nomi: tuple) -> dict:
+    return {nome: [r[i] for r in righe] for i, nome in enumerate(nomi)}
+
+
+class ClickBuffer:
+    def __init__(self, flush_secondi: float = CLICK_FLUSH_SECONDI, flush_righe: int = CLICK_FLUSH_RIGHE,
+                 massimo: int = CLICK_BUFFER_MAX):
+        self.flush_secondi = flush_secondi
+        self.flush_righe = flush_righe
+        self.massimo = massimo
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._offerte: list = []
+        self._vetrina: list = []
+        self._sospesi_offerte: list = []   # lotto fallito, riprovato a parte
+        self._sospesi_vetrina: list = []
+        self._tentativi = 0
+        self._sveglia = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.accodati = 0
+        self.scritti = 0
+        self.scartati = 0
+        self.errori = 0
+
+    # --- lato richiesta: solo append in memoria
+
+    def _in_coda(self) -> int:
+        return (len(self._offerte) + len(self._vetrina)
+                + len(self._sospesi_offerte) + len(self._sospesi_vetrina))
+
+    def _accoda(self, coda: list, riga: tuple):
+        with self._lock:
+            if self._in_coda() >= self.massimo:
+                self.scartati += 1
+                return
+            coda.append(riga)
+            self.accodati += 1
+            pieno = len(self._offerte) + len(self._vetrina) >= self.flush_righe
+        if pieno:
+            self._sveglia.set()
+
+    def click_offerta(self, id_offerta: int, id_dealer: int):
+        self._accoda(self._offerte, (id_offerta, id_dealer, datetime.utcnow()))
+
+    def click_vetrina(self, id_dealer: int, evento: str, ip: Optional[str], user_agent: Optional[str],
+                      referrer: Optional[str]):
+        self._accoda(self._vetrina, (id_dealer, evento, ip, user_agent, referrer, datetime.utcnow()))
+
+    # --- lato writer
+
+    @staticmethod
+    def _scrivi(offerte: list, vetrina: list):
+        db = SessionLocal()
+        try:
+            if offerte:
+                db.execute(INSERT_CLICK_OFFERTE, _colonne(offerte, ("id_offerta", "id_dealer", "clicked_at")))
+            if vetrina:
+                db.execute(INSERT_CLICK_VETRINA, _colonne(
+                    vetrina, ("id_dealer", "evento", "ip", "user_agent", "referrer", "clicked_at")
+                ))
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def _isola(self, righe: list, vetrina: bool) -> tuple:
+        """
+        Bisezione di un lotto che continua a fallire: scrive i pezzi buoni, scarta le singole
+        righe che falliscono. Restituisce (scritte, rimaste): rimaste se cade la connessione.
+        """
+        scritte, pezzi = 0, [righe] if righe else []
+        while pezzi:
+            pezzo = pezzi.pop()
+            try:
+                self._scrivi([] if vetrina else pezzo, pezzo if vetrina else [])
+                scritte += len(pezzo)
+            except OperationalError as e:
+                logging.error(f"❌ Flush click: connessione persa durante l'isolamento ({e})")
+                return scritte, [r for p in pezzi for r in p] + pezzo
+            except Exception as e:
+                if len(pezzo) == 1:
+                    self.scartati += 1
+                    logging.error(f"❌ Click scartato dopo {CLICK_MAX_TENTATIVI} tentativi: {pezzo[0]} ({e})")
+                    continue
+                meta = len(pezzo) // 2
+                pezzi += [pezzo[meta:], pezzo[:meta]]
+        return scritte, []
+
+    def _ritenta_sospesi(self) -> int:
+        offerte, vetrina = self._sospesi_offerte, self._sospesi_vetrina
+        if not offerte and not vetrina:
+            return 0
+
+        if self._tentativi < CLICK_MAX_TENTATIVI:
+            try:
+                self._scrivi(offerte, vetrina)
+                rimaste_offerte, rimaste_vetrina = [], []
+                scritte = len(offerte) + len(vetrina)
+            except Exception as e:
+                self._tentativi += 1
+                self.errori += 1
+                logging.error(f"❌ Lotto click sospeso, tentativo {self._tentativi} fallito: {e}")
+                return 0
+        else:
+            scritte, rimaste_offerte = self._isola(offerte, vetrina=False)
+            if rimaste_offerte:
+                rimaste_vetrina = vetrina
+            else:
+                scritte_vetrina, rimaste_vetrina = self._isola(vetrina, vetrina=True)
+                scritte += scritte_vetrina
+
+        with self._lock:
+            self._sospesi_offerte, self._sospesi_vetrina = rimaste_offerte, rimaste_vetrina
+            if not rimaste_offerte and not rimaste_vetrina:
+                self._tentativi = 0
+        return scritte
+
+    def flush(self) -> int:
+        """Scrive il lotto sospeso (se c'è) e il buffer corrente. Restituisce le righe scritte."""
+        with self._flush_lock:
+            with self._lock:
+                offerte, self._offerte = self._offerte, []
+                vetrina, self._vetrina = self._vetrina, []
+
+            scritte = self._ritenta_sospesi()
+            if offerte or vetrina:
+                try:
+                    self._scrivi(offerte, vetrina)
+                    scritte += len(offerte) + len(vetrina)
+                except Exception as e:
+                    self.errori += 1
+                    logging.error(f"❌ Flush click fallito ({len(offerte)} offerte, {len(vetrina)} vetrina): {e}")
+                    # il lotto passa tra i sospesi: riprovato a parte, poi isolato
+                    with self._lock:
+                        if not self._sospesi_offerte and not self._sospesi_vetrina:
+                            self._tentativi = 1
+                        self._sospesi_offerte += offerte
+                        self._sospesi_vetrina += vetrina
+            self.scritti += scritte
+            return scritte
+
+    def _ciclo(self):
+        while not self._stop.is_set():
+            self._sveglia.wait(self.flush_secondi)
+            self._sveglia.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"❌ Writer click: {e}")
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._ciclo, name="click-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Ferma il writer e svuota il buffer (shutdown)."""
+        self._stop.set()
+        self._sveglia.set()
+        if self._thread:
+            self._thread.join(timeout=10)
+        scritti = self.flush()
+        logging.info(f"🛑 Writer click fermato, ultimi {scritti} click scritti")
+
+    def metrics(self) -> dict:
+        with self._lock:
+            in_coda = self._in_coda()
+            sospesi = len(self._sospesi_offerte) + len(self._sospesi_vetrina)
+        return {
+            "in_coda": in_coda,
+            "sospesi": sospesi,
+            "accodati": self.accodati,
+            "scritti": self.scritti,
+            "scartati": self.scartati,
+            "errori": self.errori,
+        }
+
+
+click_buffer = ClickBuffer()
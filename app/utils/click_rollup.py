@@ -0,0 +1,58 @@
+import logging
+from datetime import date
+from typing import Optional
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+# === Contatori giornalieri dei click (vedi click_rollup_schema.sql) ===
+# In esercizio li incrementa il writer dei click (app/utils/click_buffer.py).
+# Qui la ricostruzione dallo storico: backfill iniziale o riallineamento di un periodo.
+
+
+def ricostruisci_rollup_click(db: Session, dal: Optional[date] = None) -> dict:
+    """
+    Ricalcola i contatori dallo storico nlt_offerte_click / nlt_vetrina_click
+    (tutto, oppure dal giorno `dal` in poi) in una transazione.
+    Il lock blocca i flush del writer finché non ha finito: nessun click contato due volte.
+    """
+    filtro = "WHERE clicked_at >= :dal" if dal else ""
+    filtro_giorno = "WHERE giorno >= :dal" if dal else ""
+    params = {"dal": dal} if dal else {}
+
+    db.execute(text("LOCK TABLE nlt_offerte_click_giorno, nlt_vetrina_click_giorno IN SHARE ROW EXCLUSIVE MODE"))
+
+    db.execute(text(f"DELETE FROM nlt_offerte_click_giorno {filtro_giorno}"), params)
+    offerte = db.execute(text(f"""
+        INSERT INTO nlt_offerte_click_giorno (giorno, id_offerta, id_dealer, click)
+        SELECT clicked_at::date, id_offerta, id_dealer, count(*)
+        FROM nlt_offerte_click
+        {filtro}
+        GROUP BY 1, 2, 3
+    """), params).rowcount
+
+    db.execute(text(f"DELETE FROM nlt_vetrina_click_giorno {filtro_giorno}"), params)
+    vetrina = db.execute(text(f"""
+        INSERT INTO nlt_vetrina_click_giorno (giorno, id_dealer, click)
+        SELECT clicked_at::date, id_dealer, count(*)
+        FROM nlt_vetrina_click
+        {filtro}
+        GROUP BY 1, 2
+    """), params).rowcount
+
+    db.commit()
+    return {"offerte": offerte, "vetrina": vetrina}
+
+
+if __name__ == "__main__":
+    # Backfill:  python -m app.utils.click_rollup [AAAA-MM-GG]
+    import sys
+    from app.database import SessionLocal
+
+    logging.basicConfig(level=logging.INFO)
+    dal = date.fromisoformat(sys.argv[1]) if len(sys.argv) > 1 else None
+    db = SessionLocal()
+    try:
+        righe = ricostruisci_rollup_click(db, dal)
+        print(f"✅ Contatori click ricostruiti: {righe['offerte']} righe offerte, {righe['vetrina']} righe vetrina")
+    finally:
+        db.close()
@@ -5,11 +5,34 @@ from email.utils import formataddr
 from sqlalchemy.orm import Session
 from app.models import SmtpSettings, User
 from app.database import SessionLocal
+from app.utils.executors import run_io
 
 def get_smtp_settings(admin_id: int, db: Session):
     return db.query(SmtpSettings).filter(SmtpSettings.admin_id == admin_id).first()
 
 
+def invia_messaggio(smtp_settings: SmtpSettings, msg):
+    """Connessione SMTP (SSL o STARTTLS), login e invio. Bloccante: dagli handler async usare invia_messaggio_async."""
+    if smtp_settings.use_ssl:
+        server = smtplib.SMTP_SSL(smtp_settings.smtp_host, smtp_settings.smtp_port)
+    else:
+        server = smtplib.SMTP(smtp_settings.smtp_host, smtp_settings.smtp_port)
+        server.starttls()
+
+    server.login(smtp_settings.smtp_user, smtp_settings.smtp_password)
+    server.send_message(msg)
+    server.quit()
+
+
+async def invia_messaggio_async(smtp_settings: SmtpSettings, msg):
+    await run_io(invia_messaggio, smtp_settings, msg)
+
+
+async def send_email_async(admin_id: int, to_email: str, subject: str, body: str):
+    """send_email nel pool I/O: l'invio SMTP non blocca l'event loop."""
+    await run_io(send_email, admin_id, to_email, subject, body)
+
+
 def send_reset_email(admin_id: int, to_email: str, token: str):
     db = SessionLocal()
 
@@ -36,15 +59,7 @@ def send_reset_email(admin_id: int, to_email: str, token: str):
     msg["To"] = to_email
 
     try:
-        if smtp_settings.use_ssl:
-            server = smtplib.SMTP_SSL(smtp_settings.smtp_host, smtp_settings.smtp_port)
-        else:
-            server = smtplib.SMTP(smtp_settings.smtp_host, smtp_settings.smtp_port)
-            server.starttls()
-
-        server.login(smtp_settings.smtp_user, smtp_settings.smtp_password)
-        server.send_message(msg)
-        server.quit()
+        invia_messaggio(smtp_settings, msg)
         print("✅ Email inviata correttamente a", to_email)
     except Exception as e:
         print("❌ Errore invio email:", e)
@@ -85,15 +100,7 @@ def send_email(admin_id: int, to_email: str, subject: str, body: str):
     msg.attach(html_part)
 
     try:
-        if smtp_settings.use_ssl:
-            server = smtplib.SMTP_SSL(smtp_settings.smtp_host, smtp_settings.smtp_port)
-        else:
-            server = smtplib.SMTP(smtp_settings.smtp_host, smtp_settings.smtp_port)
-            server.starttls()
-
-        server.login(smtp_settings.smtp_user, smtp_settings.smtp_password)
-        server.send_message(msg)
-        server.quit()
+        invia_messaggio(smtp_settings, msg)
         print("✅ Email inviata correttamente a", to_email)
     except Exception as e:
         print("❌ Errore invio email:", e)
@@ -0,0 +1,117 @@
+import os
+import sys
+import time
+import asyncio
+import logging
+import functools
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+# === Pool di esecuzione per il codice bloccante chiamato da handler async ===
+# Tre pool separati e limitati, così un tipo di carico non affama gli altri:
+# - io:  HTTP sincrono (requests), SMTP, storage Supabase
+# - cpu: PIL / rembg (rilasciano in gran parte il GIL)
+# - db:  sessioni SQLAlchemy sincrone (dimensionato sul pool di connessioni)
+#
+#   risposta = await run_io(requests.get, url, timeout=30)
+#   png = await run_cpu(ensure_transparency, img_bytes)
+
+IO_WORKERS = int(os.getenv("EXECUTOR_IO_WORKERS", "32"))
+CPU_WORKERS = int(os.getenv("EXECUTOR_CPU_WORKERS", str(max(2, os.cpu_count() or 2))))
+DB_WORKERS = int(os.getenv("EXECUTOR_DB_WORKERS", "10"))  # ≤ pool_size + max_overflow del engine
+
+io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="io")
+cpu_executor = ThreadPoolExecutor(max_workers=CPU_WORKERS, thread_name_prefix="cpu")
+db_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="db")
+
+
+async def _run(executor: ThreadPoolExecutor, fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(fn, *args, **kwargs))
+
+
+async def run_io(fn, *args, **kwargs):
+    return await _run(io_executor, fn, *args, **kwargs)
+
+
+async def run_cpu(fn, *args, **kwargs):
+    return await _run(cpu_executor, fn, *args, **kwargs)
+
+
+async def run_db(fn, *args, **kwargs):
+    return await _run(db_executor, fn, *args, **kwargs)
+
+
+def shutdown_executors():
+    for ex in (io_executor, cpu_executor, db_executor):
+        ex.shutdown(wait=False, cancel_futures=True)
+
+
+# === Monitor del lag dell'event loop ===
+# Un task sul loop aggiorna un battito ogni `interval`; un thread watchdog
+# controlla il battito e, se il loop è fermo da più di `threshold`, logga lo
+# stack del thread del loop: è esattamente il codice che lo sta bloccando.
+
+LOOP_LAG_THRESHOLD = float(os.getenv("LOOP_LAG_THRESHOLD_MS", "200")) / 1000
+LOOP_LAG_INTERVAL = 0.1
+
+
+class LoopLagMonitor:
+    def __init__(self, threshold: float = LOOP_LAG_THRESHOLD, interval: float = LOOP_LAG_INTERVAL):
+        self.threshold = threshold
+        self.interval = interval
+        self.max_lag = 0.0
+        self.stalli = 0
+        self._battito = time.monotonic()
+        self._loop_thread_id = None
+        self._task = None
+        self._stop = threading.Event()
+        self._watchdog = None
+
+    async def _battiti(self):
+        while True:
+            atteso = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = time.monotonic() - atteso
+            self.max_lag = max(self.max_lag, lag)
+            self._battito = time.monotonic()
+            if lag > self.threshold:
+                logging.warning(f"🐢 Event loop in ritardo di {lag * 1000:.0f} ms")
+
+    def _sorveglia(self):
+        segnalato = None
+        while not self._stop.wait(self.interval):
+            fermo = time.monotonic() - self._battito
+            if fermo <= self.threshold:
+                segnalato = None
+                continue
+            if segnalato == self._battito:
+                continue  # stesso stallo già loggato
+            segnalato = self._battito
+            self.stalli += 1
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else "(stack non disponibile)"
+            logging.warning(f"🧱 Event loop bloccato da {fermo * 1000:.0f} ms, stack del loop:\n{stack}")
+
+    def start(self):
+        self._loop_thread_id = threading.get_ident()
+        self._battito = time.monotonic()
+        self._task = asyncio.get_running_loop().create_task(self._battiti())
+        self._watchdog = threading.Thread(target=self._sorveglia, name="loop-lag-watchdog", daemon=True)
+        self._watchdog.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+
+    def metrics(self) -> dict:
+        return {
+            "max_lag_ms": round(self.max_lag * 1000, 1),
+            "stalli": self.stalli,
+            "threshold_ms": round(self.threshold * 1000),
+        }
+
+
+loop_lag_monitor = LoopLagMonitor()
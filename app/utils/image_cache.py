@@ -0,0 +1,249 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+import httpx
+
+from app.utils.executors import run_io
+
+# === Cache immagini Imagin a due livelli ===
+# 1) LRU in memoria con budget in byte
+# 2) disco (IMAGE_CACHE_DIR), sopravvive ai riavvii del processo; budget in byte
+#    anche qui: oltre IMAGE_CACHE_DISK_MB si eliminano i file usati meno di recente
+#    (mtime, aggiornato a ogni hit) fino a tornare al 90% del budget
+# Chiave = parametri normalizzati della richiesta; l'ETag viaggia con l'entry
+# così un If-None-Match risponde 304 senza toccare DB né CDN.
+
+IMAGE_CACHE_MEM_BYTES = int(os.getenv("IMAGE_CACHE_MEM_MB", "64")) * 1024 * 1024
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", "/tmp/core_api_image_cache")
+IMAGE_CACHE_DISK_BYTES = int(os.getenv("IMAGE_CACHE_DISK_MB", "1024")) * 1024 * 1024
+IMAGE_CACHE_TTL = int(os.getenv("IMAGE_CACHE_TTL", str(7 * 24 * 3600)))
+IMAGE_MAX_BYTES = 5 * 1024 * 1024  # oltre non si mette in cache (solo streaming)
+
+
+@dataclass
+class ImmagineCache:
+    content: bytes
+    content_type: str
+    etag: str
+    salvata_il: float
+
+    def scaduta(self) -> bool:
+        return time.time() - self.salvata_il > IMAGE_CACHE_TTL
+
+
+def chiave_immagine(codice_modello: str, angle: int, width: int, random_paint: str,
+                    surrounding: Optional[str], view_point: Optional[str]) -> str:
+    return "|".join([
+        codice_modello.strip().upper(),
+        str(angle),
+        str(width),
+        (random_paint or "").strip().lower(),
+        (surrounding or "").strip().lower(),
+        (view_point or "").strip().lower(),
+    ])
+
+
+def calcola_etag(chiave: str, versione: str) -> str:
+    """ETag forte da chiave + versione upstream (ETag/Last-Modified/lunghezza del CDN)."""
+    return '"' + hashlib.sha1(f"{chiave}#{versione}".encode("utf-8")).hexdigest() + '"'
+
+
+def etag_corrisponde(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidati = [t.strip() for t in if_none_match.split(",")]
+    return "*" in candidati or etag in candidati or f"W/{etag}" in candidati
+
+
+class ImageCache:
+    def __init__(self, budget: int = IMAGE_CACHE_MEM_BYTES, directory: str = IMAGE_CACHE_DIR,
+                 budget_disco: int = IMAGE_CACHE_DISK_BYTES):
+        self.budget = budget
+        self.directory = directory
+        self.budget_disco = budget_disco
+        self._lru: "OrderedDict[str, ImmagineCache]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._lock_disco = threading.Lock()
+        self._bytes_disco: Optional[int] = None  # calcolato alla prima scrittura
+        self.hit_mem = 0
+        self.hit_disco = 0
+        self.miss = 0
+        self.rimossi_disco = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    # --- memoria ---
+
+    def _mem_get(self, chiave: str) -> Optional[ImmagineCache]:
+        with self._lock:
+            entry = self._lru.get(chiave)
+            if entry is None:
+                return None
+            if entry.scaduta():
+                self._rimuovi(chiave)
+                return None
+            self._lru.move_to_end(chiave)
+            return entry
+
+    def _mem_put(self, chiave: str, entry: ImmagineCache):
+        size = len(entry.content)
+        if size > self.budget // 4:
+            return
+        with self._lock:
+            if chiave in self._lru:
+                self._rimuovi(chiave)
+            self._lru[chiave] = entry
+            self._bytes += size
+            while self._bytes > self.budget and self._lru:
+                vecchia, _ = next(iter(self._lru.items()))
+                self._rimuovi(vecchia)
+
+    def _rimuovi(self, chiave: str):
+        entry = self._lru.pop(chiave, None)
+        if entry is not None:
+            self._bytes -= len(entry.content)
+
+    # --- disco ---
+
+    def _percorso(self, chiave: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(chiave.encode("utf-8")).hexdigest())
+
+    def _disco_get(self, chiave: str) -> Optional[ImmagineCache]:
+        base = self._percorso(chiave)
+        try:
+            with open(base + ".json", "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta.get("chiave") != chiave:
+                return None
+            with open(base + ".bin", "rb") as f:
+                content = f.read()
+        except (OSError, ValueError):
+            return None
+        entry = ImmagineCache(content, meta["content_type"], meta["etag"], meta["salvata_il"])
+        if entry.scaduta():
+            return None
+        try:
+            os.utime(base + ".bin")  # usata ora: ultima a essere eliminata
+        except OSError:
+            pass
+        return entry
+
+    def _file_disco(self) -> list:
+        """[(mtime, size, base)] delle entry su disco."""
+        voci = []
+        with os.scandir(self.directory) as it:
+            for f in it:
+                if not f.name.endswith(".bin"):
+                    continue
+                try:
+                    st = f.stat()
+                except OSError:
+                    continue
+                voci.append((st.st_mtime, st.st_size, f.path[:-len(".bin")]))
+        return voci
+
+    def _elimina_disco(self, base: str):
+        for estensione in (".json", ".bin"):
+            try:
+                os.remove(base + estensione)
+            except OSError:
+                pass
+
+    def _rispetta_budget_disco(self, aggiunti: int):
+        with self._lock_disco:
+            if self._bytes_disco is None:
+                self._bytes_disco = sum(size for _, size, _ in self._file_disco())
+            else:
+                self._bytes_disco += aggiunti
+            if self._bytes_disco <= self.budget_disco:
+                return
+            # LRU per mtime: via le più vecchie fino al 90% del budget
+            voci = sorted(self._file_disco())
+            totale = sum(size for _, size, _ in voci)
+            obiettivo = int(self.budget_disco * 0.9)
+            for _, size, base in voci:
+                if totale <= obiettivo:
+                    break
+                self._elimina_disco(base)
+                totale -= size
+                self.rimossi_disco += 1
+            self._bytes_disco = totale
+
+    def _disco_put(self, chiave: str, entry: ImmagineCache):
+        base = self._percorso(chiave)
+        try:
+            precedente = os.path.getsize(base + ".bin") if os.path.exists(base + ".bin") else 0
+            # scrittura atomica: prima il .bin, poi il .json che lo rende visibile
+            with open(base + ".bin.tmp", "wb") as f:
+                f.write(entry.content)
+            os.replace(base + ".bin.tmp", base + ".bin")
+            with open(base + ".json.tmp", "w", encoding="utf-8") as f:
+                json.dump({"chiave": chiave, "content_type": entry.content_type,
+                           "etag": entry.etag, "salvata_il": entry.salvata_il}, f)
+            os.replace(base + ".json.tmp", base + ".json")
+            self._rispetta_budget_disco(len(entry.content) - precedente)
+        except OSError as e:
+            logging.warning(f"⚠️ Cache immagini su disco non scrivibile: {e}")
+
+    # --- API ---
+
+    async def get(self, chiave: str) -> Optional[ImmagineCache]:
+        entry = self._mem_get(chiave)
+        if entry is not None:
+            self.hit_mem += 1
+            return entry
+        entry = await run_io(self._disco_get, chiave)
+        if entry is not None:
+            self.hit_disco += 1
+            self._mem_put(chiave, entry)
+            return entry
+        self.miss += 1
+        return None
+
+    async def put(self, chiave: str, entry: ImmagineCache):
+        self._mem_put(chiave, entry)
+        await run_io(self._disco_put, chiave, entry)
+
+    def metrics(self) -> dict:
+        return {
+            "hit_mem": self.hit_mem,
+            "hit_disco": self.hit_disco,
+            "miss": self.miss,
+            "entries_mem": len(self._lru),
+            "bytes_mem": self._bytes,
+            "budget_mem": self.budget,
+            "bytes_disco": self._bytes_disco,
+            "budget_disco": self.budget_disco,
+            "rimossi_disco": self.rimossi_disco,
+        }
+
+
+image_cache = ImageCache()
+
+# Client HTTP condiviso verso il CDN (pool di connessioni keep-alive)
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(30.0, connect=10.0),
+            limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+            follow_redirects=True,
+        )
+    return _http_client
+
+
+async def chiudi_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
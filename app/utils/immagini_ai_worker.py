@@ -0,0 +1,313 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from collections import defaultdict
+from typing import Optional
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from app.database import SessionLocal
+from app.utils.executors import run_cpu, run_db, run_io
+from app.utils.job_lease import HOLDER_ID
+from app.utils.logo_cache import logo_cache
+from app.utils.storage import storage
+from app.utils.url_firmate import BUCKET_MEDIA_AI, registra_firme
+from app.utils.media_encoding import VARIANTI_SHOWROOM, elabora_immagine
+
+# === Worker immagini AI (usato_leonardo, media_type='image') ===
+# Claim dei job con FOR UPDATE SKIP LOCKED: ogni riga presa passa a 'processing'
+# con un lease (lease_holder, lease_scade_il). Se il worker muore il lease scade
+# e la riga torna prendibile da chiunque, contando un tentativo in più.
+# Un job fallito torna in coda con disponibile_dal nel futuro (backoff esponenziale
+# da GEMINI_IMMAGINI_BACKOFF secondi): un 429 o un disservizio breve di Gemini non
+# brucia tutti i MAX_RETRY tentativi nello stesso giro.
+# I gruppi (stessa auto, prompt e immagini sorgente = una chiamata Gemini) girano
+# in parallelo fino a GEMINI_IMMAGINI_PARALLELISMO; composizione sul pool cpu
+# (una decodifica: PNG finale + varianti showroom in WebP), logo dalla cache sul pool io,
+# upload paralleli con il client storage async, scritture DB sul pool db.
+# Colonne e indice: usato_leonardo_jobs_schema.sql
+#
+#   await processa_coda_immagini()   # job schedulato (app/tasks.py)
+
+MAX_RETRY = 3
+PARALLELISMO = int(os.getenv("GEMINI_IMMAGINI_PARALLELISMO", "4"))
+LOTTO = int(os.getenv("GEMINI_IMMAGINI_LOTTO", "40"))                   # righe prese per claim
+VISIBILITA = float(os.getenv("GEMINI_IMMAGINI_VISIBILITA", "300"))      # secondi di lease per riga
+BACKOFF = float(os.getenv("GEMINI_IMMAGINI_BACKOFF", "15"))             # attesa dopo il primo errore
+FINESTRA_THROUGHPUT = 15  # minuti
+
+CLAIM = text("""
+    UPDATE public.usato_leonardo u
+       SET status = 'processing',
+           lease_holder = :holder,
+           lease_scade_il = now() + make_interval(secs => :visibilita),
+           retry_count = u.retry_count + CASE WHEN u.status = 'processing' THEN 1 ELSE 0 END,
+           updated_at = now()
+     WHERE u.id IN (
+        SELECT id FROM public.usato_leonardo
+         WHERE media_type = 'image'
+           AND ((status = 'queued' AND (disponibile_dal IS NULL OR disponibile_dal <= now()))
+                OR (status = 'processing' AND lease_scade_il < now()))
+         ORDER BY created_at
+         LIMIT :limite
+         FOR UPDATE SKIP LOCKED
+     )
+    RETURNING u.id, u.id_auto, u.prompt, u.subject_url, u.background_url, u.logo_url,
+              u.logo_height, u.logo_offset_y, u.retry_count, u.is_boost, u.boost_vetrina_done
+""")
+
+# lease scaduti all'ultimo tentativo: non si riprovano più
+ABBANDONA_SCADUTI = text("""
+    UPDATE public.usato_leonardo
+       SET status = 'failed', lease_holder = NULL, lease_scade_il = NULL, updated_at = now(),
+           retry_count = retry_count + 1,
+           error_message = coalesce(error_message, 'Lease scaduto durante l''elaborazione')
+     WHERE media_type = 'image' AND status = 'processing'
+       AND lease_scade_il < now() AND retry_count + 1 >= :max_retry
+""")
+
+
+class MetricheWorker:
+    """Contatori del processo worker (loggati a fine giro)."""
+
+    def __init__(self):
+        self.completate = 0
+        self.fallite = 0
+        self.riaccodate = 0
+        self.gruppi = 0
+        self._secondi_gruppi = 0.0
+
+    def snapshot(self) -> dict:
+        return {
+            "completate": self.completate,
+            "fallite": self.fallite,
+            "riaccodate": self.riaccodate,
+            "gruppi": self.gruppi,
+            "durata_media_gruppo_s": round(self._secondi_gruppi / self.gruppi, 2) if self.gruppi else None,
+        }
+
+
+metriche_worker = MetricheWorker()
+
+
+# --- DB (sincrono, gira su run_db)
+
+def _claim(limite: int) -> list:
+    db = SessionLocal()
+    try:
+        db.execute(ABBANDONA_SCADUTI, {"max_retry": MAX_RETRY})
+        righe = db.execute(CLAIM, {"holder": HOLDER_ID, "visibilita": VISIBILITA, "limite": limite}).fetchall()
+        db.commit()
+        return righe
+    finally:
+        db.close()
+
+
+def _rinnova_lease(ids: list):
+    db = SessionLocal()
+    try:
+        db.execute(text("""
+            UPDATE public.usato_leonardo
+               SET lease_scade_il = now() + make_interval(secs => :visibilita)
+             WHERE id = ANY(CAST(:ids AS uuid[])) AND status = 'processing' AND lease_holder = :holder
+        """), {"ids": [str(i) for i in ids], "visibilita": VISIBILITA, "holder": HOLDER_ID})
+        db.commit()
+    finally:
+        db.close()
+
+
+def _completa(rec, path: str, public_url: Optional[str], varianti: dict) -> bool:
+    """Chiude il job solo se il lease è ancora nostro; False se un altro worker l'ha ripreso."""
+    db = SessionLocal()
+    try:
+        ok = db.execute(text("""
+            UPDATE public.usato_leonardo
+               SET status = 'completed', public_url = :public_url, storage_path = :path,
+                   retry_count = 0, error_message = NULL, disponibile_dal = NULL,
+                   lease_holder = NULL, lease_scade_il = NULL, updated_at = now(),
+                   boost_vetrina_done = boost_vetrina_done OR is_boost,
+                   varianti = CAST(:varianti AS jsonb)
+             WHERE id = :id AND status = 'processing' AND lease_holder = :holder
+        """), {"id": str(rec.id), "public_url": public_url, "path": path, "holder": HOLDER_ID,
+               "varianti": json.dumps(varianti)}).rowcount
+        if ok:
+            firmate = {v["path"]: v["url"] for v in varianti.values()}
+            firmate[path] = public_url
+            registra_firme(db, BUCKET_MEDIA_AI, firmate)
+        if ok and rec.is_boost and not rec.boost_vetrina_done:
+            db.execute(text("""
+                INSERT INTO usato_vetrina (id_auto, media_type, media_id, priority, created_at)
+                VALUES (:id_auto, 'ai', :media_id, 1, now())
+                ON CONFLICT DO NOTHING
+            """), {"id_auto": str(rec.id_auto), "media_id": str(rec.id)})
+        db.commit()
+        return bool(ok)
+    finally:
+        db.close()
+
+
+def _ritenta(ids: list, errore: str) -> int:
+    """Un tentativo in più: torna in coda o passa a 'failed' dopo MAX_RETRY. Restituisce le fallite."""
+    db = SessionLocal()
+    try:
+        righe = db.execute(text("""
+            UPDATE public.usato_leonardo
+               SET retry_count = retry_count + 1,
+                   status = CASE WHEN retry_count + 1 >= :max_retry THEN 'failed' ELSE 'queued' END,
+                   error_message = :errore,
+                   disponibile_dal = now() + make_interval(secs => :backoff * power(2, retry_count)),
+                   lease_holder = NULL, lease_scade_il = NULL, updated_at = now()
+             WHERE id = ANY(CAST(:ids AS uuid[])) AND status = 'processing' AND lease_holder = :holder
+            RETURNING status
+        """), {"ids": [str(i) for i in ids], "max_retry": MAX_RETRY, "errore": errore[:2000],
+               "backoff": BACKOFF, "holder": HOLDER_ID}).fetchall()
+        db.commit()
+        return sum(1 for r in righe if r.status == "failed")
+    finally:
+        db.close()
+
+
+def metriche_coda_immagini(db: Session) -> dict:
+    """Profondità della coda, età del job più vecchio e throughput recente (da DB: vale per tutti i worker)."""
+    row = db.execute(text("""
+        SELECT
+            count(*) FILTER (WHERE status = 'queued') AS in_coda,
+            count(*) FILTER (WHERE status = 'queued' AND disponibile_dal > now()) AS in_attesa_retry,
+            count(*) FILTER (WHERE status = 'processing') AS in_lavorazione,
+            count(*) FILTER (WHERE status = 'processing' AND lease_scade_il < now()) AS lease_scaduti,
+            extract(epoch FROM now() - min(created_at) FILTER (WHERE status = 'queued')) AS eta_max_s,
+            count(*) FILTER (WHERE status = 'completed' AND updated_at >= now() - make_interval(mins => :finestra)) AS completate,
+            count(*) FILTER (WHERE status = 'failed' AND updated_at >= now() - make_interval(mins => :finestra)) AS fallite
+        FROM public.usato_leonardo
+        WHERE media_type = 'image'
+          AND (status IN ('queued', 'processing') OR updated_at >= now() - make_interval(mins => :finestra))
+    """), {"finestra": FINESTRA_THROUGHPUT}).fetchone()
+    return {
+        "in_coda": row.in_coda,
+        "in_attesa_retry": row.in_attesa_retry,
+        "in_lavorazione": row.in_lavorazione,
+        "lease_scaduti": row.lease_scaduti,
+        "eta_job_piu_vecchio_s": round(float(row.eta_max_s), 1) if row.eta_max_s is not None else None,
+        "completate_finestra": row.completate,
+        "fallite_finestra": row.fallite,
+        "immagini_al_minuto": round(row.completate / FINESTRA_THROUGHPUT, 2),
+        "finestra_minuti": FINESTRA_THROUGHPUT,
+        "parallelismo": PARALLELISMO,
+        "worker": metriche_worker.snapshot(),
+        "logo_cache": logo_cache.metrics(),
+    }
+
+
+# --- orchestrazione
+
+async def _mantieni_lease(ids: list, stop: asyncio.Event):
+    while True:
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=VISIBILITA / 3)
+            return
+        except asyncio.TimeoutError:
+            pass
+        try:
+            await run_db(_rinnova_lease, ids)
+        except Exception as e:
+            logging.warning(f"⚠️ Rinnovo lease immagini fallito: {e}")
+
+
+async def _carica_uscite(bucket: str, rec, uscite: dict) -> tuple:
+    """Upload in parallelo di immagine finale e varianti, una sola firma; (path, url, {variante: {...}})."""
+    percorsi = {
+        nome: f"{rec.id_auto}/{rec.id}{'' if nome == 'originale' else '_' + nome}{u.estensione}"
+        for nome, u in uscite.items()
+    }
+    url = await storage.upload_e_firma_molti(bucket, [(percorsi[nome], u.dati, u.mime) for nome, u in uscite.items()])
+    varianti = {
+        nome: {"path": percorsi[nome], "url": url.get(percorsi[nome]), "width": u.width, "height": u.height}
+        for nome, u in uscite.items() if nome != "originale"
+    }
+    return percorsi["originale"], url.get(percorsi["originale"]), varianti
+
+
+async def _processa_gruppo(batch: list, semaforo: asyncio.Semaphore):
+    # import qui: openai_config importa mezza applicazione
+    from app.routes.openai_config import _gemini_generate_image_sync
+
+    async with semaforo:
+        inizio = time.monotonic()
+        primo = batch[0]
+        logging.info(f"🟡 Generazione batch da {len(batch)} immagini per auto={primo.id_auto}")
+        try:
+            responses = await _gemini_generate_image_sync(
+                primo.prompt,
+                subject_image_url=primo.subject_url,
+                background_image_url=primo.background_url,
+                num_images=len(batch),
+            )
+            if not isinstance(responses, list):
+                responses = [responses]
+        except Exception as e:
+            metriche_worker.fallite += await run_db(_ritenta, [r.id for r in batch], str(e))
+            logging.error(f"❌ Errore batch {len(batch)} recs per auto={primo.id_auto}: {e}")
+            return
+
+        for rec, img_bytes in zip(batch, responses):
+            try:
+                if isinstance(img_bytes, list):
+                    img_bytes = img_bytes[0]
+                logo = await run_io(logo_cache.get, rec.logo_url, rec.logo_height or 100) if rec.logo_url else None
+                uscite = await run_cpu(
+                    elabora_immagine, img_bytes, "png", logo, rec.logo_offset_y or 100, VARIANTI_SHOWROOM,
+                )
+                path, public_url, varianti = await _carica_uscite(BUCKET_MEDIA_AI, rec, uscite)
+                if await run_db(_completa, rec, path, public_url, varianti):
+                    metriche_worker.completate += 1
+                    logging.info(f"✅ Immagine completata per rec_id={rec.id}")
+                else:
+                    logging.warning(f"⚠️ Lease perso per rec_id={rec.id}: risultato scartato")
+            except Exception as e:
+                metriche_worker.fallite += await run_db(_ritenta, [rec.id], str(e))
+                logging.error(f"❌ Errore singolo rec_id={rec.id}: {e}")
+
+        # Gemini ha restituito meno immagini del richiesto: le mancanti tornano in coda
+        mancanti = batch[len(responses):]
+        if mancanti:
+            fallite = await run_db(
+                _ritenta, [r.id for r in mancanti],
+                f"Gemini non ha generato abbastanza immagini (richieste {len(batch)}, ricevute {len(responses)})",
+            )
+            metriche_worker.fallite += fallite
+            metriche_worker.riaccodate += len(mancanti) - fallite
+            logging.warning(f"⚠️ Ricevute solo {len(responses)} immagini su {len(batch)} per auto={primo.id_auto}")
+
+        metriche_worker.gruppi += 1
+        metriche_worker._secondi_gruppi += time.monotonic() - inizio
+
+
+async def processa_coda_immagini():
+    """Svuota la coda a lotti: claim, gruppi in parallelo, claim successivo finché c'è lavoro."""
+    semaforo = asyncio.Semaphore(PARALLELISMO)
+    totale = 0
+    while True:
+        righe = await run_db(_claim, LOTTO)
+        if not righe:
+            break
+        totale += len(righe)
+
+        gruppi = defaultdict(list)
+        for rec in righe:
+            gruppi[(rec.id_auto, rec.prompt, rec.subject_url, rec.background_url, rec.logo_url)].append(rec)
+
+        stop = asyncio.Event()
+        heartbeat = asyncio.create_task(_mantieni_lease([r.id for r in righe], stop))
+        try:
+            esiti = await asyncio.gather(*(_processa_gruppo(b, semaforo) for b in gruppi.values()),
+                                         return_exceptions=True)
+            for esito in esiti:
+                if isinstance(esito, Exception):
+                    logging.error(f"❌ Gruppo immagini interrotto: {esito}")
+        finally:
+            stop.set()
+            await heartbeat
+
+    if totale:
+        logging.info(f"📊 Worker immagini: {totale} job presi in carico, {metriche_worker.snapshot()}")
@@ -0,0 +1,69 @@
+import os
+import uuid
+import socket
+import asyncio
+import logging
+import functools
+from sqlalchemy import text
+from app.database import engine
+
+# === Lease su Postgres per i job schedulati ===
+# Una riga per nome in `job_lease`: chi la detiene (holder) e fino a quando.
+# - leader election del worker: solo il leader fa girare lo scheduler
+# - claim per singolo job: lo stesso job non parte due volte su repliche diverse
+#   (es. durante un deploy, vecchio e nuovo leader sovrapposti)
+# Lease e non advisory lock: funziona anche dietro il pooler di Supabase in transaction mode.
+
+HOLDER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def acquisisci_lease(nome: str, ttl: float, holder: str = HOLDER_ID) -> bool:
+    """Prende (o rinnova) il lease se libero, scaduto o già nostro."""
+    with engine.begin() as conn:
+        row = conn.execute(text("""
+            INSERT INTO job_lease (nome, holder, scade_il, acquisito_il)
+            VALUES (:nome, :holder, now() + make_interval(secs => :ttl), now())
+            ON CONFLICT (nome) DO UPDATE
+               SET holder = EXCLUDED.holder,
+                   scade_il = EXCLUDED.scade_il,
+                   acquisito_il = CASE WHEN job_lease.holder = EXCLUDED.holder
+                                       THEN job_lease.acquisito_il ELSE now() END
+             WHERE job_lease.holder = EXCLUDED.holder OR job_lease.scade_il < now()
+            RETURNING holder
+        """), {"nome": nome, "holder": holder, "ttl": ttl}).fetchone()
+    return row is not None
+
+
+def rilascia_lease(nome: str, holder: str = HOLDER_ID):
+    with engine.begin() as conn:
+        conn.execute(text("DELETE FROM job_lease WHERE nome = :nome AND holder = :holder"),
+                     {"nome": nome, "holder": holder})
+
+
+def con_lease(nome: str, fn, ttl: float):
+    """
+    Avvolge un job (sync o async) così da eseguirlo solo se il lease `nome`
+    è libero; se un'altra replica lo sta già eseguendo il giro viene saltato.
+    """
+    if asyncio.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def _async(*args, **kwargs):
+            if not await asyncio.to_thread(acquisisci_lease, nome, ttl):
+                logging.info(f"⏭️ Job {nome} già in esecuzione altrove, salto")
+                return
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                await asyncio.to_thread(rilascia_lease, nome)
+        return _async
+
+    @functools.wraps(fn)
+    def _sync(*args, **kwargs):
+        if not acquisisci_lease(nome, ttl):
+            logging.info(f"⏭️ Job {nome} già in esecuzione altrove, salto")
+            return
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            rilascia_lease(nome)
+    return _sync
@@ -0,0 +1,130 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+import requests
+from PIL import Image
+from app.utils.media_encoding import ridimensiona_logo
+
+# === Cache dei loghi dealer per la composizione delle immagini AI ===
+# LRU in memoria (LOGO_CACHE_MAX voci) del logo già decodificato e ridimensionato,
+# chiave (url, altezza): un lotto di 20 immagini con lo stesso logo lo scarica e
+# ridimensiona una volta. Dopo LOGO_CACHE_REVALIDA secondi si rivalida verso
+# l'origine con If-None-Match / If-Modified-Since: 304 = si tiene l'entry.
+# Se la rivalidazione fallisce si usa l'ultimo logo noto.
+#
+#   logo = logo_cache.get(logo_url, 120)   # PIL RGBA pronto da incollare (bloccante: run_io)
+
+LOGO_CACHE_MAX = int(os.getenv("LOGO_CACHE_MAX", "256"))
+LOGO_CACHE_REVALIDA = float(os.getenv("LOGO_CACHE_REVALIDA", "600"))
+
+
+@dataclass
+class LogoInCache:
+    logo: Image.Image
+    etag: Optional[str]
+    last_modified: Optional[str]
+    verificato_il: float
+
+
+class LogoCache:
+    def __init__(self, massimo: int = LOGO_CACHE_MAX, revalida: float = LOGO_CACHE_REVALIDA):
+        self.massimo = massimo
+        self.revalida = revalida
+        self._lru: "OrderedDict[tuple, LogoInCache]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._lock_chiavi: dict = {}
+        self.hit = 0
+        self.miss = 0
+        self.non_modificati = 0
+        self.scaricati = 0
+        self.errori = 0
+
+    def _entry(self, chiave: tuple) -> Optional[LogoInCache]:
+        with self._lock:
+            entry = self._lru.get(chiave)
+            if entry is not None:
+                self._lru.move_to_end(chiave)
+            return entry
+
+    def _salva(self, chiave: tuple, entry: LogoInCache):
+        with self._lock:
+            self._lru[chiave] = entry
+            self._lru.move_to_end(chiave)
+            while len(self._lru) > self.massimo:
+                vecchia, _ = self._lru.popitem(last=False)
+                self._lock_chiavi.pop(vecchia, None)
+
+    def _lock_chiave(self, chiave: tuple) -> threading.Lock:
+        with self._lock:
+            return self._lock_chiavi.setdefault(chiave, threading.Lock())
+
+    def get(self, logo_url: str, altezza: int) -> Image.Image:
+        chiave = (logo_url, max(1, int(altezza or 100)))
+        entry = self._entry(chiave)
+        if entry and time.monotonic() - entry.verificato_il < self.revalida:
+            self.hit += 1
+            return entry.logo
+
+        # un solo download per chiave anche con più gruppi in parallelo
+        with self._lock_chiave(chiave):
+            entry = self._entry(chiave)
+            if entry and time.monotonic() - entry.verificato_il < self.revalida:
+                self.hit += 1
+                return entry.logo
+
+            headers = {}
+            if entry and entry.etag:
+                headers["If-None-Match"] = entry.etag
+            if entry and entry.last_modified:
+                headers["If-Modified-Since"] = entry.last_modified
+            try:
+                r = requests.get(logo_url, headers=headers, timeout=30)
+                if r.status_code == 304 and entry:
+                    entry.verificato_il = time.monotonic()
+                    self.non_modificati += 1
+                    return entry.logo
+                r.raise_for_status()
+            except requests.RequestException:
+                self.errori += 1
+                if entry:
+                    entry.verificato_il = time.monotonic()  # riprova al prossimo giro di rivalidazione
+                    return entry.logo
+                raise
+
+            self.miss += 1
+            self.scaricati += 1
+            nuovo = LogoInCache(
+                logo=ridimensiona_logo(r.content, chiave[1]),
+                etag=r.headers.get("ETag"),
+                last_modified=r.headers.get("Last-Modified"),
+                verificato_il=time.monotonic(),
+            )
+            self._salva(chiave, nuovo)
+            return nuovo.logo
+
+    def invalida(self, logo_url: Optional[str] = None):
+        with self._lock:
+            if logo_url is None:
+                self._lru.clear()
+            else:
+                for chiave in [c for c in self._lru if c[0] == logo_url]:
+                    del self._lru[chiave]
+
+    def metrics(self) -> dict:
+        with self._lock:
+            voci = len(self._lru)
+        return {
+            "voci": voci,
+            "max": self.massimo,
+            "hit": self.hit,
+            "miss": self.miss,
+            "non_modificati": self.non_modificati,
+            "scaricati": self.scaricati,
+            "errori": self.errori,
+        }
+
+
+logo_cache = LogoCache()
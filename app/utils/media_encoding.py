@@ -0,0 +1,103 @@
+from io import BytesIO
+from dataclasses import dataclass
+from typing import Optional
+from PIL import Image
+
+# === Codifica immagini AI in un solo passaggio ===
+# I byte grezzi restituiti da Gemini vengono decodificati una volta, il logo
+# applicato una volta e ogni uscita codificata una volta sola: il formato finale
+# e, se richieste, le varianti responsive per lo showroom (tutte dalla stessa
+# immagine già composta, mai da un'uscita già compressa).
+#
+#   logo = logo_cache.get(logo_url, 100)   # app/utils/logo_cache.py
+#   uscite = elabora_immagine(raw, "png", logo=logo, varianti=VARIANTI_SHOWROOM)
+#   uscite["originale"].dati, uscite["card"].mime
+
+# formato → (formato PIL, mime, estensione, opzioni di salvataggio)
+FORMATI = {
+    "png": ("PNG", "image/png", ".png", {}),
+    "webp": ("WEBP", "image/webp", ".webp", {"quality": 85, "method": 4}),
+    "jpeg": ("JPEG", "image/jpeg", ".jpg", {"quality": 85, "optimize": True}),
+}
+
+# nome → larghezza massima (px); le varianti sono sempre WebP
+VARIANTI_SHOWROOM = (("thumb", 320), ("card", 800), ("hero", 1600))
+
+
+@dataclass(frozen=True)
+class ImmagineCodificata:
+    dati: bytes
+    mime: str
+    estensione: str
+    width: int
+    height: int
+
+
+def _formato(formato: str) -> tuple:
+    try:
+        return FORMATI[formato.lower()]
+    except KeyError:
+        raise ValueError(f"Formato immagine non supportato: {formato}")
+
+
+def codifica(img: Image.Image, formato: str) -> ImmagineCodificata:
+    pil, mime, estensione, opzioni = _formato(formato)
+    if pil == "JPEG" and img.mode != "RGB":
+        img = img.convert("RGB")
+    buf = BytesIO()
+    img.save(buf, format=pil, **opzioni)
+    return ImmagineCodificata(buf.getvalue(), mime, estensione, img.width, img.height)
+
+
+def applica_logo(img: Image.Image, logo: Image.Image, offset_y: int) -> Image.Image:
+    """Incolla il logo (RGBA già alla dimensione finale) centrato, a offset_y dall'alto."""
+    if img.height < logo.height + offset_y:
+        raise ValueError(f"image too small for logo offset {offset_y}px")
+    if img.mode != "RGBA":
+        img = img.convert("RGBA")
+    img.paste(logo, ((img.width - logo.width) // 2, offset_y), logo)
+    return img
+
+
+def ridimensiona_logo(logo_bytes: bytes, altezza: int) -> Image.Image:
+    logo = Image.open(BytesIO(logo_bytes)).convert("RGBA")
+    ow, oh = logo.size
+    new_h = max(1, int(altezza or 100))
+    return logo.resize((int((ow / oh) * new_h), new_h))
+
+
+def elabora_immagine(
+    raw: bytes,
+    formato: str = "png",
+    logo: Optional[Image.Image] = None,
+    offset_y: int = 100,
+    varianti: tuple = (),
+) -> dict:
+    """
+    Una decodifica, logo opzionale (RGBA già ridimensionato), una codifica per uscita.
+    Restituisce {"originale": ImmagineCodificata, <variante>: ImmagineCodificata, ...}.
+    """
+    img = Image.open(BytesIO(raw))
+
+    # già nel formato giusto e nulla da comporre: i byte originali, senza ricodifica
+    if logo is None and not varianti and (img.format or "").upper() == _formato(formato)[0]:
+        _, mime, estensione, _ = _formato(formato)
+        return {"originale": ImmagineCodificata(raw, mime, estensione, img.width, img.height)}
+
+    img.load()
+    if logo is not None:
+        img = applica_logo(img, logo, offset_y)
+
+    uscite = {"originale": codifica(img, formato)}
+    for nome, larghezza in varianti:
+        if img.width > larghezza:
+            ridotta = img.resize((larghezza, max(1, round(img.height * larghezza / img.width))), Image.LANCZOS)
+        else:
+            ridotta = img  # niente ingrandimenti
+        uscite[nome] = codifica(ridotta, "webp")
+    return uscite
+
+
+def converti(raw: bytes, formato: str) -> bytes:
+    """Solo cambio formato (nessuna ricodifica se è già quello richiesto)."""
+    return elabora_immagine(raw, formato)["originale"].dati
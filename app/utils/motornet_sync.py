@@ -0,0 +1,484 @@
+import json
+import time
+import random
+import asyncio
+import hashlib
+import logging
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Iterable, Optional
+
+import httpx
+from sqlalchemy import text
+
+from app.database import SessionLocal
+from app.utils.motornet_token import motornet_tokens
+
+# === Motore di sync Motornet asincrono ===
+# Usato da tutte le catene (marche → modelli → allestimenti → dettagli, nuovo e usato):
+# - un solo httpx.AsyncClient con pool di connessioni
+# - concorrenza limitata (semaforo)
+# - token bucket che si adatta a 429 / Retry-After (dimezza il rate, poi risale)
+# - backoff esponenziale con jitter su errori di rete e 5xx
+# - coda dei codici falliti persistita in `mnet_sync_retry`, ripresa al giro successivo
+# Le scritture DB passano da un unico thread "writer" con una sola sessione;
+# i dettagli (~90 colonne per riga) sono scritti a blocchi da BulkUpsertWriter.
+
+
+class RateLimiter:
+    """Token bucket adattivo (AIMD): -50% su 429, +5% ogni risposta OK fino al massimo."""
+
+    def __init__(self, rate: float, capacity: Optional[int] = None, min_rate: float = 0.5):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate
+        self.capacity = capacity or max(1, int(rate))
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.pausa_fino = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.pausa_fino:
+                    await asyncio.sleep(self.pausa_fino - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def rallenta(self, retry_after: Optional[float] = None):
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.tokens = 0
+        if retry_after:
+            self.pausa_fino = max(self.pausa_fino, time.monotonic() + retry_after)
+
+    def accelera(self):
+        self.rate = min(self.max_rate, self.rate * 1.05)
+
+
+def _retry_after(resp: httpx.Response) -> Optional[float]:
+    try:
+        return float(resp.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+def _insert_multiriga(tabella: str, righe: list) -> tuple:
+    """(colonne, sql INSERT ... VALUES, params) per righe con le stesse colonne (nomi = chiavi del dict)."""
+    colonne = list(righe[0].keys())
+    valori, params = [], {}
+    for i, riga in enumerate(righe):
+        valori.append("(" + ", ".join(f":{c}_{i}" for c in colonne) + ")")
+        params.update({f"{c}_{i}": riga.get(c) for c in colonne})
+    sql = f"INSERT INTO {tabella} ({', '.join(colonne)}) VALUES {', '.join(valori)}"
+    return colonne, sql, params
+
+
+def inserisci_righe(db, tabella: str, righe: list) -> int:
+    """Un solo INSERT multi-riga, senza ON CONFLICT (tabella appena svuotata per quelle chiavi)."""
+    if not righe:
+        return 0
+    _, sql, params = _insert_multiriga(tabella, righe)
+    db.execute(text(sql), params)
+    return len(righe)
+
+
+def upsert_righe(db, tabella: str, righe: list, chiave: str = "codice_motornet_uni") -> int:
+    """
+    Un solo INSERT multi-riga con ON CONFLICT (chiave) DO UPDATE per tutte le righe.
+    Le righe devono avere le stesse colonne (nomi = chiavi del dict).
+    """
+    if not righe:
+        return 0
+
+    colonne, sql, params = _insert_multiriga(tabella, righe)
+    aggiorna = ", ".join(f"{c} = EXCLUDED.{c}" for c in colonne if c != chiave)
+    db.execute(text(f"{sql} ON CONFLICT ({chiave}) DO UPDATE SET {aggiorna}"), params)
+    return len(righe)
+
+
+class BulkUpsertWriter:
+    """
+    Buffer di righe già parse: flush a blocchi quando si raggiunge `batch_size`
+    o sono passati `flush_interval` secondi, un commit per blocco.
+    La chiave della riga deve coincidere con la chiave dell'item del motore,
+    così un flush fallito rimette i codici nella coda retry.
+    """
+
+    def __init__(self, engine: "MotornetSyncEngine", tabella: str, chiave: str = "codice_motornet_uni",
+                 batch_size: int = 200, flush_interval: float = 5.0):
+        self.engine = engine
+        self.tabella = tabella
+        self.chiave = chiave
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.buffer = {}  # chiave → riga (l'ultima vince: ON CONFLICT non accetta doppioni nello stesso statement)
+        self.scritte = 0
+        self.flush_count = 0
+        self.falliti = set()
+        self._ultimo_flush = time.monotonic()
+        self._timer = asyncio.create_task(self._flush_periodico())
+
+    async def aggiungi(self, riga: dict):
+        self.buffer[riga[self.chiave]] = riga
+        if len(self.buffer) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self):
+        self._ultimo_flush = time.monotonic()
+        if not self.buffer:
+            return
+        righe, self.buffer = list(self.buffer.values()), {}
+        try:
+            self.scritte += await self.engine.scrivi(upsert_righe, self.tabella, righe, self.chiave)
+            self.flush_count += 1
+        except Exception as e:
+            logging.error(f"❌ [{self.engine.job}] Flush {self.tabella} fallito ({len(righe)} righe): {e}")
+            for riga in righe:
+                self.falliti.add(str(riga[self.chiave]))
+                await self.engine.scrivi(self.engine._segna_fallito, str(riga[self.chiave]), f"flush: {e}")
+
+    async def _flush_periodico(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            if time.monotonic() - self._ultimo_flush >= self.flush_interval:
+                await self.flush()
+
+    async def chiudi(self):
+        self._timer.cancel()
+        await self.flush()
+
+
+# === Sync incrementale dettagli ===
+# Ogni riga salva l'hash del contenuto e `fetched_at`. I codici già presenti
+# vengono riscaricati secondo l'età del listino (più recente = più spesso):
+# si scrive solo se l'hash è cambiato, altrimenti si aggiorna solo fetched_at.
+
+STALENESS_SQL = """
+    CASE
+        WHEN d.data_listino >= current_date - interval '1 year'  THEN interval '7 days'
+        WHEN d.data_listino >= current_date - interval '3 years' THEN interval '30 days'
+        ELSE interval '90 days'
+    END
+"""
+
+
+def query_codici_dettagli(tabella_allestimenti: str, tabella_dettagli: str, incrementale: bool) -> str:
+    """
+    Codici da scaricare: solo i mancanti, oppure (incrementale) anche quelli
+    scaduti secondo STALENESS_SQL, listini più recenti per primi.
+    Colonne: codice_motornet_uni, presente, content_hash.
+    """
+    scaduti = f"""
+           OR d.fetched_at IS NULL
+           OR d.fetched_at < now() - {STALENESS_SQL}""" if incrementale else ""
+    return f"""
+        SELECT a.codice_motornet_uni,
+               d.codice_motornet_uni IS NOT NULL AS presente,
+               d.content_hash
+        FROM {tabella_allestimenti} a
+        LEFT JOIN {tabella_dettagli} d ON a.codice_motornet_uni = d.codice_motornet_uni
+        WHERE d.codice_motornet_uni IS NULL{scaduti}
+        ORDER BY (d.codice_motornet_uni IS NULL) DESC, d.data_listino DESC NULLS LAST
+        LIMIT :limite
+    """
+
+
+def hash_contenuto(riga: dict) -> str:
+    return hashlib.sha256(json.dumps(riga, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def _tocca_fetched_at(db, tabella: str, codici: list):
+    db.execute(text(f"""
+        UPDATE {tabella} SET fetched_at = now() WHERE codice_motornet_uni = ANY(:codici)
+    """), {"codici": codici})
+
+
+class DettagliIncrementali:
+    """Smista le righe scaricate: nuove/cambiate al writer a blocchi, invariate solo fetched_at."""
+
+    def __init__(self, tabella: str, esistenti: dict, batch_size: int = 500):
+        self.tabella = tabella
+        self.esistenti = esistenti  # codice → content_hash (None se mai calcolato)
+        self.batch_size = batch_size
+        self.aggiunti = 0
+        self.cambiati = 0
+        self.invariati = 0
+        self.ripresi = 0          # dalla coda retry: fuori da `esistenti`, non per forza nuovi
+        self._invariati = []
+        self._da_retry = set()
+
+    def segna_ripresi(self, codici):
+        """Codici aggiunti al giro dalla coda retry (non presenti nella query iniziale)."""
+        self._da_retry.update(codici)
+
+    async def registra(self, engine: "MotornetSyncEngine", riga: dict):
+        codice = riga["codice_motornet_uni"]
+        h = hash_contenuto(riga)
+
+        if codice in self.esistenti and self.esistenti[codice] == h:
+            self.invariati += 1
+            self._invariati.append(codice)
+            if len(self._invariati) >= self.batch_size:
+                await self._flush_invariati(engine)
+            return
+
+        if codice in self.esistenti:
+            self.cambiati += 1
+        elif codice in self._da_retry:
+            self.ripresi += 1
+        else:
+            self.aggiunti += 1
+        riga = {**riga, "content_hash": h, "fetched_at": datetime.now(timezone.utc)}
+        await engine.bulk_writer(self.tabella).aggiungi(riga)
+
+    async def _flush_invariati(self, engine: "MotornetSyncEngine"):
+        codici, self._invariati = self._invariati, []
+        if codici:
+            await engine.scrivi(_tocca_fetched_at, self.tabella, codici)
+
+    async def chiudi(self, engine: "MotornetSyncEngine"):
+        await self._flush_invariati(engine)
+
+    def report(self) -> dict:
+        return {"aggiunti": self.aggiunti, "cambiati": self.cambiati, "invariati": self.invariati,
+                "ripresi": self.ripresi}
+
+
+class MotornetSyncEngine:
+    def __init__(
+        self,
+        job: str,
+        concurrency: int = 8,
+        rate: float = 8.0,
+        max_attempts: int = 5,
+        backoff_base: float = 1.0,
+        backoff_max: float = 60.0,
+        timeout: float = 30.0,
+    ):
+        self.job = job
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.limiter = RateLimiter(rate)
+        self.timeout = timeout
+
+        self.client: Optional[httpx.AsyncClient] = None
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"mnet-{job}")
+        self._db = None
+        self._bulk = {}
+        self._incrementali = []
+
+        self.ok = 0
+        self.falliti = 0
+
+    # --- ciclo di vita ---
+
+    async def __aenter__(self):
+        self.client = httpx.AsyncClient(
+            timeout=self.timeout,
+            limits=httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency),
+        )
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.client.aclose()
+        if self._db is not None:
+            await asyncio.get_running_loop().run_in_executor(self._writer, self._db.close)
+        self._writer.shutdown(wait=True)
+
+    # --- HTTP ---
+
+    def _backoff(self, attempt: int) -> float:
+        # full jitter: uniforme in [0, base * 2^attempt]
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    async def get(self, url: str, ok_status: Iterable[int] = (200,)) -> Optional[httpx.Response]:
+        """
+        GET con token condiviso, rate limit e retry. Ritorna la risposta se lo status
+        è in `ok_status`, None per 404, solleva RuntimeError dopo `max_attempts`.
+        """
+        ok_status = tuple(ok_status)
+        ultimo = None
+        for attempt in range(self.max_attempts):
+            await self.limiter.acquire()
+            token = await motornet_tokens.aget_token()
+            try:
+                resp = await self.client.get(url, headers={"Authorization": f"Bearer {token}"})
+            except httpx.HTTPError as e:
+                ultimo = f"rete: {e}"
+                await asyncio.sleep(self._backoff(attempt))
+                continue
+
+            motornet_tokens.registra_risposta(resp.status_code, token)
+
+            if resp.status_code in ok_status:
+                self.limiter.accelera()
+                return resp
+            if resp.status_code == 404:
+                return None
+            if resp.status_code == 401:
+                ultimo = "401"
+                continue
+            if resp.status_code == 429:
+                wait = _retry_after(resp) or self._backoff(attempt + 2)
+                logging.warning(f"⏳ [{self.job}] Rate limit 429, attendo {wait:.1f}s")
+                self.limiter.rallenta(wait)
+                ultimo = "429"
+                continue
+
+            ultimo = f"HTTP {resp.status_code}"
+            if resp.status_code < 500:
+                break  # 4xx non recuperabile
+            await asyncio.sleep(self._backoff(attempt))
+
+        raise RuntimeError(f"Motornet {url}: {ultimo}")
+
+    async def get_json(self, url: str) -> Optional[dict]:
+        resp = await self.get(url)
+        return resp.json() if resp is not None else None
+
+    # --- DB ---
+
+    async def scrivi(self, fn: Callable, *args):
+        """Esegue fn(db, *args) nel thread writer, con commit (o rollback su errore)."""
+        def _run():
+            if self._db is None:
+                self._db = SessionLocal()
+            try:
+                result = fn(self._db, *args)
+                self._db.commit()
+                return result
+            except Exception:
+                self._db.rollback()
+                raise
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._writer, _run)
+
+    def incrementale(self, tracker: DettagliIncrementali) -> DettagliIncrementali:
+        """Registra un tracker di change detection, chiuso (e riportato) a fine run."""
+        self._incrementali.append(tracker)
+        return tracker
+
+    def bulk_writer(self, tabella: str, **kwargs) -> BulkUpsertWriter:
+        """Writer a blocchi per la tabella (uno per motore, creato al primo uso)."""
+        if tabella not in self._bulk:
+            self._bulk[tabella] = BulkUpsertWriter(self, tabella, **kwargs)
+        return self._bulk[tabella]
+
+    # --- coda retry persistente ---
+
+    def _carica_retry(self, db) -> list:
+        rows = db.execute(text("""
+            SELECT chiave FROM mnet_sync_retry WHERE job = :job ORDER BY updated_at
+        """), {"job": self.job}).fetchall()
+        return [r.chiave for r in rows]
+
+    def _segna_fallito(self, db, chiave: str, errore: str):
+        db.execute(text("""
+            INSERT INTO mnet_sync_retry (job, chiave, tentativi, ultimo_errore, updated_at)
+            VALUES (:job, :chiave, 1, :errore, now())
+            ON CONFLICT (job, chiave) DO UPDATE
+               SET tentativi = mnet_sync_retry.tentativi + 1,
+                   ultimo_errore = EXCLUDED.ultimo_errore,
+                   updated_at = now()
+        """), {"job": self.job, "chiave": chiave, "errore": errore[:500]})
+
+    def _segna_ok(self, db, chiavi: list):
+        db.execute(text("""
+            DELETE FROM mnet_sync_retry WHERE job = :job AND chiave = ANY(:chiavi)
+        """), {"job": self.job, "chiavi": chiavi})
+
+    # --- esecuzione ---
+
+    async def run(
+        self,
+        items: list,
+        worker: Callable[["MotornetSyncEngine", object], Awaitable[None]],
+        chiave: Callable[[object], str] = str,
+        da_chiave: Callable[[str], object] = None,
+    ) -> dict:
+        """
+        Esegue `worker(engine, item)` per ogni item con concorrenza limitata.
+        `chiave` serializza un item per la coda retry, `da_chiave` lo ricostruisce:
+        gli item rimasti in coda da un giro precedente vengono rielaborati per primi.
+        """
+        pendenti = await self.scrivi(self._carica_retry)
+        if pendenti:
+            visti = {chiave(i) for i in items}
+            chiavi_extra = [k for k in pendenti if k not in visti]
+            for tracker in self._incrementali:
+                tracker.segna_ripresi(chiavi_extra)
+            extra = [da_chiave(k) if da_chiave else k for k in chiavi_extra]
+            items = extra + list(items)
+            logging.info(f"🔁 [{self.job}] {len(pendenti)} elementi dalla coda retry")
+
+        sem = asyncio.Semaphore(self.concurrency)
+        completati = []
+        t0 = time.monotonic()
+
+        async def _uno(item):
+            async with sem:
+                try:
+                    await worker(self, item)
+                    self.ok += 1
+                    completati.append(chiave(item))
+                except Exception as e:
+                    self.falliti += 1
+                    logging.error(f"❌ [{self.job}] {chiave(item)}: {e}")
+                    await self.scrivi(self._segna_fallito, chiave(item), str(e))
+
+        await asyncio.gather(*(_uno(i) for i in items))
+
+        for tracker in self._incrementali:
+            await tracker.chiudi(self)
+
+        # ultimo flush dei writer a blocchi: i codici di un blocco fallito restano in coda
+        scritte = 0
+        for writer in self._bulk.values():
+            await writer.chiudi()
+            scritte += writer.scritte
+            if writer.falliti:
+                completati = [k for k in completati if k not in writer.falliti]
+                self.ok -= len(writer.falliti)
+                self.falliti += len(writer.falliti)
+
+        if completati and pendenti:
+            await self.scrivi(self._segna_ok, completati)
+
+        stats = {
+            "job": self.job,
+            "totale": len(items),
+            "ok": self.ok,
+            "falliti": self.falliti,
+            "righe_scritte": scritte,
+            "secondi": round(time.monotonic() - t0, 1),
+        }
+        for tracker in self._incrementali:
+            stats.update(tracker.report())
+        logging.info(f"🏁 [{self.job}] {stats}")
+        return stats
+
+
+def esegui_sync(job: str, items: list, worker, **kwargs) -> dict:
+    """Entry point sincrono per APScheduler / script: avvia il motore in un event loop dedicato."""
+    chiave = kwargs.pop("chiave", str)
+    da_chiave = kwargs.pop("da_chiave", None)
+    tracker = kwargs.pop("incrementale", None)
+
+    async def _main():
+        async with MotornetSyncEngine(job, **kwargs) as engine:
+            if tracker is not None:
+                engine.incrementale(tracker)
+            return await engine.run(items, worker, chiave=chiave, da_chiave=da_chiave)
+
+    return asyncio.run(_main())
@@ -0,0 +1,130 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+import requests
+from fastapi import HTTPException
+
+# === Token OAuth Motornet condiviso ===
+# Un solo provider per processo, usato da route e job di sync:
+# - legge `expires_in` e rinnova in anticipo (prima della scadenza)
+# - thread-safe: chi arriva durante un rinnovo attende quello in corso, niente richieste doppie
+# - asyncio-safe: `aget_token()` non blocca il loop e condivide lo stesso rinnovo
+# - su 401 `invalida(token)` scarta solo il token effettivamente usato
+
+MOTORN_AUTH_URL = "https://webservice.motornet.it/auth/realms/webservices/protocol/openid-connect/token"
+MOTORN_USERNAME = os.getenv("MOTORNET_USERNAME", "azure447")
+MOTORN_PASSWORD = os.getenv("MOTORNET_PASSWORD", "azwsn557")
+
+# margine di rinnovo anticipato: il maggiore tra 30s e il 10% della durata del token
+REFRESH_MARGIN_MIN = 30
+REFRESH_MARGIN_RATIO = 0.1
+
+
+class MotornetTokenProvider:
+    def __init__(self, auth_url: str = MOTORN_AUTH_URL, max_attempts: int = 3):
+        self.auth_url = auth_url
+        self.max_attempts = max_attempts
+
+        self._lock = threading.Lock()
+        self._token = None
+        self._expires_at = 0.0
+        self._refresh_at = 0.0
+
+        # metriche
+        self.refresh_count = 0
+        self.refresh_errors = 0
+        self.responses = 0
+        self.unauthorized = 0
+        self.last_refresh_at = None
+
+    def _valido(self) -> bool:
+        return self._token is not None and time.time() < self._refresh_at
+
+    def _refresh(self):
+        payload = {
+            "grant_type": "password",
+            "client_id": "webservice",
+            "username": MOTORN_USERNAME,
+            "password": MOTORN_PASSWORD,
+        }
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+
+        last_status = 502
+        for attempt in range(self.max_attempts):
+            try:
+                resp = requests.post(self.auth_url, headers=headers, data=payload, timeout=15)
+                last_status = resp.status_code
+                if resp.status_code == 200:
+                    data = resp.json()
+                    expires_in = float(data.get("expires_in", 300))
+                    now = time.time()
+                    margin = max(REFRESH_MARGIN_MIN, expires_in * REFRESH_MARGIN_RATIO)
+
+                    self._token = data.get("access_token")
+                    self._expires_at = now + expires_in
+                    self._refresh_at = now + max(expires_in - margin, 0)
+                    self.refresh_count += 1
+                    self.last_refresh_at = now
+                    logging.info(f"🔑 Token Motornet rinnovato (scade tra {int(expires_in)}s)")
+                    return self._token
+
+                logging.error(f"❌ Errore token Motornet {resp.status_code} (tentativo {attempt+1}): {resp.text}")
+            except requests.exceptions.RequestException as e:
+                logging.error(f"❌ Errore rete token Motornet (tentativo {attempt+1}): {e}")
+            self.refresh_errors += 1
+            time.sleep(2)
+
+        raise HTTPException(status_code=last_status, detail="Errore nel recupero del token")
+
+    def get_token(self) -> str:
+        """Token valido; rinnova (una sola volta per tutti i chiamanti) se in scadenza."""
+        if self._valido():
+            return self._token
+        with self._lock:
+            # ricontrollo: un altro thread può aver appena rinnovato
+            if self._valido():
+                return self._token
+            return self._refresh()
+
+    async def aget_token(self) -> str:
+        if self._valido():
+            return self._token
+        return await asyncio.to_thread(self.get_token)
+
+    def invalida(self, token: str = None):
+        """Da chiamare su 401: scarta il token solo se è ancora quello corrente."""
+        self.unauthorized += 1
+        with self._lock:
+            if token is None or token == self._token:
+                self._refresh_at = 0.0
+
+    def registra_risposta(self, status_code: int, token: str = None):
+        """Conteggio risposte Motornet per il tasso di 401; su 401 invalida il token usato."""
+        self.responses += 1
+        if status_code == 401:
+            self.invalida(token)
+
+    def headers(self) -> dict:
+        return {"Authorization": f"Bearer {self.get_token()}"}
+
+    def metrics(self) -> dict:
+        now = time.time()
+        return {
+            "refresh_count": self.refresh_count,
+            "refresh_errors": self.refresh_errors,
+            "responses": self.responses,
+            "unauthorized": self.unauthorized,
+            "unauthorized_rate": round(self.unauthorized / self.responses, 4) if self.responses else 0.0,
+            "token_valid": self._valido(),
+            "expires_in": max(int(self._expires_at - now), 0) if self._token else None,
+            "last_refresh_at": self.last_refresh_at,
+        }
+
+
+motornet_tokens = MotornetTokenProvider()
+
+
+def get_motornet_token() -> str:
+    return motornet_tokens.get_token()
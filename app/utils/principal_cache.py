@@ -0,0 +1,123 @@
+import os
+from dataclasses import dataclass
+from types import SimpleNamespace
+from typing import Optional
+from fastapi import Depends, HTTPException
+from fastapi_jwt_auth import AuthJWT
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+from app.database import get_db
+from app.models import User
+from app.auth_helpers import get_admin_id, get_dealer_id, is_dealer_user
+from app.utils.tenant_cache import TTLCache, _fotografia
+
+# === Utente autenticato (principal) in cache per subject JWT ===
+# Ogni rotta protetta risolveva l'email del token con una query su utenti (e spesso
+# un'altra per il team). Qui una fotografia immutabile con ruolo, parent, admin/dealer
+# effettivi e membri del team, riusata per PRINCIPAL_CACHE_TTL secondi.
+# Qualsiasi insert/update/delete ORM su User svuota la cache al commit;
+# le modifiche via SQL grezzo si riallineano entro il TTL.
+#
+#   current_user = Depends(get_principal)   # current_user.id, .role, .ragione_sociale ...
+
+PRINCIPAL_CACHE_TTL = float(os.getenv("PRINCIPAL_CACHE_TTL", "30"))
+
+
+@dataclass(frozen=True)
+class Principal:
+    id: int
+    email: str
+    role: str
+    parent_id: Optional[int]
+    admin_id: Optional[int]
+    dealer_id: Optional[int]
+    team: tuple                 # (id, role) degli utenti con parent_id = admin/dealer effettivo
+    user: SimpleNamespace       # colonne di User (senza password)
+
+    def __getattr__(self, nome):
+        # compatibilità con il codice che usava l'oggetto User: current_user.nome, .logo_url, ...
+        if nome == "user":
+            raise AttributeError(nome)
+        return getattr(self.user, nome)
+
+    def membri(self, *ruoli: str) -> list:
+        """Id dei membri del team, eventualmente solo con i ruoli indicati."""
+        return [id_ for id_, ruolo in self.team if not ruoli or ruolo in ruoli]
+
+
+_principal_cache = TTLCache(PRINCIPAL_CACHE_TTL)
+
+
+def _carica_principal(db: Session, email: str) -> Optional[Principal]:
+    user = db.query(User).filter(User.email == email).first()
+    if not user:
+        return None
+
+    titolare = get_dealer_id(user) if is_dealer_user(user) else get_admin_id(user)
+    team = ()
+    if titolare:
+        team = tuple(
+            (r.id, r.role)
+            for r in db.query(User.id, User.role).filter(User.parent_id == titolare).order_by(User.id).all()
+        )
+
+    return Principal(
+        id=user.id,
+        email=user.email,
+        role=user.role,
+        parent_id=user.parent_id,
+        admin_id=get_admin_id(user),
+        dealer_id=get_dealer_id(user),
+        team=team,
+        user=_fotografia(user, escludi=("hashed_password", "reset_token", "reset_token_expiration")),
+    )
+
+
+def risolvi_principal(db: Session, email: Optional[str]) -> Optional[Principal]:
+    """Principal dell'email (subject del token) dalla cache o dal DB; None se l'utente non esiste."""
+    if not email:
+        return None
+    return _principal_cache.get_or_load(email, lambda: _carica_principal(db, email))
+
+
+def invalida_principal(email: Optional[str] = None):
+    """Invalida un utente; senza argomenti svuota tutta la cache."""
+    _principal_cache.invalida(email)
+
+
+def principal_cache_metrics() -> dict:
+    return _principal_cache.metrics()
+
+
+def get_principal(Authorize: AuthJWT = Depends(), db: Session = Depends(get_db)) -> Principal:
+    """Dependency unica per le rotte protette: 401 se token non valido o utente inesistente."""
+    Authorize.jwt_required()
+    principal = risolvi_principal(db, Authorize.get_jwt_subject())
+    if not principal:
+        raise HTTPException(status_code=401, detail="Utente non trovato")
+    return principal
+
+
+def get_principal_optional(Authorize: AuthJWT = Depends(), db: Session = Depends(get_db)) -> Optional[Principal]:
+    try:
+        Authorize.jwt_required()
+    except Exception:
+        return None
+    return risolvi_principal(db, Authorize.get_jwt_subject())
+
+
+# --- invalidazione: una modifica a User (anche di team/credito) vale per tutti i principal collegati
+
+@event.listens_for(User, "after_insert")
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _segna_utenti_modificati(mapper, connection, target):
+    sessione = object_session(target)
+    if sessione is not None:
+        sessione.info["principal_da_invalidare"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _invalida_dopo_commit(sessione):
+    if sessione.info.pop("principal_da_invalidare", False):
+        invalida_principal()
@@ -1,203 +1,184 @@
-﻿from sqlalchemy.orm import Session
+﻿from typing import Optional
+from sqlalchemy.orm import Session
 from app.models import SiteAdminSettings
 from app.auth_helpers import is_dealer_user
 
-def calcola_quotazione(offerta, quotazione, current_user, db: Session, settings_corrente: SiteAdminSettings):
-   # print("🟦 [START] calcola_quotazione")
-   # print("🔸 Offerta ID:", offerta.id_offerta)
-   #print("🔸 Slug offerta:", offerta.slug)
-   # print("🔸 Prezzo listino:", offerta.prezzo_listino)
-   # print("🔸 Prezzo totale:", offerta.prezzo_totale)
-   # print("🔸 solo_privati:", offerta.solo_privati)
-   # print("🔸 Player ID:", offerta.id_player)
+# === Motore quotazioni NLT a lotti ===
+# Un'unica implementazione per pagine pubbliche, dettaglio offerta e job di rating:
+# - provvigioni admin lette con UNA query per tutto il lotto (niente query + refresh per offerta)
+# - canone base, IVA e maggiorazione provvigioni calcolati colonna per colonna
+# - `calcola_quotazione` / `calcola_quotazione_custom` restano come wrapper a riga singola
+# Risultato per riga: (durata, km, canone_finale, slug_finale) oppure (None, None, None, None).
 
-    if not offerta or not quotazione or not offerta.prezzo_listino:
-   #     print("❌ Dati iniziali mancanti")
-        return None, None, None, None
+IVA = 1.22
+PLAYER_SENZA_PROVVIGIONI = 5  # UnipolRental
+NESSUNA_QUOTAZIONE = (None, None, None, None)
 
-    # === Selezione canone base ===
-    if offerta.solo_privati and quotazione.mesi_48_30:
-        durata, km, canone_base = 48, 30000, quotazione.mesi_48_30
-        fonte = "mesi_48_30"
-    elif quotazione.mesi_36_10:
-        durata, km, canone_base = 36, 10000, quotazione.mesi_36_10
-        fonte = "mesi_36_10"
-    elif quotazione.mesi_48_10:
-        durata, km, canone_base = 48, 10000, quotazione.mesi_48_10
-        fonte = "mesi_48_10"
-    else:
-    #    print("❌ Nessun canone base disponibile")
-        return None, None, None, None
-
-    # print(f"✅ Canone base selezionato da: {fonte}")
-    # print(f"➡️ Canone base: {canone_base}, durata: {durata} mesi, km: {km}")
 
+def _float(valore) -> Optional[float]:
     try:
-        canone_base = float(canone_base)
+        return float(valore)
     except (TypeError, ValueError):
-      # print("❌ Errore cast canone_base")
-        return None, None, None, None
+        return None
 
-    prezzo_grezzo = offerta.prezzo_totale or offerta.prezzo_listino
-    if not prezzo_grezzo:
-      # print("❌ prezzo_grezzo mancante")
-        return None, None, None, None
 
-    try:
-        prezzo_netto = float(prezzo_grezzo) / 1.22
-    except (TypeError, ValueError):
-      # print("❌ Errore cast prezzo_netto")
-        return None, None, None, None
+def carica_provvigioni_admin(db: Session, admin_ids) -> dict:
+    """admin_id -> (id settings admin, prov_vetrina) con una sola query."""
+    admin_ids = {int(a) for a in admin_ids if a is not None}
+    if not admin_ids:
+        return {}
 
-    # print("➡️ Prezzo netto calcolato:", prezzo_netto)
+    rows = (
+        db.query(SiteAdminSettings.id, SiteAdminSettings.admin_id, SiteAdminSettings.prov_vetrina)
+        .filter(SiteAdminSettings.admin_id.in_(admin_ids), SiteAdminSettings.dealer_id == None)
+        .order_by(SiteAdminSettings.id.asc())
+        .all()
+    )
+    provvigioni = {}
+    for r in rows:
+        provvigioni.setdefault(r.admin_id, (r.id, r.prov_vetrina))
+    return provvigioni
 
-    # === Recupero settings admin ===
-    settings_admin = (
-        db.query(SiteAdminSettings)
-        .filter(
-            SiteAdminSettings.admin_id == int(offerta.id_admin),
-            SiteAdminSettings.dealer_id == None
+
+def seleziona_canone_base(offerta, quotazione):
+    """(durata, km, canone_base) secondo la priorità 48/30 (solo privati), 36/10, 48/10; None se assente."""
+    if not offerta or not quotazione or not offerta.prezzo_listino:
+        return None
+    if offerta.solo_privati and quotazione.mesi_48_30:
+        return 48, 30000, quotazione.mesi_48_30
+    if quotazione.mesi_36_10:
+        return 36, 10000, quotazione.mesi_36_10
+    if quotazione.mesi_48_10:
+        return 48, 10000, quotazione.mesi_48_10
+    return None
+
+
+def _motore(db: Session, offerte: list, durate: list, kms: list, canoni_base: list, settings_corrente) -> list:
+    n = len(offerte)
+    provvigioni = carica_provvigioni_admin(db, {o.id_admin for o in offerte if o is not None})
+
+    # --- colonne di input
+    canone_base = [_float(c) if c else None for c in canoni_base]
+    prezzo_netto = [
+        (p / IVA if p is not None else None)
+        for p in (
+            _float(o.prezzo_totale or o.prezzo_listino) if o is not None and (o.prezzo_totale or o.prezzo_listino) else None
+            for o in offerte
         )
-        .first()
+    ]
+    settings_admin = [provvigioni.get(int(o.id_admin)) if o is not None else None for o in offerte]
+
+    # --- colonne provvigioni (percentuali)
+    prov_admin = [(_float(s[1]) or 0.0) if s else 0.0 for s in settings_admin]
+    id_corrente = getattr(settings_corrente, "id", None)
+    prov_corrente = _float(getattr(settings_corrente, "prov_vetrina", None) or 0) or 0.0
+    prov_dealer = [
+        prov_corrente if settings_corrente is not None and s and id_corrente != s[0] else 0.0
+        for s in settings_admin
+    ]
+    attive = [0.0 if o is not None and o.id_player == PLAYER_SENZA_PROVVIGIONI else 1.0 for o in offerte]
+
+    # --- canone finale = base + netto * (prov_admin + prov_dealer) / 100 / durata
+    slug_finale = settings_corrente.slug if settings_corrente else None
+    risultato = []
+    for i in range(n):
+        if offerte[i] is None or not durate[i] or durate[i] <= 0 or canone_base[i] is None or prezzo_netto[i] is None:
+            risultato.append(NESSUNA_QUOTAZIONE)
+            continue
+        incremento_mensile = prezzo_netto[i] * (prov_admin[i] + prov_dealer[i]) * attive[i] / 100.0 / durate[i]
+        risultato.append((durate[i], kms[i], round(canone_base[i] + incremento_mensile, 2), slug_finale))
+    return risultato
+
+
+def calcola_quotazioni(db: Session, coppie, settings_corrente=None) -> list:
+    """
+    Quotazioni per una lista di (offerta, quotazione) nel contesto di `settings_corrente`
+    (settings dello slug, ORM o fotografia di TenantContext). Un risultato per coppia, stesso ordine.
+    """
+    selezioni = [seleziona_canone_base(o, q) for o, q in coppie]
+    return _motore(
+        db,
+        [o if sel else None for (o, _), sel in zip(coppie, selezioni)],
+        [sel[0] if sel else None for sel in selezioni],
+        [sel[1] if sel else None for sel in selezioni],
+        [sel[2] if sel else None for sel in selezioni],
+        settings_corrente,
     )
 
-    if settings_admin:
-        db.refresh(settings_admin)
-      #  print("✅ settings_admin trovato → ID:", settings_admin.id)
-      #  print("🔎 settings_admin.prov_vetrina:", settings_admin.prov_vetrina, type(settings_admin.prov_vetrina))
-    else:
-        print(f"❌ settings_admin NON trovato per admin_id={offerta.id_admin}")
-      
-    try:
-        prov_admin = float(settings_admin.prov_vetrina)
-    except (TypeError, ValueError, AttributeError):
-        prov_admin = 0.0
-      #  print("⚠️ prov_admin fallback a 0.0")
-
-    # === Provvigione dealer (evita doppio conteggio)
-    prov_dealer = 0.0
-    if settings_corrente and settings_admin and settings_corrente.id != settings_admin.id:
-        try:
-            prov_dealer = float(settings_corrente.prov_vetrina or 0)
-        except (TypeError, ValueError):
-            prov_dealer = 0.0
-       #     print("⚠️ prov_dealer fallback a 0.0")
-   
 
-    slug_finale = settings_corrente.slug if settings_corrente else None
+def calcola_quotazioni_custom(db: Session, righe, settings_corrente=None) -> list:
+    """Come `calcola_quotazioni` ma con (offerta, durata, km, canone_base) già scelti dal chiamante."""
+    righe = list(righe)
+    return _motore(
+        db,
+        [r[0] for r in righe],
+        [r[1] for r in righe],
+        [r[2] for r in righe],
+        [r[3] for r in righe],
+        settings_corrente,
+    )
 
-    # === Blocco provvigioni UnipolRental
-    if offerta.id_player == 5:
-       # print("🛑 Provvigioni azzerate (id_player == 5)")
-        prov_admin = 0.0
-        prov_dealer = 0.0
-
-    incremento_totale = prezzo_netto * (prov_admin + prov_dealer) / 100.0
-    incremento_mensile = incremento_totale / durata
-    canone_finale = canone_base + incremento_mensile
-
-  #  print("🧮 DEBUG FINALE")
-  #  print("📦 canone_base:", canone_base)
-  #  print("📦 prezzo_netto:", prezzo_netto)
-  #  print("📦 prov_admin:", prov_admin)
-  #  print("📦 prov_dealer:", prov_dealer)
-  #  print("📦 incremento_totale:", incremento_totale)
-  #  print("📦 incremento_mensile:", incremento_mensile)
-  #  print("📦 canone_finale:", canone_finale)
-  #  print("📤 slug_finale:", slug_finale)
-  #  print("✅ [END] calcola_quotazione")
-
-    return durata, km, round(canone_finale, 2), slug_finale
-
-
-def calcola_quotazione_custom(offerta, durata, km, canone_base, current_user, db: Session, settings_corrente: SiteAdminSettings):
-  #  print("🟦 [START] calcola_quotazione_custom")
-  #  print("🔸 Offerta ID:", offerta.id_offerta)
-  #  print("🔸 Slug offerta:", offerta.slug)
-  #  print("🔸 durata:", durata, "km:", km)
-  #  print("🔸 Player ID:", offerta.id_player)
-
-    if not offerta or not durata or durata <= 0 or not canone_base:
-  #      print("❌ Dati iniziali mancanti o non validi")
-        return None, None, None, None
 
-    try:
-        canone_base = float(canone_base)
-    except (TypeError, ValueError):
-   #     print("❌ Errore cast canone_base")
-        return None, None, None, None
+def calcola_quotazione(offerta, quotazione, current_user, db: Session, settings_corrente: SiteAdminSettings = None):
+    return calcola_quotazioni(db, [(offerta, quotazione)], settings_corrente)[0]
 
-    prezzo_grezzo = offerta.prezzo_totale or offerta.prezzo_listino
-    if not prezzo_grezzo:
-    #    print("❌ prezzo_grezzo mancante")
-        return None, None, None, None
 
-    try:
-        prezzo_netto = float(prezzo_grezzo) / 1.22
-    except (TypeError, ValueError):
-    #   print("❌ Errore cast prezzo_netto")
-        return None, None, None, None
+def calcola_quotazione_custom(offerta, durata, km, canone_base, current_user, db: Session, settings_corrente: SiteAdminSettings = None):
+    return calcola_quotazioni_custom(db, [(offerta, durata, km, canone_base)], settings_corrente)[0]
 
-    # print("➡️ Prezzo netto calcolato:", prezzo_netto)
 
-    settings_admin = (
-        db.query(SiteAdminSettings)
-        .filter(SiteAdminSettings.admin_id == int(offerta.id_admin), SiteAdminSettings.dealer_id == None)
-        .first()
-    )
+# === Configuratore (/nlt/calcola-canone e matrice durate × km) ===
+# Prezzo su prezzo_totale lordo + provvigione extra del consulente, opzioni e IVA solo privati.
 
-    if settings_admin:
-        db.refresh(settings_admin)
-    #    print("✅ settings_admin ID:", settings_admin.id)
-    #    print("🔎 prov_vetrina (admin):", settings_admin.prov_vetrina, type(settings_admin.prov_vetrina))
-    else:
-        print(f"❌ settings_admin NON trovato per admin_id={offerta.id_admin}")
+DURATE_CONFIGURATORE = (36, 48, 60)
+KM_CONFIGURATORE = (10, 15, 20, 25, 30, 40)  # migliaia di km/anno, come le colonne mesi_{durata}_{km}
 
-    try:
-        prov_admin = float(settings_admin.prov_vetrina)
-    except (TypeError, ValueError, AttributeError):
-        prov_admin = 0.0
-    #    print("⚠️ prov_admin fallback a 0.0")
 
-    prov_dealer = 0.0
-    if settings_corrente and settings_admin and settings_corrente.id != settings_admin.id:
-        try:
-            prov_dealer = float(settings_corrente.prov_vetrina or 0)
-        except (TypeError, ValueError):
-            prov_dealer = 0.0
-    #        print("⚠️ prov_dealer fallback a 0.0")
-    
+def colonne_popolate(quotazione) -> list:
+    """(durata, km, canone_base) per ogni colonna mesi_{durata}_{km} valorizzata."""
+    colonne = []
+    for durata in DURATE_CONFIGURATORE:
+        for km in KM_CONFIGURATORE:
+            canone_base = getattr(quotazione, f"mesi_{durata}_{km}", None)
+            if canone_base:
+                colonne.append((durata, km, canone_base))
+    return colonne
 
-    slug_finale = settings_corrente.slug if settings_corrente else None
 
-    if offerta.id_player == 5:
-    #    print("🛑 Provvigioni azzerate (id_player == 5)")
-        prov_admin = 0.0
-        prov_dealer = 0.0
+def canone_configuratore(
+    offerta,
+    canone_base,
+    durata: int,
+    prov_admin,
+    provvigione_extra: float = 0.0,
+    anticipo: float = 0.0,
+    costo_treno: Optional[float] = None,
+    n_treni: int = 1,
+    costo_sostitutiva: Optional[float] = None,
+) -> float:
+    """Canone mensile del configuratore; costo_treno / costo_sostitutiva None = opzione non scelta."""
+    # 🔒 Eccezione per Unipolrental: provvigione extra ignorata
+    prov_totale = _float(prov_admin) or 0.0
+    if offerta.id_player != PLAYER_SENZA_PROVVIGIONI:
+        prov_totale += provvigione_extra or 0.0
 
-    incremento_totale = prezzo_netto * (prov_admin + prov_dealer) / 100.0
-    incremento_mensile = incremento_totale / durata
-    canone_finale = canone_base + incremento_mensile
+    incremento = float(offerta.prezzo_totale) * prov_totale / 100.0
+    canone = float(canone_base) + incremento / durata
 
-    #print("🧮 DEBUG FINALE (custom)")
-    #print("📦 canone_base:", canone_base)
-    #print("📦 prezzo_netto:", prezzo_netto)
-    #print("📦 prov_admin:", prov_admin)
-    ##print("📦 prov_dealer:", prov_dealer)
-    #print("📦 incremento_totale:", incremento_totale)
-    #print("📦 incremento_mensile:", incremento_mensile)
-    #print("📦 canone_finale:", canone_finale)
-    #print("📤 slug_finale:", slug_finale)
-    #print("✅ [END] calcola_quotazione_custom")
+    if anticipo and anticipo > 0:
+        canone -= anticipo / durata
+    if costo_treno is not None:
+        canone += costo_treno * n_treni / durata
+    if costo_sostitutiva is not None:
+        canone += costo_sostitutiva
 
-    return durata, km, round(canone_finale, 2), slug_finale
+    if offerta.solo_privati:
+        canone *= IVA
+    return round(canone, 2)
 
 
 def aggiorna_rating_convenienza(db: Session):
     from app.models import NltOfferte, NltQuotazioni, NltOfferteRating
-    from app.utils.quotazioni import calcola_quotazione  # evita import circolari
-    from app.auth_helpers import is_dealer_user  # se necessario, ma lo bypassiamo con dealer_context=False
-
     from datetime import datetime
 
     offerte_raw = (
@@ -213,18 +194,10 @@ def aggiorna_rating_convenienza(db: Session):
 
     risultati = []
 
-    for offerta, quotazione in offerte_raw:
-        from types import SimpleNamespace
-        dummy_user = SimpleNamespace(role="admin", id=offerta.id_admin)
-
-        durata, km, canone_finale, _ = calcola_quotazione(
-            offerta, quotazione,
-            current_user=dummy_user,
-            db=db,
-            dealer_context=False,
-            dealer_id=None
-        )
+    # contesto admin (nessuna provvigione dealer): un solo lotto per tutte le offerte
+    quotazioni = calcola_quotazioni(db, offerte_raw, settings_corrente=None)
 
+    for (offerta, quotazione), (durata, km, canone_finale, _) in zip(offerte_raw, quotazioni):
 
         if not durata or not km or not canone_finale:
             continue
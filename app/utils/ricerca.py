@@ -0,0 +1,60 @@
+import os
+import re
+from dataclasses import dataclass, field
+from typing import Optional
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+# === Ricerca testuale (vedi ricerca_schema.sql) ===
+# Stessa logica per vetrina NLT (nlt_catalogo_vetrina), vetrina usato e contesto
+# dell'assistente (mnet_dettagli_usato). Ogni tabella espone:
+#   - search_vector: tsvector 'simple' di marca/modello/versione → match per prefisso
+#   - testo_ricerca: testo minuscolo con indice GIN pg_trgm → match con errori di battitura
+# Una riga corrisponde se almeno una parola combacia per prefisso OPPURE se la frase
+# è abbastanza simile (word_similarity) a una porzione del testo; la rilevanza somma i due punteggi.
+
+SOGLIA_SIMILARITA = float(os.getenv("RICERCA_SOGLIA_TRGM", "0.45"))
+MIN_LUNGHEZZA_TERMINE = 2
+
+
+@dataclass
+class FiltroRicerca:
+    where: str
+    rilevanza: str
+    params: dict = field(default_factory=dict)
+
+
+def termini_ricerca(q: Optional[str]) -> list:
+    if not q:
+        return []
+    termini = [re.sub(r"[^\w]", "", t) for t in q.lower().split()]
+    return [t for t in termini if len(t) >= MIN_LUNGHEZZA_TERMINE]
+
+
+def filtro_ricerca(q: Optional[str], testo_col: str, vettore_col: str, prefisso: str = "ric") -> Optional[FiltroRicerca]:
+    """
+    Frammenti SQL (where + espressione di rilevanza) per la ricerca `q` sulle colonne date.
+    None se `q` non contiene termini utili.
+    """
+    termini = termini_ricerca(q)
+    if not termini:
+        return None
+
+    p_tsq, p_q = f"{prefisso}_tsq", f"{prefisso}_q"
+    tsquery = f"to_tsquery('simple', :{p_tsq})"
+    return FiltroRicerca(
+        where=f"({vettore_col} @@ {tsquery} OR :{p_q} <% {testo_col})",
+        rilevanza=f"(ts_rank({vettore_col}, {tsquery}) + word_similarity(:{p_q}, {testo_col}))",
+        params={
+            p_tsq: " | ".join(f"{t}:*" for t in termini),
+            p_q: " ".join(termini),
+        },
+    )
+
+
+def applica_soglia(db: Session):
+    """Soglia di word_similarity per l'operatore <% (solo per la transazione corrente)."""
+    db.execute(
+        text("SELECT set_config('pg_trgm.word_similarity_threshold', :soglia, true)"),
+        {"soglia": str(SOGLIA_SIMILARITA)},
+    )
@@ -0,0 +1,88 @@
+import os
+import re
+import threading
+import time
+from typing import Optional
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from app.models import NltPneumatici, NltAutoSostitutiva
+from app.utils.tenant_cache import TTLCache
+
+# === Servizi extra del preventivo NLT: pneumatici e auto sostitutiva ===
+# - diametro cerchio precalcolato per codice_motornet_uni (mnet_dettagli.diametro_cerchio,
+#   scritto dal sync dettagli) e tenuto in cache: niente chiamate HTTP a Motornet/a noi stessi
+# - listini nlt_pneumatici e nlt_autosostitutiva (poche righe) tenuti interi in memoria,
+#   ricaricati ogni SERVIZI_EXTRA_TTL secondi
+
+SERVIZI_EXTRA_TTL = float(os.getenv("SERVIZI_EXTRA_TTL", "600"))
+DIAMETRO_TTL = float(os.getenv("DIAMETRO_CERCHIO_TTL", "86400"))
+
+_RE_DIAMETRO = re.compile(r"R(\d{2})")
+
+
+def diametro_da_misure(*misure: Optional[str]) -> Optional[int]:
+    """Diametro maggiore (pollici) tra le misure pneumatici Motornet, es. '225/45 R17'."""
+    diametri = []
+    for misura in misure:
+        match = _RE_DIAMETRO.search(misura or "")
+        if match:
+            diametri.append(int(match.group(1)))
+    return max(diametri) if diametri else None
+
+
+class ListiniServiziExtra:
+    """Costo treno per diametro e costo mensile auto sostitutiva per segmento, in memoria."""
+
+    def __init__(self, ttl: float = SERVIZI_EXTRA_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._pneumatici: dict = {}
+        self._sostitutiva: dict = {}
+        self._caricato_il = 0.0
+
+    def _carica(self, db: Session):
+        with self._lock:
+            if time.monotonic() - self._caricato_il < self.ttl:
+                return
+            self._pneumatici = {int(r.diametro): float(r.costo_treno) for r in db.query(NltPneumatici).all()}
+            self._sostitutiva = {r.segmento.upper(): float(r.costo_mensile) for r in db.query(NltAutoSostitutiva).all()}
+            self._caricato_il = time.monotonic()
+
+    def costo_treno(self, db: Session, diametro: int) -> Optional[float]:
+        self._carica(db)
+        return self._pneumatici.get(int(diametro))
+
+    def costo_sostitutiva(self, db: Session, segmento: str) -> Optional[float]:
+        self._carica(db)
+        return self._sostitutiva.get((segmento or "").upper())
+
+    def invalida(self):
+        with self._lock:
+            self._caricato_il = 0.0
+
+
+listini_servizi_extra = ListiniServiziExtra()
+_diametri = TTLCache(DIAMETRO_TTL)
+
+
+def _leggi_diametro(db: Session, codice_motornet: str) -> Optional[int]:
+    row = db.execute(text("""
+        SELECT diametro_cerchio, pneumatici_anteriori, pneumatici_posteriori
+        FROM mnet_dettagli
+        WHERE codice_motornet_uni = :codice
+    """), {"codice": codice_motornet}).fetchone()
+    if not row:
+        return None
+    # righe non ancora ripassate dal sync: calcolo al volo dalle misure salvate
+    return row.diametro_cerchio or diametro_da_misure(row.pneumatici_anteriori, row.pneumatici_posteriori)
+
+
+def diametro_cerchio(db: Session, codice_motornet: str) -> Optional[int]:
+    """Diametro cerchio dell'allestimento, dalla cache o da mnet_dettagli."""
+    return _diametri.get_or_load(codice_motornet, lambda: _leggi_diametro(db, codice_motornet))
+
+
+def ricorda_diametro(codice_motornet: str, diametro: Optional[int]):
+    """Da chiamare quando il diametro è già noto (es. letto in join con l'offerta)."""
+    if diametro:
+        _diametri.set(codice_motornet, int(diametro))
@@ -0,0 +1,277 @@
+import os
+import hmac
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+from abc import ABC, abstractmethod
+from typing import Optional, Union, BinaryIO
+from urllib.parse import quote
+import httpx
+from app.utils.executors import run_io
+
+# === Client storage (Supabase Storage via REST, o filesystem locale) ===
+# Un solo client per processo al posto dell'SDK sincrono chiamato dagli handler async:
+#   - pool di connessioni HTTP/2 condiviso (una connessione, richieste multiplexate)
+#   - upload di più oggetti in parallelo (STORAGE_CONCORRENZA)
+#   - URL firmate di più oggetti con una sola chiamata
+#   - upload in streaming da file aperto (video grandi: niente bytes interi in memoria)
+# STORAGE_BACKEND=locale scrive in STORAGE_LOCAL_DIR con la stessa interfaccia (test offline).
+#
+#   url = await storage.upload_e_firma("leonardo-video", path, blob, "image/png")
+#   urls = await storage.firma_molti(bucket, [p1, p2])          # {path: url}
+#   pubblico = storage.carica_sync(bucket, path, blob, "image/webp")   # script sincroni
+
+SCADENZA_FIRMA = 60 * 60 * 24 * 30  # 30 giorni
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "supabase").lower()
+STORAGE_CONCORRENZA = int(os.getenv("STORAGE_CONCORRENZA", "8"))
+STORAGE_LOCAL_DIR = os.getenv("STORAGE_LOCAL_DIR", "/tmp/core_api_storage")
+STORAGE_LOCAL_URL = os.getenv("STORAGE_LOCAL_URL", "http://localhost:8000/storage")
+CHUNK_STREAM = 1024 * 1024
+
+Dati = Union[bytes, BinaryIO]
+
+
+class StorageError(RuntimeError):
+    pass
+
+
+class StorageBase(ABC):
+    """Interfaccia comune dei backend: un backend senza uno dei metodi astratti non si istanzia."""
+
+    @abstractmethod
+    async def upload(self, bucket: str, path: str, dati: Dati, content_type: str, upsert: bool = True) -> str:
+        ...
+
+    @abstractmethod
+    async def firma_molti(self, bucket: str, paths: list, scadenza: int = SCADENZA_FIRMA) -> dict:
+        ...
+
+    @abstractmethod
+    def url_pubblico(self, bucket: str, path: str) -> str:
+        ...
+
+    @abstractmethod
+    def carica_sync(self, bucket: str, path: str, dati: bytes, content_type: str, upsert: bool = False) -> str:
+        """Upload da codice sincrono (script, job sync); restituisce l'URL pubblico."""
+
+    @abstractmethod
+    def firma_molti_sync(self, bucket: str, paths: list, scadenza: int = SCADENZA_FIRMA) -> dict:
+        """Come firma_molti, da codice sincrono (rotte sync, generatori)."""
+
+    async def firma(self, bucket: str, path: str, scadenza: int = SCADENZA_FIRMA) -> Optional[str]:
+        return (await self.firma_molti(bucket, [path], scadenza)).get(path)
+
+    async def upload_molti(self, bucket: str, oggetti: list, upsert: bool = True) -> list:
+        """oggetti = [(path, dati, content_type), ...] caricati in parallelo (al massimo STORAGE_CONCORRENZA)."""
+        semaforo = asyncio.Semaphore(STORAGE_CONCORRENZA)
+
+        async def _uno(path, dati, content_type):
+            async with semaforo:
+                return await self.upload(bucket, path, dati, content_type, upsert)
+
+        return await asyncio.gather(*(_uno(*o) for o in oggetti))
+
+    async def upload_e_firma(self, bucket: str, path: str, dati: Dati, content_type: str,
+                             scadenza: int = SCADENZA_FIRMA) -> Optional[str]:
+        await self.upload(bucket, path, dati, content_type)
+        return await self.firma(bucket, path, scadenza)
+
+    async def upload_e_firma_molti(self, bucket: str, oggetti: list, scadenza: int = SCADENZA_FIRMA) -> dict:
+        """Upload paralleli e una sola chiamata di firma: {path: url firmata}."""
+        await self.upload_molti(bucket, oggetti)
+        return await self.firma_molti(bucket, [o[0] for o in oggetti], scadenza)
+
+    async def chiudi(self):
+        pass
+
+
+class SupabaseStorage(StorageBase):
+    def __init__(self, url: Optional[str] = None, chiave: Optional[str] = None):
+        self.base = (url or os.getenv("SUPABASE_URL", "")).rstrip("/")
+        self.chiave = chiave or os.getenv("SUPABASE_KEY", "")
+        self._client: Optional[httpx.AsyncClient] = None
+        self._loop = None
+        self._client_sync: Optional[httpx.Client] = None
+        self._lock = threading.Lock()
+
+    def _headers(self, **extra) -> dict:
+        return {"Authorization": f"Bearer {self.chiave}", "apikey": self.chiave, **extra}
+
+    def _limiti(self) -> httpx.Limits:
+        return httpx.Limits(max_connections=STORAGE_CONCORRENZA * 2, max_keepalive_connections=STORAGE_CONCORRENZA)
+
+    def _async(self) -> httpx.AsyncClient:
+        # il pool è legato all'event loop: uno per loop (app web, worker, asyncio.run negli script)
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._loop is not loop:
+            self._client = httpx.AsyncClient(base_url=f"{self.base}/storage/v1", http2=True,
+                                             limits=self._limiti(), timeout=httpx.Timeout(120, connect=10))
+            self._loop = loop
+        return self._client
+
+    def _sync(self) -> httpx.Client:
+        with self._lock:
+            if self._client_sync is None:
+                self._client_sync = httpx.Client(base_url=f"{self.base}/storage/v1", http2=True,
+                                                 limits=self._limiti(), timeout=httpx.Timeout(120, connect=10))
+            return self._client_sync
+
+    @staticmethod
+    def _oggetto(bucket: str, path: str) -> str:
+        return f"/object/{bucket}/{quote(path.lstrip('/'))}"
+
+    def _assoluta(self, url: Optional[str]) -> Optional[str]:
+        if not url or url.startswith("http"):
+            return url
+        if url.startswith("/storage"):
+            return f"{self.base}{url}"
+        return f"{self.base}/storage/v1{url}"
+
+    @staticmethod
+    async def _post(client: httpx.AsyncClient, url: str, cosa: str, **kwargs) -> httpx.Response:
+        # errori di rete come StorageError: i chiamanti gestiscono un solo tipo di errore
+        try:
+            return await client.post(url, **kwargs)
+        except httpx.HTTPError as e:
+            raise StorageError(f"Errore rete {cosa} Supabase: {e}") from e
+
+    @staticmethod
+    def _post_sync(client: httpx.Client, url: str, cosa: str, **kwargs) -> httpx.Response:
+        try:
+            return client.post(url, **kwargs)
+        except httpx.HTTPError as e:
+            raise StorageError(f"Errore rete {cosa} Supabase: {e}") from e
+
+    @staticmethod
+    def _verifica(r: httpx.Response, cosa: str):
+        if r.status_code >= 300:
+            raise StorageError(f"Errore {cosa} Supabase ({r.status_code}): {r.text[:300]}")
+
+    async def upload(self, bucket: str, path: str, dati: Dati, content_type: str, upsert: bool = True) -> str:
+        if isinstance(dati, (bytes, bytearray)):
+            corpo = dati
+        else:
+            # file aperto: spedito a blocchi, letti nel pool io
+            async def _blocchi():
+                while True:
+                    blocco = await run_io(dati.read, CHUNK_STREAM)
+                    if not blocco:
+                        return
+                    yield blocco
+            corpo = _blocchi()
+        r = await self._post(
+            self._async(), self._oggetto(bucket, path), "upload", content=corpo,
+            headers=self._headers(**{"Content-Type": content_type, "x-upsert": "true" if upsert else "false"}),
+        )
+        self._verifica(r, "upload")
+        return path
+
+    async def firma_molti(self, bucket: str, paths: list, scadenza: int = SCADENZA_FIRMA) -> dict:
+        if not paths:
+            return {}
+        r = await self._post(self._async(), f"/object/sign/{bucket}", "firma",
+                             json={"expiresIn": scadenza, "paths": list(paths)}, headers=self._headers())
+        return self._firmate(r, bucket)
+
+    def firma_molti_sync(self, bucket: str, paths: list, scadenza: int = SCADENZA_FIRMA) -> dict:
+        if not paths:
+            return {}
+        r = self._post_sync(self._sync(), f"/object/sign/{bucket}", "firma",
+                            json={"expiresIn": scadenza, "paths": list(paths)}, headers=self._headers())
+        return self._firmate(r, bucket)
+
+    def _firmate(self, r: httpx.Response, bucket: str) -> dict:
+        self._verifica(r, "firma")
+        firmate = {}
+        for voce in r.json():
+            if voce.get("error"):
+                logging.warning(f"⚠️ Firma storage fallita per {bucket}/{voce.get('path')}: {voce['error']}")
+                continue
+            firmate[voce.get("path")] = self._assoluta(voce.get("signedURL") or voce.get("signedUrl"))
+        return firmate
+
+    def url_pubblico(self, bucket: str, path: str) -> str:
+        return f"{self.base}/storage/v1/object/public/{bucket}/{path.lstrip('/')}"
+
+    def carica_sync(self, bucket: str, path: str, dati: bytes, content_type: str, upsert: bool = False) -> str:
+        r = self._post_sync(
+            self._sync(), self._oggetto(bucket, path), "upload", content=dati,
+            headers=self._headers(**{"Content-Type": content_type, "x-upsert": "true" if upsert else "false"}),
+        )
+        self._verifica(r, "upload")
+        return self.url_pubblico(bucket, path)
+
+    async def chiudi(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        if self._client_sync is not None:
+            self._client_sync.close()
+            self._client_sync = None
+
+
+class LocalStorage(StorageBase):
+    """Stessa interfaccia su filesystem: bucket = cartella, URL firmate con HMAC e scadenza."""
+
+    def __init__(self, directory: str = STORAGE_LOCAL_DIR, base_url: str = STORAGE_LOCAL_URL,
+                 segreto: Optional[str] = None):
+        self.directory = directory
+        self.base_url = base_url.rstrip("/")
+        self.segreto = (segreto or os.getenv("STORAGE_LOCAL_SECRET", "locale")).encode("utf-8")
+
+    def _percorso(self, bucket: str, path: str) -> str:
+        completo = os.path.realpath(os.path.join(self.directory, bucket, path.lstrip("/")))
+        if not completo.startswith(os.path.realpath(os.path.join(self.directory, bucket)) + os.sep):
+            raise StorageError(f"Path non valido: {path}")
+        return completo
+
+    def _scrivi(self, bucket: str, path: str, dati: Dati, upsert: bool):
+        destinazione = self._percorso(bucket, path)
+        if not upsert and os.path.exists(destinazione):
+            raise StorageError(f"Oggetto già esistente: {bucket}/{path}")
+        os.makedirs(os.path.dirname(destinazione), exist_ok=True)
+        with open(destinazione + ".tmp", "wb") as f:
+            if isinstance(dati, (bytes, bytearray)):
+                f.write(dati)
+            else:
+                while True:
+                    blocco = dati.read(CHUNK_STREAM)
+                    if not blocco:
+                        break
+                    f.write(blocco)
+        os.replace(destinazione + ".tmp", destinazione)
+
+    def firma_locale(self, bucket: str, path: str, scade: int) -> str:
+        return hmac.new(self.segreto, f"{bucket}/{path}:{scade}".encode("utf-8"), hashlib.sha256).hexdigest()
+
+    async def upload(self, bucket: str, path: str, dati: Dati, content_type: str, upsert: bool = True) -> str:
+        await asyncio.to_thread(self._scrivi, bucket, path, dati, upsert)
+        return path
+
+    async def firma_molti(self, bucket: str, paths: list, scadenza: int = SCADENZA_FIRMA) -> dict:
+        return self.firma_molti_sync(bucket, paths, scadenza)
+
+    def firma_molti_sync(self, bucket: str, paths: list, scadenza: int = SCADENZA_FIRMA) -> dict:
+        scade = int(time.time()) + int(scadenza)
+        return {
+            p: f"{self.base_url}/sign/{bucket}/{p.lstrip('/')}?exp={scade}&token={self.firma_locale(bucket, p, scade)}"
+            for p in paths if os.path.exists(self._percorso(bucket, p))
+        }
+
+    def url_pubblico(self, bucket: str, path: str) -> str:
+        return f"{self.base_url}/public/{bucket}/{path.lstrip('/')}"
+
+    def carica_sync(self, bucket: str, path: str, dati: bytes, content_type: str, upsert: bool = False) -> str:
+        self._scrivi(bucket, path, dati, upsert)
+        return self.url_pubblico(bucket, path)
+
+
+def crea_storage() -> StorageBase:
+    if STORAGE_BACKEND == "locale":
+        return LocalStorage()
+    return SupabaseStorage()
+
+
+storage = crea_storage()
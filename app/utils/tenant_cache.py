@@ -0,0 +1,155 @@
+import os
+import time
+import threading
+from dataclasses import dataclass, field
+from types import SimpleNamespace
+from typing import Any, Callable, Optional
+from fastapi import Depends, HTTPException
+from sqlalchemy.orm import Session
+from app.database import get_db
+from app.models import SiteAdminSettings, User
+
+# === Contesto tenant per slug (cache in-process) ===
+# Le pagine pubbliche partono tutte da slug -> SiteAdminSettings -> User -> admin effettivo.
+# Il risolutore fa queste query una volta ogni TTL e restituisce una fotografia
+# staccata dalla sessione (niente lazy load, riusabile tra richieste e thread).
+# Le scritture su site-settings invalidano subito la voce nel processo corrente;
+# gli altri worker si riallineano entro il TTL.
+
+TENANT_CACHE_TTL = float(os.getenv("TENANT_CACHE_TTL", "60"))
+
+
+class TTLCache:
+    """Cache chiave -> valore con scadenza, thread-safe."""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._voci: dict = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, chiave) -> Optional[Any]:
+        with self._lock:
+            voce = self._voci.get(chiave)
+            if voce is None or voce[0] <= time.monotonic():
+                self._voci.pop(chiave, None)
+                self.misses += 1
+                return None
+            self.hits += 1
+            return voce[1]
+
+    def set(self, chiave, valore):
+        with self._lock:
+            self._voci[chiave] = (time.monotonic() + self.ttl, valore)
+
+    def get_or_load(self, chiave, loader: Callable[[], Any]):
+        """Valore in cache o caricato con `loader()`; None non viene memorizzato."""
+        valore = self.get(chiave)
+        if valore is None:
+            valore = loader()
+            if valore is not None:
+                self.set(chiave, valore)
+        return valore
+
+    def invalida(self, chiave=None):
+        with self._lock:
+            if chiave is None:
+                self._voci.clear()
+            else:
+                self._voci.pop(chiave, None)
+
+    def metrics(self) -> dict:
+        return {"entries": len(self._voci), "hits": self.hits, "misses": self.misses}
+
+
+def _fotografia(row, escludi: tuple = ()) -> Optional[SimpleNamespace]:
+    if row is None:
+        return None
+    return SimpleNamespace(**{
+        col.name: getattr(row, col.name)
+        for col in row.__table__.columns
+        if col.name not in escludi
+    })
+
+
+@dataclass(frozen=True)
+class TenantContext:
+    slug: str
+    settings: SimpleNamespace              # colonne di SiteAdminSettings
+    admin_id: int                          # admin effettivo (parent del dealer)
+    dealer_id: Optional[int]
+    user: Optional[SimpleNamespace]        # dealer se presente, altrimenti admin
+    admin_user: Optional[SimpleNamespace]
+    dealer_user: Optional[SimpleNamespace] = None
+    dealer_defaults: dict = field(default_factory=dict)  # logo/nome/indirizzo della vetrina
+
+
+_tenant_cache = TTLCache(TENANT_CACHE_TTL)
+
+
+def _carica_tenant(db: Session, slug: str) -> Optional[TenantContext]:
+    settings = db.query(SiteAdminSettings).filter(SiteAdminSettings.slug == slug).first()
+    if not settings:
+        return None
+
+    ids = {settings.admin_id} | ({settings.dealer_id} if settings.dealer_id else set())
+    utenti = {u.id: u for u in db.query(User).filter(User.id.in_(ids)).all()}
+    admin_user = _fotografia(utenti.get(settings.admin_id), escludi=("hashed_password",))
+    dealer_user = _fotografia(utenti.get(settings.dealer_id), escludi=("hashed_password",)) if settings.dealer_id else None
+    user = dealer_user if settings.dealer_id else admin_user
+
+    if user is not None and user.role == "dealer" and user.parent_id:
+        admin_id = user.parent_id
+    else:
+        admin_id = user.id if user is not None else settings.admin_id
+
+    return TenantContext(
+        slug=slug,
+        settings=_fotografia(settings),
+        admin_id=admin_id,
+        dealer_id=settings.dealer_id,
+        user=user,
+        admin_user=admin_user,
+        dealer_user=dealer_user,
+        dealer_defaults={
+            "logo": settings.logo_web,
+            "nome": settings.meta_title,
+            "indirizzo": settings.contact_address,
+        },
+    )
+
+
+def risolvi_tenant(db: Session, slug: str) -> Optional[TenantContext]:
+    """Contesto dello slug dalla cache (o dal DB se scaduto); None se lo slug non esiste."""
+    return _tenant_cache.get_or_load(slug, lambda: _carica_tenant(db, slug))
+
+
+def invalida_tenant(*slugs: Optional[str]):
+    """Invalida gli slug indicati; senza argomenti svuota tutta la cache."""
+    if not slugs:
+        _tenant_cache.invalida()
+        return
+    for slug in slugs:
+        if slug:
+            _tenant_cache.invalida(slug)
+
+
+def tenant_cache_metrics() -> dict:
+    return {"ttl": TENANT_CACHE_TTL, **_tenant_cache.metrics()}
+
+
+# === Dipendenze FastAPI ===
+
+def get_tenant(slug: str, db: Session = Depends(get_db)) -> TenantContext:
+    tenant = risolvi_tenant(db, slug)
+    if not tenant:
+        raise HTTPException(status_code=404, detail=f"Slug '{slug}' non trovato.")
+    return tenant
+
+
+def get_tenant_dealer(slug_dealer: str, db: Session = Depends(get_db)) -> TenantContext:
+    tenant = risolvi_tenant(db, slug_dealer)
+    if not tenant:
+        raise HTTPException(status_code=404, detail=f"Dealer '{slug_dealer}' non trovato.")
+    return tenant
@@ -0,0 +1,200 @@
+import os
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from app.database import SessionLocal
+from app.utils.executors import run_db
+from app.utils.storage import SCADENZA_FIRMA, storage
+from app.utils.tenant_cache import TTLCache
+
+# === URL firmate dei media in storage (vedi url_firmate_schema.sql) ===
+# Le URL dei media AI sono firmate 30 giorni: la lettura non usa più la colonna
+# public_url ma passa da qui, per storage_path.
+#   1) cache in memoria (URL_FIRMATE_CACHE_TTL secondi)
+#   2) tabella storage_url_firmate, condivisa tra repliche
+#   3) firma in blocco dei path mancanti o in scadenza, salvata in tabella
+# Il job rinnova_url_firmate rifirma a lotti le URL che scadono entro
+# URL_FIRMATE_ANTICIPO_ORE: in lettura il passo 3 resta un'eccezione.
+#
+#   urls = url_firmate(db, [r.storage_path for r in rows])   # {path: url}
+
+BUCKET_MEDIA_AI = os.getenv("SUPABASE_BUCKET_LEONARDO", "leonardo-video")
+URL_FIRMATE_CACHE_TTL = float(os.getenv("URL_FIRMATE_CACHE_TTL", "3600"))
+MARGINE = timedelta(hours=float(os.getenv("URL_FIRMATE_MARGINE_ORE", "24")))          # validità minima servita
+ANTICIPO_RINNOVO = timedelta(hours=float(os.getenv("URL_FIRMATE_ANTICIPO_ORE", "72")))
+LOTTO_RINNOVO = 500
+
+_cache = TTLCache(URL_FIRMATE_CACHE_TTL)
+
+UPSERT_FIRME = text("""
+    INSERT INTO public.storage_url_firmate (bucket, path, url, scade_il, firmato_il)
+    SELECT :bucket, f.path, f.url, :scade_il, now()
+    FROM unnest(CAST(:paths AS text[]), CAST(:urls AS text[])) AS f(path, url)
+    ON CONFLICT (bucket, path) DO UPDATE
+       SET url = EXCLUDED.url, scade_il = EXCLUDED.scade_il, firmato_il = EXCLUDED.firmato_il
+""")
+
+
+def _adesso() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def _memorizza(bucket: str, firmate: dict, scade_il: datetime):
+    for path, url in firmate.items():
+        _cache.set((bucket, path), (url, scade_il))
+
+
+def registra_firme(db: Session, bucket: str, firmate: dict, scade_il: Optional[datetime] = None):
+    """Salva URL appena firmate (es. subito dopo l'upload). Non fa commit."""
+    firmate = {p: u for p, u in firmate.items() if p and u}
+    if not firmate:
+        return
+    scade_il = scade_il or _adesso() + timedelta(seconds=SCADENZA_FIRMA)
+    db.execute(UPSERT_FIRME, {"bucket": bucket, "paths": list(firmate), "urls": list(firmate.values()),
+                              "scade_il": scade_il})
+    _memorizza(bucket, firmate, scade_il)
+
+
+def url_firmate(db: Session, paths, bucket: str = BUCKET_MEDIA_AI) -> dict:
+    """
+    URL firmate valide almeno MARGINE per i path dati: {path: url}. I path non firmabili
+    restano fuori. Le nuove firme si salvano in una sessione propria: la transazione del
+    chiamante (es. cursore server-side dello stream NDJSON) non viene mai chiusa.
+    """
+    limite = _adesso() + MARGINE
+    risultato, mancanti = {}, []
+    for path in {p for p in paths if p}:
+        voce = _cache.get((bucket, path))
+        if voce and voce[1] > limite:
+            if voce[0]:
+                risultato[path] = voce[0]
+        else:
+            mancanti.append(path)
+    if not mancanti:
+        return risultato
+
+    rows = db.execute(text("""
+        SELECT path, url, scade_il
+        FROM public.storage_url_firmate
+        WHERE bucket = :bucket AND path = ANY(CAST(:paths AS text[])) AND scade_il > :limite
+    """), {"bucket": bucket, "paths": mancanti, "limite": limite}).fetchall()
+    for r in rows:
+        risultato[r.path] = r.url
+        _cache.set((bucket, r.path), (r.url, r.scade_il))
+
+    da_firmare = [p for p in mancanti if p not in risultato]
+    if da_firmare:
+        risultato.update(_firma_e_registra(bucket, da_firmare, limite))
+    return risultato
+
+
+def _firma_e_registra(bucket: str, paths: list, limite: datetime) -> dict:
+    try:
+        firmate = storage.firma_molti_sync(bucket, paths)
+    except Exception as e:
+        logging.error(f"❌ Firma URL storage fallita ({len(paths)} path): {e}")
+        return {}
+    # oggetti non firmabili (es. rimossi): niente nuova chiamata a ogni render
+    _memorizza(bucket, {p: None for p in paths if p not in firmate}, limite + MARGINE)
+
+    db = SessionLocal()
+    try:
+        registra_firme(db, bucket, firmate)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        # le URL restano valide: si servono comunque, al prossimo giro si risalvano
+        _memorizza(bucket, firmate, _adesso() + timedelta(seconds=SCADENZA_FIRMA))
+        logging.error(f"❌ Salvataggio URL firmate fallito ({len(firmate)} path): {e}")
+    finally:
+        db.close()
+    return firmate
+
+
+def url_media(db: Session, righe, colonna_path: str = "storage_path", colonna_url: str = "public_url",
+              bucket: str = BUCKET_MEDIA_AI) -> dict:
+    """Per righe con storage_path + public_url: {storage_path: url} con fallback alla colonna salvata."""
+    righe = list(righe)
+    firmate = url_firmate(db, [getattr(r, colonna_path) for r in righe], bucket)
+    return {
+        getattr(r, colonna_path): firmate.get(getattr(r, colonna_path)) or getattr(r, colonna_url)
+        for r in righe if getattr(r, colonna_path)
+    }
+
+
+# --- rinnovo in blocco (job schedulato)
+
+def _da_rinnovare(limite: int, saltati: list) -> dict:
+    db = SessionLocal()
+    try:
+        rows = db.execute(text("""
+            SELECT bucket, path FROM public.storage_url_firmate
+            WHERE scade_il < now() + make_interval(secs => :anticipo)
+              AND path <> ALL(CAST(:saltati AS text[]))
+            ORDER BY scade_il
+            LIMIT :limite
+        """), {"anticipo": ANTICIPO_RINNOVO.total_seconds(), "limite": limite, "saltati": saltati}).fetchall()
+        per_bucket = defaultdict(list)
+        for r in rows:
+            per_bucket[r.bucket].append(r.path)
+
+        # media AI mai passati dal servizio (caricati prima o da altri percorsi)
+        if len(rows) < limite:
+            nuovi = db.execute(text("""
+                SELECT l.storage_path FROM public.usato_leonardo l
+                WHERE l.status = 'completed' AND l.storage_path IS NOT NULL
+                  AND l.storage_path <> ALL(CAST(:saltati AS text[]))
+                  AND NOT EXISTS (SELECT 1 FROM public.storage_url_firmate f
+                                  WHERE f.bucket = :bucket AND f.path = l.storage_path)
+                LIMIT :limite
+            """), {"bucket": BUCKET_MEDIA_AI, "limite": limite - len(rows), "saltati": saltati}).scalars().all()
+            per_bucket[BUCKET_MEDIA_AI].extend(nuovi)
+        return per_bucket
+    finally:
+        db.close()
+
+
+def _salva_rinnovo(bucket: str, firmate: dict, scade_il: datetime):
+    db = SessionLocal()
+    try:
+        registra_firme(db, bucket, firmate, scade_il)
+        if bucket == BUCKET_MEDIA_AI:
+            # la colonna resta allineata per chi la legge ancora (admin, export)
+            db.execute(text("""
+                UPDATE public.usato_leonardo l
+                   SET public_url = f.url
+                  FROM unnest(CAST(:paths AS text[]), CAST(:urls AS text[])) AS f(path, url)
+                 WHERE l.storage_path = f.path
+            """), {"paths": list(firmate), "urls": list(firmate.values())})
+        db.commit()
+    finally:
+        db.close()
+
+
+async def rinnova_url_firmate():
+    """Rifirma a lotti le URL in scadenza entro ANTICIPO_RINNOVO (una chiamata di firma per lotto)."""
+    totale, saltati = 0, []
+    while True:
+        per_bucket = await run_db(_da_rinnovare, LOTTO_RINNOVO, saltati)
+        if not any(per_bucket.values()):
+            break
+        for bucket, paths in per_bucket.items():
+            scade_il = _adesso() + timedelta(seconds=SCADENZA_FIRMA)
+            firmate = await storage.firma_molti(bucket, paths)
+            if firmate:
+                await run_db(_salva_rinnovo, bucket, firmate, scade_il)
+            totale += len(firmate)
+            # non firmabili (oggetto rimosso?): saltati fino al prossimo giro del job
+            non_firmati = [p for p in paths if p not in firmate]
+            if non_firmati:
+                saltati.extend(non_firmati)
+                logging.warning(f"⚠️ {len(non_firmati)} path non firmabili in {bucket}")
+    if totale:
+        logging.info(f"🔏 URL firmate rinnovate: {totale}")
+
+
+def url_firmate_metrics() -> dict:
+    return _cache.metrics()
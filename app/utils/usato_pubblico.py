@@ -0,0 +1,334 @@
+import base64
+import binascii
+import json
+from collections import defaultdict
+from datetime import datetime
+from typing import Optional
+from uuid import UUID
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from app.database import SessionLocal
+from app.models import SiteAdminSettings
+from app.utils.tenant_cache import risolvi_tenant
+from app.utils.ricerca import filtro_ricerca, applica_soglia
+from app.utils.url_firmate import url_firmate
+
+
+# === Vetrina pubblica usato: caricamento a insiemi ===
+# Ogni relazione (foto, media AI, dettagli Motornet, vetrina) viene letta con
+# UNA query per l'intero elenco di auto, poi il risultato è composto in memoria.
+# Il numero di query resta costante al crescere del parco auto del dealer.
+
+SQL_AUTO_SELECT = """
+    SELECT
+        a.id AS id_auto,
+        a.anno_immatricolazione,
+        a.km_certificati,
+        a.colore,
+        a.codice_motornet,
+        a.cronologia_tagliandi,
+        i.prezzo_vendita,
+        i.iva_esposta,
+        i.data_inserimento,
+        i.opzionato_da,
+        i.venduto_da,
+        i.dealer_id,
+        d.marca_nome AS marca,
+        d.allestimento
+"""
+
+SQL_AUTO_FROM = """
+    FROM azlease_usatoauto a
+    JOIN azlease_usatoin i ON i.id = a.id_usatoin
+    LEFT JOIN mnet_dettagli_usato d ON d.codice_motornet_uni = a.codice_motornet
+    WHERE i.admin_id = :admin_id
+      AND i.visibile = TRUE
+      AND (:dealer_id IS NULL OR i.dealer_id = :dealer_id)
+"""
+
+
+def codifica_cursore(data_inserimento: datetime, id_auto) -> str:
+    """Cursore keyset opaco (data_inserimento, id) dell'ultima riga restituita."""
+    payload = json.dumps([data_inserimento.isoformat(), str(id_auto)])
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii")
+
+
+def decodifica_cursore(cursor: str) -> tuple[datetime, str]:
+    try:
+        data_iso, id_auto = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return datetime.fromisoformat(data_iso), str(UUID(id_auto))
+    except (ValueError, TypeError, binascii.Error):
+        raise HTTPException(400, "Cursore non valido")
+
+
+def query_auto_visibili(
+    admin_id: int,
+    dealer_id: Optional[int],
+    marca: Optional[str] = None,
+    alimentazione: Optional[str] = None,
+    prezzo_min: Optional[float] = None,
+    prezzo_max: Optional[float] = None,
+    km_max: Optional[int] = None,
+    search: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+    count_only: bool = False,
+) -> tuple[str, dict]:
+    """
+    Costruisce la query delle auto visibili di uno slug con i filtri lato server
+    (sul join mnet_dettagli_usato già presente) e la paginazione keyset
+    su (data_inserimento, id). Con `search` senza paginazione l'ordine è per
+    rilevanza; con cursore/limit resta quello keyset. Restituisce (sql, parametri).
+    """
+    where = []
+    params = {"admin_id": admin_id, "dealer_id": dealer_id}
+
+    ricerca = filtro_ricerca(search, "d.testo_ricerca", "d.search_vector")
+    if ricerca:
+        where.append(ricerca.where)
+        params.update(ricerca.params)
+
+    if marca:
+        where.append("lower(d.marca_nome) = :marca")
+        params["marca"] = marca.lower().strip()
+    if alimentazione:
+        where.append("lower(d.alimentazione) = :alimentazione")
+        params["alimentazione"] = alimentazione.lower().strip()
+    if prezzo_min is not None:
+        where.append("i.prezzo_vendita >= :prezzo_min")
+        params["prezzo_min"] = prezzo_min
+    if prezzo_max is not None:
+        where.append("i.prezzo_vendita <= :prezzo_max")
+        params["prezzo_max"] = prezzo_max
+    if km_max is not None:
+        where.append("a.km_certificati <= :km_max")
+        params["km_max"] = km_max
+
+    filtri = "".join(f"\n      AND {w}" for w in where)
+
+    if count_only:
+        return f"SELECT COUNT(*) {SQL_AUTO_FROM}{filtri}", params
+
+    if cursor:
+        params["cur_data"], params["cur_id"] = decodifica_cursore(cursor)
+        filtri += "\n      AND (i.data_inserimento, a.id) < (:cur_data, CAST(:cur_id AS uuid))"
+
+    ordine = "i.data_inserimento DESC, a.id DESC"
+    if ricerca and cursor is None and limit is None:
+        ordine = f"{ricerca.rilevanza} DESC, {ordine}"
+
+    sql = f"{SQL_AUTO_SELECT}{SQL_AUTO_FROM}{filtri}\n    ORDER BY {ordine}"
+    if limit is not None:
+        sql += "\n    LIMIT :limit"
+        params["limit"] = limit
+
+    return sql, params
+
+
+def _carica_immagini(db: Session, ids: list) -> dict:
+    rows = db.execute(text("""
+        SELECT auto_id, id, foto AS foto_url, principale
+        FROM azlease_usatoimg
+        WHERE auto_id = ANY(CAST(:ids AS uuid[]))
+        ORDER BY auto_id, principale DESC, id ASC
+    """), {"ids": ids}).fetchall()
+
+    immagini = defaultdict(list)
+    for r in rows:
+        immagini[str(r.auto_id)].append({"id": r.id, "foto_url": r.foto_url, "principale": r.principale})
+    return immagini
+
+
+def _carica_media_ai(db: Session, ids: list) -> dict:
+    # un solo giro per immagine e video attivi: DISTINCT ON (auto, tipo)
+    rows = db.execute(text("""
+        SELECT DISTINCT ON (id_auto, media_type) id_auto, media_type, public_url, storage_path, varianti
+        FROM usato_leonardo
+        WHERE id_auto = ANY(CAST(:ids AS uuid[]))
+          AND media_type IN ('image', 'video')
+          AND is_active = true
+        ORDER BY id_auto, media_type, id DESC
+    """), {"ids": ids}).fetchall()
+
+    # URL firmate dal servizio (per storage_path), la colonna salvata solo come ripiego
+    firmate = url_firmate(db, [r.storage_path for r in rows] + [
+        v.get("path") for r in rows if r.varianti for v in r.varianti.values()
+    ])
+
+    media = defaultdict(dict)
+    for r in rows:
+        media[str(r.id_auto)][r.media_type] = firmate.get(r.storage_path) or r.public_url
+        if r.media_type == "image" and r.varianti:
+            media[str(r.id_auto)]["varianti"] = {
+                nome: firmate.get(v.get("path")) or v.get("url") for nome, v in r.varianti.items()
+            }
+    return media
+
+
+def _carica_dettagli(db: Session, codici: list) -> dict:
+    if not codici:
+        return {}
+
+    rows = db.execute(text("""
+        SELECT
+            codice_motornet_uni,
+            alimentazione, cambio, trazione, hp, kw, cilindrata,
+            descrizione_motore, euro, consumo_medio, emissioni_co2,
+            segmento, categoria, tipo, porte, posti, bagagliaio,
+            lunghezza, larghezza, altezza,
+            velocita, accelerazione,
+            consumo_urbano, consumo_extraurbano,
+            emissioni_urbe, emissioni_extraurb,
+            neo_patentati
+        FROM mnet_dettagli_usato
+        WHERE codice_motornet_uni = ANY(:codici)
+    """), {"codici": codici}).fetchall()
+
+    dettagli = {}
+    for r in rows:
+        d = dict(r._mapping)
+        dettagli[d.pop("codice_motornet_uni")] = d
+    return dettagli
+
+
+def _carica_vetrina(db: Session, ids: list) -> dict:
+    # cover (priority più bassa) + conteggio media per auto in una sola passata
+    rows = db.execute(text("""
+        SELECT DISTINCT ON (v.id_auto)
+            v.id_auto,
+            CASE v.media_type
+              WHEN 'foto' THEN f.foto
+              WHEN 'ai'   THEN l.public_url
+            END AS url,
+            l.storage_path,
+            COUNT(*) OVER (PARTITION BY v.id_auto) AS total_media
+        FROM public.usato_vetrina v
+        LEFT JOIN public.azlease_usatoimg f ON v.media_type = 'foto' AND f.id = v.media_id
+        LEFT JOIN public.usato_leonardo l ON v.media_type = 'ai' AND l.id = v.media_id
+        WHERE v.id_auto = ANY(CAST(:ids AS uuid[]))
+        ORDER BY v.id_auto, v.priority ASC NULLS LAST, v.created_at ASC
+    """), {"ids": ids}).fetchall()
+
+    firmate = url_firmate(db, [r.storage_path for r in rows])
+    return {str(r.id_auto): (firmate.get(r.storage_path) or r.url, r.total_media) for r in rows}
+
+
+def _carica_info_dealer(db: Session, rows) -> dict:
+    dealer_ids = {r.dealer_id for r in rows if getattr(r, "dealer_id", None) is not None}
+    dealer_settings = {}
+    if dealer_ids:
+        q = (
+            db.query(SiteAdminSettings.dealer_id,
+                     SiteAdminSettings.logo_web,
+                     SiteAdminSettings.meta_title,
+                     SiteAdminSettings.contact_address)
+              .filter(SiteAdminSettings.dealer_id.in_(dealer_ids))
+        )
+        for r in q.all():
+            dealer_settings[r.dealer_id] = {
+                "logo": r.logo_web,
+                "nome": r.meta_title,
+                "indirizzo": r.contact_address,
+            }
+    return dealer_settings
+
+
+def componi_usato_pubblico(db: Session, settings: SiteAdminSettings, rows) -> list:
+    """
+    Compone la risposta della vetrina pubblica usato per le righe base date
+    (una riga per auto, vedi query_auto_visibili) con un numero fisso di query.
+    """
+    if not rows:
+        return []
+
+    admin_id = settings.admin_id
+    ids = [str(r.id_auto) for r in rows]
+    codici = list({r.codice_motornet for r in rows if r.codice_motornet})
+
+    immagini = _carica_immagini(db, ids)
+    media_ai = _carica_media_ai(db, ids)
+    dettagli = _carica_dettagli(db, codici)
+    vetrina = _carica_vetrina(db, ids)
+    dealer_settings = _carica_info_dealer(db, rows)
+
+    admin_defaults = {
+        "logo": settings.logo_web,
+        "nome": settings.meta_title,
+        "indirizzo": settings.contact_address,
+    }
+
+    risultato = []
+    for row in rows:
+        auto = dict(row._mapping)
+        key = str(row.id_auto)
+
+        foto = immagini.get(key, [])
+        ai = media_ai.get(key, {})
+        img_ai = ai.get("image")
+        vid_ai = ai.get("video")
+
+        # Dealer effettivo
+        auto_dealer_id = row.dealer_id if getattr(row, "dealer_id", None) is not None else None
+        info = dealer_settings.get(auto_dealer_id, admin_defaults)
+
+        # Cover da vetrina (priority=1), poi AI attiva, poi prima foto
+        cover, total_media = vetrina.get(key, (None, 0))
+        cover_url = cover if key in vetrina else (img_ai if img_ai else (foto[0]["foto_url"] if foto else None))
+
+        risultato.append({
+            "auto": auto,
+            "immagini": foto,
+            "dettagli": dettagli.get(row.codice_motornet, {}),
+            "dealer_id": auto_dealer_id or admin_id,
+            "dealer_logo": info["logo"],
+            "dealer_nome": info["nome"],
+            "dealer_indirizzo": info["indirizzo"],
+            "immagine_ai": img_ai,
+            "immagine_ai_varianti": ai.get("varianti"),
+            "video_ai": vid_ai,
+            "cover_url": cover_url,
+            "total_media": total_media or 0,
+        })
+
+    return risultato
+
+
+def lista_usato_pubblico_batch(db: Session, settings: SiteAdminSettings, **filtri) -> list:
+    if filtri.get("search"):
+        applica_soglia(db)
+    sql, params = query_auto_visibili(settings.admin_id, settings.dealer_id, **filtri)
+    rows = db.execute(text(sql), params).fetchall()
+    return componi_usato_pubblico(db, settings, rows)
+
+
+def conta_usato_pubblico(db: Session, settings: SiteAdminSettings, **filtri) -> int:
+    if filtri.get("search"):
+        applica_soglia(db)
+    sql, params = query_auto_visibili(settings.admin_id, settings.dealer_id, count_only=True, **filtri)
+    return db.execute(text(sql), params).scalar() or 0
+
+
+def stream_usato_pubblico_ndjson(slug: str, chunk_size: int = 100, **filtri):
+    """
+    Generatore NDJSON (una auto per riga) con cursore lato server: le prime
+    auto arrivano al client prima che l'ultima sia serializzata.
+    Usa una sessione propria perché vive oltre la dipendenza get_db.
+    """
+    db = SessionLocal()
+    try:
+        tenant = risolvi_tenant(db, slug)
+        if not tenant:
+            return
+        settings = tenant.settings
+
+        if filtri.get("search"):
+            applica_soglia(db)
+        sql, params = query_auto_visibili(settings.admin_id, settings.dealer_id, **filtri)
+        result = db.execute(text(sql).execution_options(stream_results=True), params)
+        for rows in result.partitions(chunk_size):
+            for item in componi_usato_pubblico(db, settings, rows):
+                yield json.dumps(jsonable_encoder(item), ensure_ascii=False) + "\n"
+    finally:
+        db.close()
@@ -0,0 +1,131 @@
+import os
+import json
+import select
+import asyncio
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Optional
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+
+# === Eventi WhatsApp in push (WebSocket /api/whatsapp/eventi) ===
+# Invio e ricezione dei messaggi pubblicano un evento; ogni connessione WebSocket
+# ha una coda asyncio e riceve solo gli eventi dei dealer che può vedere.
+#   - locale (default): consegna in-process dopo il commit della transazione
+#   - WHATSAPP_PUBSUB_PG=true: pg_notify nella transazione, un thread in LISTEN
+#     consegna a tutte le repliche (ognuna riceve anche i propri eventi)
+#
+#   pubblica_evento(db, {...})   # PRIMA di db.commit(): con il rollback non parte nulla
+
+CANALE_PG = "whatsapp_eventi"
+WHATSAPP_PUBSUB_PG = os.getenv("WHATSAPP_PUBSUB_PG", "false").lower() == "true"
+CODA_MAX = 200
+MAX_TESTO_NOTIFY = 2000  # il payload di NOTIFY ha un limite di 8000 byte
+
+
+@dataclass(eq=False)
+class Iscrizione:
+    loop: asyncio.AbstractEventLoop
+    coda: asyncio.Queue
+    dealer_ids: frozenset
+    sessione_id: Optional[str] = None
+
+    def interessa(self, evento: dict) -> bool:
+        if evento.get("dealer_id") not in self.dealer_ids:
+            return False
+        return self.sessione_id is None or evento.get("sessione_id") == self.sessione_id
+
+
+def _metti(coda: asyncio.Queue, evento: dict):
+    try:
+        coda.put_nowait(evento)
+    except asyncio.QueueFull:
+        # client troppo lento: svuota e chiede di ricaricare via REST
+        while not coda.empty():
+            coda.get_nowait()
+        coda.put_nowait({"tipo": "risincronizza"})
+
+
+class BrokerEventi:
+    def __init__(self):
+        self._iscritti: set = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._listener: Optional[threading.Thread] = None
+
+    def iscrivi(self, dealer_ids, sessione_id: Optional[str] = None) -> Iscrizione:
+        """Da chiamare dentro l'event loop della connessione."""
+        iscrizione = Iscrizione(asyncio.get_running_loop(), asyncio.Queue(CODA_MAX), frozenset(dealer_ids), sessione_id)
+        with self._lock:
+            self._iscritti.add(iscrizione)
+        return iscrizione
+
+    def disiscrivi(self, iscrizione: Iscrizione):
+        with self._lock:
+            self._iscritti.discard(iscrizione)
+
+    def consegna(self, evento: dict):
+        """Thread-safe: chiamabile da handler sincroni, thread LISTEN o dal loop."""
+        with self._lock:
+            destinatari = [i for i in self._iscritti if i.interessa(evento)]
+        for iscrizione in destinatari:
+            iscrizione.loop.call_soon_threadsafe(_metti, iscrizione.coda, evento)
+
+    # --- fan-out tra repliche via LISTEN/NOTIFY
+
+    def _ascolta(self):
+        import psycopg2
+        import psycopg2.extensions
+        from app.database import engine
+
+        dsn = engine.url.set(drivername="postgresql").render_as_string(hide_password=False)
+        while not self._stop.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(dsn)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                conn.cursor().execute(f"LISTEN {CANALE_PG}")
+                logging.info("📡 Eventi WhatsApp: in ascolto su Postgres")
+                while not self._stop.is_set():
+                    if select.select([conn], [], [], 5) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notifica = conn.notifies.pop(0)
+                        try:
+                            self.consegna(json.loads(notifica.payload))
+                        except ValueError:
+                            logging.warning("⚠️ Evento WhatsApp non valido scartato")
+            except Exception as e:
+                logging.error(f"❌ LISTEN eventi WhatsApp interrotto: {e}")
+                self._stop.wait(5)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+    def start(self):
+        if not WHATSAPP_PUBSUB_PG or (self._listener and self._listener.is_alive()):
+            return
+        self._stop.clear()
+        self._listener = threading.Thread(target=self._ascolta, name="whatsapp-listen", daemon=True)
+        self._listener.start()
+
+    def stop(self):
+        self._stop.set()
+
+
+broker_whatsapp = BrokerEventi()
+
+
+def pubblica_evento(db: Session, evento: dict):
+    """Accoda l'evento alla transazione corrente di `db`: parte solo se il commit va a buon fine."""
+    if WHATSAPP_PUBSUB_PG:
+        payload = dict(evento)
+        messaggio = payload.get("messaggio")
+        if messaggio and len(messaggio.get("messaggio") or "") > MAX_TESTO_NOTIFY:
+            payload["messaggio"] = {**messaggio, "messaggio": messaggio["messaggio"][:MAX_TESTO_NOTIFY], "troncato": True}
+        db.execute(text("SELECT pg_notify(:canale, :payload)"),
+                   {"canale": CANALE_PG, "payload": json.dumps(payload, default=str)})
+    else:
+        event.listen(db, "after_commit", lambda _sessione: broker_whatsapp.consegna(evento), once=True)
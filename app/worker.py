@@ -0,0 +1,85 @@
+import sys
+import signal
+import asyncio
+import logging
+from datetime import timedelta
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from apscheduler.triggers.interval import IntervalTrigger
+from app.tasks import scheduler
+from app.utils.job_lease import HOLDER_ID, acquisisci_lease, rilascia_lease, con_lease
+
+# === Worker dei job schedulati (fuori dal processo web) ===
+#   python -m app.worker
+# Stesso registro job di app/tasks.py. Più repliche possono girare insieme:
+# solo il leader (lease 'scheduler') tiene lo scheduler attivo, le altre restano
+# in standby e subentrano se il leader smette di rinnovare il lease.
+
+LEADER_LEASE = "scheduler"
+LEADER_TTL = 30          # secondi: un leader morto viene sostituito entro questo tempo
+CRON_JOB_TTL = 6 * 3600  # tetto per i job lunghi (sync Motornet, foto)
+
+
+def _nome_job(job) -> str:
+    # gli id senza nome esplicito sono uuid diversi per processo: uso la funzione
+    return f"job:{job.func.__module__}.{job.func.__qualname__}"
+
+
+def _ttl_job(job) -> float:
+    if isinstance(job.trigger, IntervalTrigger):
+        return max(60.0, 4 * job.trigger.interval / timedelta(seconds=1))
+    return CRON_JOB_TTL
+
+
+def proteggi_job():
+    """Ogni job prende il proprio lease prima di partire: mai due esecuzioni in parallelo tra repliche."""
+    for job in scheduler.get_jobs():
+        job.modify(func=con_lease(_nome_job(job), job.func, _ttl_job(job)))
+
+
+async def main():
+    proteggi_job()
+    scheduler.start(paused=True)
+    leader = False
+    stop = asyncio.Event()
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # Windows
+            pass
+
+    logging.info(f"👷 Worker avviato ({HOLDER_ID}), {len(scheduler.get_jobs())} job registrati")
+    try:
+        while not stop.is_set():
+            try:
+                ok = await asyncio.to_thread(acquisisci_lease, LEADER_LEASE, LEADER_TTL)
+            except Exception as e:
+                logging.error(f"❌ Rinnovo lease leader fallito: {e}")
+                ok = False
+
+            if ok and not leader:
+                scheduler.resume()
+                logging.info("👑 Leader: scheduler attivo")
+            elif not ok and leader:
+                scheduler.pause()
+                logging.warning("⏸️ Lease perso: scheduler in pausa, torno in standby")
+            leader = ok
+
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=LEADER_TTL / 3)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        scheduler.shutdown(wait=False)
+        if leader:
+            await asyncio.to_thread(rilascia_lease, LEADER_LEASE)
+        logging.info("🛑 Worker fermato")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s", handlers=[logging.StreamHandler(sys.stdout)])
+    asyncio.run(main())
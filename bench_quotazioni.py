@@ -0,0 +1,137 @@
+from dotenv import load_dotenv
+load_dotenv(dotenv_path=".env")  # Assicura il caricamento delle variabili
+
+import sys
+import time
+from sqlalchemy import event
+
+from app.database import SessionLocal, engine
+from app.models import NltOfferte, NltQuotazioni, SiteAdminSettings
+from app.utils.quotazioni import calcola_quotazioni, calcola_quotazioni_custom
+
+# Verifica di parità del motore quotazioni a lotti: per ogni offerta attiva
+# dell'admin dello slug confronta il risultato del lotto con il calcolo
+# riga per riga storico (una query settings admin per offerta), e misura
+# query e tempi di entrambi.
+#
+#   python bench_quotazioni.py <slug>
+
+query_count = 0
+
+
+def _conta_query(conn, cursor, statement, parameters, context, executemany):
+    global query_count
+    query_count += 1
+
+
+def _quotazione_riga(db, offerta, durata, km, canone_base, settings_corrente):
+    """Calcolo storico riga per riga, usato come riferimento."""
+    if not offerta or not durata or durata <= 0 or not canone_base:
+        return None, None, None, None
+    try:
+        canone_base = float(canone_base)
+    except (TypeError, ValueError):
+        return None, None, None, None
+
+    prezzo_grezzo = offerta.prezzo_totale or offerta.prezzo_listino
+    if not prezzo_grezzo:
+        return None, None, None, None
+    prezzo_netto = float(prezzo_grezzo) / 1.22
+
+    settings_admin = db.query(SiteAdminSettings).filter(
+        SiteAdminSettings.admin_id == int(offerta.id_admin),
+        SiteAdminSettings.dealer_id == None
+    ).first()
+    if settings_admin:
+        db.refresh(settings_admin)
+
+    try:
+        prov_admin = float(settings_admin.prov_vetrina)
+    except (TypeError, ValueError, AttributeError):
+        prov_admin = 0.0
+
+    prov_dealer = 0.0
+    if settings_corrente and settings_admin and settings_corrente.id != settings_admin.id:
+        try:
+            prov_dealer = float(settings_corrente.prov_vetrina or 0)
+        except (TypeError, ValueError):
+            prov_dealer = 0.0
+
+    if offerta.id_player == 5:
+        prov_admin = 0.0
+        prov_dealer = 0.0
+
+    canone_finale = canone_base + prezzo_netto * (prov_admin + prov_dealer) / 100.0 / durata
+    return durata, km, round(canone_finale, 2), (settings_corrente.slug if settings_corrente else None)
+
+
+def _selezione_riga(offerta, quotazione):
+    if not offerta or not quotazione or not offerta.prezzo_listino:
+        return None, None, None
+    if offerta.solo_privati and quotazione.mesi_48_30:
+        return 48, 30000, quotazione.mesi_48_30
+    if quotazione.mesi_36_10:
+        return 36, 10000, quotazione.mesi_36_10
+    if quotazione.mesi_48_10:
+        return 48, 10000, quotazione.mesi_48_10
+    return None, None, None
+
+
+def _misura(etichetta, fn):
+    global query_count
+    query_count = 0
+    t0 = time.perf_counter()
+    risultato = fn()
+    ms = (time.perf_counter() - t0) * 1000
+    print(f"📊 {etichetta:<22} query={query_count:>5}  tempo={ms:8.1f} ms")
+    return risultato
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Uso: python bench_quotazioni.py <slug>")
+        sys.exit(1)
+
+    slug = sys.argv[1]
+    db = SessionLocal()
+    try:
+        settings = db.query(SiteAdminSettings).filter(SiteAdminSettings.slug == slug).first()
+        if not settings:
+            print(f"❌ Slug '{slug}' non trovato")
+            sys.exit(1)
+
+        coppie = (
+            db.query(NltOfferte, NltQuotazioni)
+            .join(NltQuotazioni, NltOfferte.id_offerta == NltQuotazioni.id_offerta)
+            .filter(NltOfferte.id_admin == settings.admin_id, NltOfferte.attivo.is_(True))
+            .all()
+        )
+        print(f"🚗 Offerte attive per '{slug}': {len(coppie)}")
+
+        event.listen(engine, "before_cursor_execute", _conta_query)
+
+        attesi = _misura("riga per riga", lambda: [
+            _quotazione_riga(db, o, *_selezione_riga(o, q), settings) for o, q in coppie
+        ])
+        ottenuti = _misura("lotto", lambda: calcola_quotazioni(db, coppie, settings_corrente=settings))
+
+        attesi_6040 = _misura("riga per riga 60/40", lambda: [
+            _quotazione_riga(db, o, 60, 40000, q.mesi_60_40, settings) for o, q in coppie
+        ])
+        ottenuti_6040 = _misura("lotto 60/40", lambda: calcola_quotazioni_custom(
+            db, [(o, 60, 40000, q.mesi_60_40) for o, q in coppie], settings_corrente=settings
+        ))
+
+        event.remove(engine, "before_cursor_execute", _conta_query)
+
+        differenze = [
+            (o.id_offerta, a, b)
+            for (o, _), a, b in zip(coppie + coppie, attesi + attesi_6040, ottenuti + ottenuti_6040)
+            if tuple(a) != tuple(b)
+        ]
+        for id_offerta, a, b in differenze[:20]:
+            print(f"❌ offerta {id_offerta}: riga={a} lotto={b}")
+        print("✅ Parità OK" if not differenze else f"❌ {len(differenze)} differenze")
+        sys.exit(1 if differenze else 0)
+    finally:
+        db.close()
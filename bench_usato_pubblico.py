@@ -0,0 +1,54 @@
+from dotenv import load_dotenv
+load_dotenv(dotenv_path=".env")  # Assicura il caricamento delle variabili
+
+import sys
+import time
+from sqlalchemy import event, text
+
+from app.database import SessionLocal, engine
+from app.models import SiteAdminSettings
+from app.utils.usato_pubblico import query_auto_visibili, componi_usato_pubblico
+
+# Benchmark vetrina pubblica usato: conta le query eseguite per comporre
+# la lista al crescere del numero di auto. Con il caricamento a insiemi
+# il conteggio deve restare costante.
+#
+#   python bench_usato_pubblico.py <slug>
+
+query_count = 0
+
+
+def _conta_query(conn, cursor, statement, parameters, context, executemany):
+    global query_count
+    query_count += 1
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Uso: python bench_usato_pubblico.py <slug>")
+        sys.exit(1)
+
+    slug = sys.argv[1]
+    db = SessionLocal()
+    try:
+        settings = db.query(SiteAdminSettings).filter(SiteAdminSettings.slug == slug).first()
+        if not settings:
+            print(f"❌ Slug '{slug}' non trovato")
+            sys.exit(1)
+
+        sql, params = query_auto_visibili(settings.admin_id, settings.dealer_id)
+        rows = db.execute(text(sql), params).fetchall()
+        print(f"🚗 Auto visibili per '{slug}': {len(rows)}")
+
+        event.listen(engine, "before_cursor_execute", _conta_query)
+        for n in (1, 10, 50, 100, 300, len(rows)):
+            if n > len(rows):
+                continue
+            query_count = 0
+            t0 = time.perf_counter()
+            componi_usato_pubblico(db, settings, rows[:n])
+            ms = (time.perf_counter() - t0) * 1000
+            print(f"📊 auto={n:>5}  query={query_count:>3}  tempo={ms:8.1f} ms")
+        event.remove(engine, "before_cursor_execute", _conta_query)
+    finally:
+        db.close()
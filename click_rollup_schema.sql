@@ -0,0 +1,25 @@
+--
+-- Contatori giornalieri dei click (statistiche /analytics e filtro "top" della vetrina NLT)
+-- Incrementati dal writer dei click (app/utils/click_buffer.py) nello stesso statement
+-- che inserisce lo storico; ricostruibili con:  python -m app.utils.click_rollup
+--
+
+CREATE TABLE IF NOT EXISTS public.nlt_offerte_click_giorno (
+    giorno date NOT NULL,
+    id_offerta integer NOT NULL REFERENCES public.nlt_offerte (id_offerta) ON DELETE CASCADE,
+    id_dealer integer NOT NULL REFERENCES public.utenti (id) ON DELETE CASCADE,
+    click integer DEFAULT 0 NOT NULL,
+    CONSTRAINT nlt_offerte_click_giorno_pkey PRIMARY KEY (giorno, id_offerta, id_dealer)
+);
+
+CREATE INDEX IF NOT EXISTS nlt_offerte_click_giorno_offerta_idx ON public.nlt_offerte_click_giorno (id_offerta);
+CREATE INDEX IF NOT EXISTS nlt_offerte_click_giorno_dealer_idx ON public.nlt_offerte_click_giorno (id_dealer);
+
+CREATE TABLE IF NOT EXISTS public.nlt_vetrina_click_giorno (
+    giorno date NOT NULL,
+    id_dealer integer NOT NULL REFERENCES public.utenti (id) ON DELETE CASCADE,
+    click integer DEFAULT 0 NOT NULL,
+    CONSTRAINT nlt_vetrina_click_giorno_pkey PRIMARY KEY (giorno, id_dealer)
+);
+
+CREATE INDEX IF NOT EXISTS nlt_vetrina_click_giorno_dealer_idx ON public.nlt_vetrina_click_giorno (id_dealer);
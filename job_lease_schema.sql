@@ -0,0 +1,12 @@
+--
+-- Name: job_lease; Type: TABLE; Schema: public; Owner: postgres
+-- Lease dei job schedulati: leader election del worker e claim per singolo job
+--
+
+CREATE TABLE IF NOT EXISTS public.job_lease (
+    nome character varying NOT NULL,
+    holder character varying NOT NULL,
+    scade_il timestamp with time zone NOT NULL,
+    acquisito_il timestamp with time zone DEFAULT now() NOT NULL,
+    CONSTRAINT job_lease_pkey PRIMARY KEY (nome)
+);
@@ -0,0 +1,44 @@
+--
+-- Name: mnet_sync_retry; Type: TABLE; Schema: public; Owner: postgres
+-- Coda persistente dei codici falliti dei job di sync Motornet
+--
+
+CREATE TABLE IF NOT EXISTS public.mnet_sync_retry (
+    job character varying NOT NULL,
+    chiave character varying NOT NULL,
+    tentativi integer DEFAULT 1 NOT NULL,
+    ultimo_errore text,
+    updated_at timestamp with time zone DEFAULT now() NOT NULL,
+    CONSTRAINT mnet_sync_retry_pkey PRIMARY KEY (job, chiave)
+);
+
+--
+-- Sync incrementale dettagli: hash del contenuto e data ultimo download
+--
+
+ALTER TABLE public.mnet_dettagli
+    ADD COLUMN IF NOT EXISTS content_hash character varying(64),
+    ADD COLUMN IF NOT EXISTS fetched_at timestamp with time zone;
+
+ALTER TABLE public.mnet_dettagli_usato
+    ADD COLUMN IF NOT EXISTS content_hash character varying(64),
+    ADD COLUMN IF NOT EXISTS fetched_at timestamp with time zone;
+
+CREATE INDEX IF NOT EXISTS mnet_dettagli_fetched_at_idx ON public.mnet_dettagli (fetched_at);
+CREATE INDEX IF NOT EXISTS mnet_dettagli_usato_fetched_at_idx ON public.mnet_dettagli_usato (fetched_at);
+
+--
+-- Diametro cerchio precalcolato (costo pneumatici nel preventivo NLT, vedi app/utils/servizi_extra.py)
+-- Scritto dal sync dettagli; l'UPDATE riempie le righe già presenti
+--
+
+ALTER TABLE public.mnet_dettagli
+    ADD COLUMN IF NOT EXISTS diametro_cerchio smallint;
+
+UPDATE public.mnet_dettagli
+SET diametro_cerchio = GREATEST(
+    substring(pneumatici_anteriori FROM 'R(\d{2})')::smallint,
+    substring(pneumatici_posteriori FROM 'R(\d{2})')::smallint
+)
+WHERE diametro_cerchio IS NULL
+  AND (pneumatici_anteriori ~ 'R\d{2}' OR pneumatici_posteriori ~ 'R\d{2}');
@@ -0,0 +1,105 @@
+--
+-- Name: nlt_catalogo_vetrina; Type: TABLE; Schema: public; Owner: postgres
+-- Catalogo NLT denormalizzato per tenant (una riga per settings sito × offerta attiva)
+-- con canone finale già calcolato: la vetrina filtrata diventa una sola query indicizzata.
+-- Ricostruito per admin da app/utils/catalogo_nlt.py
+--
+
+CREATE TABLE IF NOT EXISTS public.nlt_catalogo_vetrina (
+    settings_id integer NOT NULL,
+    id_offerta integer NOT NULL,
+    admin_id integer NOT NULL,
+    slug character varying(255) NOT NULL,
+    marca character varying(100),
+    modello character varying(100),
+    versione character varying(100),
+    cambio character varying,
+    alimentazione character varying,
+    segmento character varying,
+    segmento_mnet character varying,
+    segmento_descrizione character varying,
+    tipo_descrizione character varying,
+    id_player integer,
+    solo_privati boolean DEFAULT false NOT NULL,
+    prezzo_listino numeric(10,2),
+    prezzo_totale numeric(10,2),
+    canone_mensile numeric(10,2),
+    durata_mesi integer,
+    km_inclusi integer,
+    canone_60_40 numeric(10,2),
+    ha_dettagli boolean DEFAULT false NOT NULL,
+    immagine character varying(1000),
+    rating_convenienza smallint,
+    search_vector tsvector GENERATED ALWAYS AS (
+        to_tsvector('simple', coalesce(marca, '') || ' ' || coalesce(modello, '') || ' ' || coalesce(versione, ''))
+    ) STORED,
+    aggiornato_il timestamp with time zone DEFAULT now() NOT NULL,
+    CONSTRAINT nlt_catalogo_vetrina_pkey PRIMARY KEY (settings_id, id_offerta)
+);
+
+CREATE INDEX IF NOT EXISTS nlt_catalogo_vetrina_admin_idx ON public.nlt_catalogo_vetrina (admin_id);
+CREATE INDEX IF NOT EXISTS nlt_catalogo_vetrina_prezzo_idx ON public.nlt_catalogo_vetrina (settings_id, prezzo_listino, id_offerta);
+CREATE INDEX IF NOT EXISTS nlt_catalogo_vetrina_rating_idx ON public.nlt_catalogo_vetrina (settings_id, rating_convenienza DESC NULLS LAST);
+CREATE INDEX IF NOT EXISTS nlt_catalogo_vetrina_search_idx ON public.nlt_catalogo_vetrina USING gin (search_vector);
+
+--
+-- Name: nlt_catalogo_da_aggiornare; Type: TABLE; Schema: public; Owner: postgres
+-- Admin il cui catalogo va ricalcolato (riempita dai trigger, svuotata dal job)
+--
+
+CREATE TABLE IF NOT EXISTS public.nlt_catalogo_da_aggiornare (
+    admin_id integer NOT NULL,
+    segnato_il timestamp with time zone DEFAULT now() NOT NULL,
+    CONSTRAINT nlt_catalogo_da_aggiornare_pkey PRIMARY KEY (admin_id)
+);
+
+CREATE OR REPLACE FUNCTION public.nlt_catalogo_segna_admin() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+DECLARE
+    v_offerta integer;
+BEGIN
+    IF TG_TABLE_NAME = 'nlt_offerte' THEN
+        IF TG_OP <> 'INSERT' THEN
+            INSERT INTO public.nlt_catalogo_da_aggiornare (admin_id) VALUES (OLD.id_admin) ON CONFLICT DO NOTHING;
+        END IF;
+        IF TG_OP <> 'DELETE' THEN
+            INSERT INTO public.nlt_catalogo_da_aggiornare (admin_id) VALUES (NEW.id_admin) ON CONFLICT DO NOTHING;
+        END IF;
+    ELSIF TG_TABLE_NAME = 'site_admin_settings' THEN
+        IF TG_OP <> 'INSERT' THEN
+            INSERT INTO public.nlt_catalogo_da_aggiornare (admin_id) VALUES (OLD.admin_id) ON CONFLICT DO NOTHING;
+        END IF;
+        IF TG_OP <> 'DELETE' THEN
+            INSERT INTO public.nlt_catalogo_da_aggiornare (admin_id) VALUES (NEW.admin_id) ON CONFLICT DO NOTHING;
+        END IF;
+    ELSE
+        -- nlt_quotazioni / nlt_offerte_rating: risale all'admin tramite l'offerta
+        v_offerta := CASE WHEN TG_OP = 'DELETE' THEN OLD.id_offerta ELSE NEW.id_offerta END;
+        INSERT INTO public.nlt_catalogo_da_aggiornare (admin_id)
+        SELECT o.id_admin FROM public.nlt_offerte o WHERE o.id_offerta = v_offerta
+        ON CONFLICT DO NOTHING;
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS nlt_catalogo_offerte_trg ON public.nlt_offerte;
+CREATE TRIGGER nlt_catalogo_offerte_trg
+    AFTER INSERT OR UPDATE OR DELETE ON public.nlt_offerte
+    FOR EACH ROW EXECUTE FUNCTION public.nlt_catalogo_segna_admin();
+
+DROP TRIGGER IF EXISTS nlt_catalogo_quotazioni_trg ON public.nlt_quotazioni;
+CREATE TRIGGER nlt_catalogo_quotazioni_trg
+    AFTER INSERT OR UPDATE OR DELETE ON public.nlt_quotazioni
+    FOR EACH ROW EXECUTE FUNCTION public.nlt_catalogo_segna_admin();
+
+DROP TRIGGER IF EXISTS nlt_catalogo_rating_trg ON public.nlt_offerte_rating;
+CREATE TRIGGER nlt_catalogo_rating_trg
+    AFTER INSERT OR UPDATE OR DELETE ON public.nlt_offerte_rating
+    FOR EACH ROW EXECUTE FUNCTION public.nlt_catalogo_segna_admin();
+
+-- settings: solo i campi che cambiano canone o appartenenza
+DROP TRIGGER IF EXISTS nlt_catalogo_settings_trg ON public.site_admin_settings;
+CREATE TRIGGER nlt_catalogo_settings_trg
+    AFTER INSERT OR DELETE OR UPDATE OF prov_vetrina, slug, admin_id, dealer_id ON public.site_admin_settings
+    FOR EACH ROW EXECUTE FUNCTION public.nlt_catalogo_segna_admin();
@@ -0,0 +1,35 @@
+--
+-- Ricerca testuale vetrine NLT / usato e contesto assistente (vedi app/utils/ricerca.py)
+-- tsvector per i prefissi, pg_trgm per gli errori di battitura
+--
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+--
+-- Catalogo NLT per tenant (search_vector già presente, vedi nlt_catalogo_schema.sql)
+--
+
+ALTER TABLE public.nlt_catalogo_vetrina
+    ADD COLUMN IF NOT EXISTS testo_ricerca text GENERATED ALWAYS AS (
+        lower(coalesce(marca, '') || ' ' || coalesce(modello, '') || ' ' || coalesce(versione, ''))
+    ) STORED;
+
+CREATE INDEX IF NOT EXISTS nlt_catalogo_vetrina_trgm_idx
+    ON public.nlt_catalogo_vetrina USING gin (testo_ricerca gin_trgm_ops);
+
+--
+-- Dettagli Motornet usato (vetrina usato e assistente)
+--
+
+ALTER TABLE public.mnet_dettagli_usato
+    ADD COLUMN IF NOT EXISTS testo_ricerca text GENERATED ALWAYS AS (
+        lower(coalesce(marca_nome, '') || ' ' || coalesce(modello, '') || ' ' || coalesce(allestimento, ''))
+    ) STORED,
+    ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (
+        to_tsvector('simple', coalesce(marca_nome, '') || ' ' || coalesce(modello, '') || ' ' || coalesce(allestimento, ''))
+    ) STORED;
+
+CREATE INDEX IF NOT EXISTS mnet_dettagli_usato_trgm_idx
+    ON public.mnet_dettagli_usato USING gin (testo_ricerca gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS mnet_dettagli_usato_search_idx
+    ON public.mnet_dettagli_usato USING gin (search_vector);
@@ -0,0 +1,23 @@
+--
+-- Name: storage_url_firmate; Type: TABLE; Schema: public; Owner: postgres
+-- URL firmate dei media in storage per (bucket, path), con la loro scadenza
+-- (app/utils/url_firmate.py): lette dallo showroom, rinnovate in blocco dal job
+--
+
+CREATE TABLE IF NOT EXISTS public.storage_url_firmate (
+    bucket character varying NOT NULL,
+    path text NOT NULL,
+    url text NOT NULL,
+    scade_il timestamp with time zone NOT NULL,
+    firmato_il timestamp with time zone DEFAULT now() NOT NULL,
+    CONSTRAINT storage_url_firmate_pkey PRIMARY KEY (bucket, path)
+);
+
+-- job di rinnovo: le prossime a scadere
+CREATE INDEX IF NOT EXISTS storage_url_firmate_scade_il_idx
+    ON public.storage_url_firmate (scade_il);
+
+-- backfill dei media AI non ancora registrati (NOT EXISTS per storage_path)
+CREATE INDEX IF NOT EXISTS usato_leonardo_storage_path_idx
+    ON public.usato_leonardo (storage_path)
+    WHERE storage_path IS NOT NULL;
@@ -0,0 +1,24 @@
+--
+-- Coda immagini AI su usato_leonardo (app/utils/immagini_ai_worker.py)
+-- lease per riga: chi sta elaborando il job e fino a quando; scaduto il lease
+-- il job torna prendibile da un altro worker
+--
+
+ALTER TABLE public.usato_leonardo
+    ADD COLUMN IF NOT EXISTS lease_holder character varying,
+    ADD COLUMN IF NOT EXISTS lease_scade_il timestamp with time zone;
+
+-- claim FIFO (ORDER BY created_at ... FOR UPDATE SKIP LOCKED) e metriche della coda
+CREATE INDEX IF NOT EXISTS ix_usato_leonardo_coda_immagini
+    ON public.usato_leonardo (created_at)
+    WHERE media_type = 'image' AND status IN ('queued', 'processing');
+
+-- backoff dei tentativi: un job rimesso in coda dopo un errore non è
+-- prendibile prima di disponibile_dal (GEMINI_IMMAGINI_BACKOFF * 2^tentativi)
+ALTER TABLE public.usato_leonardo
+    ADD COLUMN IF NOT EXISTS disponibile_dal timestamp with time zone;
+
+-- varianti responsive delle immagini AI per lo showroom (app/utils/media_encoding.py)
+-- {"thumb": {"path": ..., "url": ..., "width": 320, "height": ...}, "card": ..., "hero": ...}
+ALTER TABLE public.usato_leonardo
+    ADD COLUMN IF NOT EXISTS varianti jsonb;
@@ -0,0 +1,14 @@
+--
+-- Indici per la lista sessioni WhatsApp (app/routes/whatsapp.py, GET /api/whatsapp/sessioni)
+-- ultimo messaggio per sessione e conteggio dei messaggi in ingresso non letti
+--
+
+CREATE INDEX IF NOT EXISTS nlt_messaggi_whatsapp_sessione_data_idx
+    ON public.nlt_messaggi_whatsapp (sessione_id, data_invio DESC);
+
+CREATE INDEX IF NOT EXISTS nlt_messaggi_whatsapp_non_letti_idx
+    ON public.nlt_messaggi_whatsapp (sessione_id)
+    WHERE direzione = 'in' AND stato_messaggio IS NULL;
+
+CREATE INDEX IF NOT EXISTS whatsapp_sessioni_cliente_idx
+    ON public.whatsapp_sessioni (cliente_id);